@@ -0,0 +1,447 @@
+"""
+A dataset that applies random spatial augmentation (zero-padding,
+windowing and horizontal flipping) to each minibatch of images as it is
+requested.
+
+This is an on-the-fly alternative to
+`pylearn2.train_extensions.window_flip.WindowAndFlip`, which rewrites
+the whole (padded) topological view of every dataset it randomizes once
+per epoch. Here only the minibatch being returned is ever padded and
+windowed, so memory use stays at a single copy of the dataset and there
+is no pause at epoch boundaries.
+"""
+__authors__ = "LISA Lab"
+__copyright__ = "Copyright 2010-2015, Universite de Montreal"
+__credits__ = ["LISA Lab"]
+__license__ = "3-clause BSD"
+__maintainer__ = "LISA Lab"
+__email__ = "pylearn-dev@googlegroups"
+
+import collections
+import multiprocessing
+
+import numpy
+
+from pylearn2.datasets.dataset import Dataset
+from pylearn2.space import CompositeSpace, Conv2DSpace
+from pylearn2.utils import py_integer_types, safe_zip, wraps
+from pylearn2.utils.data_specs import is_flat_specs
+from pylearn2.utils.rng import make_np_rng
+
+
+_default_seed = (2013, 2, 20)
+_canonical_axes = ('b', 0, 1, 'c')
+
+
+def random_window_and_flip(batch, window_shape, axes=_canonical_axes,
+                           pad=0, flip=True, rng=None):
+    """
+    Takes a random window of every image in a batch, optionally
+    reflecting it on the horizontal axis.
+
+    All the windows are gathered with a single fancy-indexing operation,
+    so there is no Python-level loop over the examples.
+
+    Parameters
+    ----------
+    batch : numpy.ndarray
+        A 4-dimensional batch of images, with axes given by `axes`.
+    window_shape : tuple
+        A length-2 tuple of (window_rows, window_cols).
+    axes : tuple, optional
+        A permutation of ('b', 0, 1, 'c') giving the layout of `batch`.
+    pad : int, optional
+        Number of zeros to add on each side of both spatial axes
+        before windowing. Default is 0.
+    flip : bool, optional
+        Reflect each window on the horizontal axis with probability
+        0.5. Default is `True`.
+    rng : numpy.random.RandomState or seed, optional
+        A random number generator, or a seed used to create one.
+
+    Returns
+    -------
+    windows : numpy.ndarray
+        The windowed batch, with the same axes as `batch` and spatial
+        shape `window_shape`.
+    """
+    axes = tuple(axes)
+    if len(window_shape) != 2:
+        raise ValueError("window_shape should be length 2")
+    rng = make_np_rng(rng, _default_seed, which_method=["randint"])
+
+    topo = batch.transpose([axes.index(a) for a in _canonical_axes])
+    if pad > 0:
+        topo = numpy.pad(topo, ((0, 0), (pad, pad), (pad, pad), (0, 0)),
+                         mode='constant')
+    num_examples, rows, cols, _ = topo.shape
+    window_r, window_c = window_shape
+    if window_r > rows or window_c > cols:
+        raise ValueError("window_shape (%d, %d) greater than image shape "
+                         "(%d, %d)" % (window_r, window_c, rows, cols))
+
+    row_offsets = rng.randint(0, rows - window_r + 1, size=num_examples)
+    col_offsets = rng.randint(0, cols - window_c + 1, size=num_examples)
+    row_idx = row_offsets[:, None] + numpy.arange(window_r)
+    col_idx = col_offsets[:, None] + numpy.arange(window_c)
+    if flip:
+        flipped = rng.randint(0, 2, size=num_examples).astype(bool)
+        col_idx[flipped] = col_idx[flipped, ::-1]
+
+    windows = topo[numpy.arange(num_examples)[:, None, None],
+                   row_idx[:, :, None],
+                   col_idx[:, None, :]]
+    return windows.transpose([_canonical_axes.index(a) for a in axes])
+
+
+class RandomWindowAndFlip(object):
+    """
+    A minibatch augmentation that zero-pads, randomly windows and
+    randomly flips images. See `random_window_and_flip`.
+
+    Parameters
+    ----------
+    window_shape : tuple
+        A length-2 tuple of (window_rows, window_cols).
+    pad : int, optional
+        Amount of zero padding to add to each side of the images before
+        windowing. Default is 0.
+    flip : bool, optional
+        Reflect images on the horizontal axis with probability 0.5.
+        `True` by default.
+    """
+    def __init__(self, window_shape, pad=0, flip=True):
+        self.window_shape = tuple(window_shape)
+        assert isinstance(pad, py_integer_types), (
+            "The 'pad' parameter of RandomWindowAndFlip should be an int")
+        self.pad = pad
+        self.flip = flip
+
+    def get_output_shape(self, input_shape):
+        """
+        Returns the spatial shape of the augmented images.
+
+        Parameters
+        ----------
+        input_shape : tuple
+            The (rows, cols) shape of the images before augmentation.
+
+        Returns
+        -------
+        output_shape : tuple
+            The (rows, cols) shape of the images after augmentation.
+        """
+        return self.window_shape
+
+    def perform(self, batch, axes, rng):
+        """
+        Augments a batch of images.
+
+        Parameters
+        ----------
+        batch : numpy.ndarray
+            A 4-dimensional batch of images.
+        axes : tuple
+            The layout of `batch`, a permutation of ('b', 0, 1, 'c').
+        rng : numpy.random.RandomState
+            The random number generator to draw windows and flips from.
+
+        Returns
+        -------
+        augmented : numpy.ndarray
+            The augmented batch, with the same axes as `batch`.
+        """
+        return random_window_and_flip(batch, self.window_shape, axes=axes,
+                                      pad=self.pad, flip=self.flip, rng=rng)
+
+
+def _augment(augmentation, batch, axes, seed):
+    """
+    Applies `augmentation` to `batch` with a generator seeded by `seed`.
+
+    This is a module-level function so that it can be sent to worker
+    processes.
+    """
+    return augmentation.perform(batch, axes, numpy.random.RandomState(seed))
+
+
+class AugmentedDataset(Dataset):
+    """
+    A dataset that applies a random augmentation to the 'features'
+    source of every minibatch drawn from another dataset.
+
+    Parameters
+    ----------
+    raw : DenseDesignMatrix
+        Provides the raw images. It must have a `view_converter` with a
+        `topo_space`, like datasets built from a topological view.
+    augmentation : object
+        The augmentation to apply, e.g. a `RandomWindowAndFlip`. It must
+        provide `get_output_shape(input_shape)` and
+        `perform(batch, axes, rng)`, and be picklable if `num_workers`
+        is positive.
+    rng : numpy.random.RandomState or seed, optional
+        Generator from which a seed is drawn for every minibatch.
+        Seeded deterministically by default.
+    num_workers : int, optional
+        If positive, minibatches are augmented in a pool of this many
+        worker processes, up to `num_workers` batches ahead of the
+        training loop. The augmented data does not depend on the number
+        of workers. Default is 0 (augment on the calling thread).
+    """
+    def __init__(self, raw, augmentation, rng=_default_seed, num_workers=0):
+        view_converter = getattr(raw, 'view_converter', None)
+        if getattr(view_converter, 'topo_space', None) is None:
+            raise ValueError("AugmentedDataset needs a raw dataset with a "
+                             "topological view, got %s" % str(raw))
+        self.raw = raw
+        self.augmentation = augmentation
+        self.rng = make_np_rng(rng, which_method=["randint"])
+        self.num_workers = num_workers
+        self._pool = None
+
+        raw_topo_space = view_converter.topo_space
+        self.raw_topo_space = raw_topo_space
+        self.topo_space = Conv2DSpace(
+            shape=augmentation.get_output_shape(raw_topo_space.shape),
+            num_channels=raw_topo_space.num_channels,
+            axes=raw_topo_space.axes,
+            dtype=raw_topo_space.dtype)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def _get_pool(self):
+        """
+        Returns the worker pool, creating it on first use.
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.num_workers)
+        return self._pool
+
+    def close(self):
+        """
+        Terminates the worker pool, if any. A new one is created if the
+        dataset is iterated over again.
+        """
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            self._pool = None
+            pool.terminate()
+            pool.join()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def get_data_specs(self):
+        """
+        Returns the data specs of the raw dataset, with the 'features'
+        source in the topological space of the augmented images.
+        """
+        space, source = self.raw.get_data_specs()
+        if not isinstance(space, CompositeSpace):
+            return (self.topo_space, source)
+        components = tuple(self.topo_space if src == 'features' else sp
+                           for sp, src in safe_zip(space.components, source))
+        return (CompositeSpace(components), source)
+
+    @wraps(Dataset.iterator)
+    def iterator(self, mode=None, batch_size=None, num_batches=None,
+                 rng=None, data_specs=None, return_tuple=False, prefetch=0,
+                 num_buffers=0):
+        if data_specs is None:
+            data_specs = self.get_data_specs()
+        assert is_flat_specs(data_specs)
+        space, source = data_specs
+        if not isinstance(source, tuple):
+            source = (source,)
+        if isinstance(space, CompositeSpace):
+            space = tuple(space.components)
+        else:
+            space = (space,)
+
+        # Ask self.raw for the full-size images, laid out with the axes
+        # of the requested space if it is topological.
+        raw_space = list(space)
+        for i, (sp, src) in enumerate(safe_zip(space, source)):
+            if src == 'features':
+                if isinstance(sp, Conv2DSpace):
+                    axes = sp.axes
+                else:
+                    axes = self.raw_topo_space.axes
+                raw_space[i] = Conv2DSpace(
+                    shape=self.raw_topo_space.shape,
+                    num_channels=self.raw_topo_space.num_channels,
+                    axes=axes,
+                    dtype=sp.dtype)
+        raw_data_specs = (CompositeSpace(raw_space), source)
+
+        # AugmentedIterator draws raw batches up to num_workers - 1
+        # batches ahead of the one it returns, so the raw ring needs that
+        # many more buffers for the returned batches to stay valid.
+        if num_buffers:
+            num_buffers += max(self.num_workers, 1) - 1
+
+        raw_iterator = self.raw.iterator(
+            mode=mode, batch_size=batch_size,
+            num_batches=num_batches, rng=rng,
+            data_specs=raw_data_specs, return_tuple=True,
+            prefetch=prefetch, num_buffers=num_buffers)
+
+        return AugmentedIterator(raw_iterator, self, space, source,
+                                 raw_space, return_tuple)
+
+    @wraps(Dataset.adjust_for_viewer)
+    def adjust_for_viewer(self, X):
+        return self.raw.adjust_for_viewer(X)
+
+    @wraps(Dataset.has_targets)
+    def has_targets(self):
+        return self.raw.has_targets()
+
+    @wraps(Dataset.get_num_examples)
+    def get_num_examples(self):
+        return self.raw.get_num_examples()
+
+
+class AugmentedIterator(object):
+    """
+    Iterator returned by `AugmentedDataset.iterator`.
+
+    A seed is drawn from the dataset's random number generator for every
+    minibatch, in order, on the calling thread, so the augmented data is
+    the same whether or not a worker pool is used.
+
+    Parameters
+    ----------
+    raw_iterator : iterator
+        Iterator over the raw dataset, returning tuples.
+    dataset : AugmentedDataset
+        The dataset being iterated over.
+    space : tuple
+        The requested space of each source.
+    source : tuple
+        The requested sources.
+    raw_space : tuple
+        The space in which each source is requested from `raw_iterator`.
+    return_tuple : bool
+        Whether to return a tuple even if there is only one source.
+    """
+    def __init__(self, raw_iterator, dataset, space, source, raw_space,
+                 return_tuple):
+        self.raw_iterator = raw_iterator
+        self.dataset = dataset
+        self.stochastic = raw_iterator.stochastic
+        self.uneven = raw_iterator.uneven
+        self._space = space
+        self._source = source
+        self._raw_space = raw_space
+        self._return_tuple = return_tuple
+        self._pending = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def _submit(self):
+        """
+        Draws the next raw batch and starts augmenting its features.
+
+        Returns
+        -------
+        pending : list
+            The raw batch, with the features replaced by an object
+            whose `get` method returns the augmented features.
+        """
+        raw_batch = list(self.raw_iterator.next())
+        dataset = self.dataset
+        for i, src in enumerate(self._source):
+            if src != 'features':
+                continue
+            seed = dataset.rng.randint(2 ** 30)
+            args = (dataset.augmentation, raw_batch[i],
+                    self._raw_space[i].axes, seed)
+            if dataset.num_workers > 0:
+                raw_batch[i] = dataset._get_pool().apply_async(_augment, args)
+            else:
+                raw_batch[i] = _Ready(_augment(*args))
+        return raw_batch
+
+    def next(self):
+        """
+        Retrieves the next augmented batch of examples.
+        """
+        num_ahead = max(self.dataset.num_workers, 1)
+        try:
+            while len(self._pending) < num_ahead:
+                self._pending.append(self._submit())
+        except StopIteration:
+            if not self._pending:
+                raise
+        batch = self._pending.popleft()
+
+        rval = []
+        for data, sp, raw_sp, src in safe_zip(batch, self._space,
+                                              self._raw_space, self._source):
+            if src == 'features':
+                data = self._augmented_space(raw_sp).np_format_as(data.get(),
+                                                                  sp)
+            rval.append(data)
+
+        if not self._return_tuple and len(rval) == 1:
+            return rval[0]
+        return tuple(rval)
+
+    def __next__(self):
+        return self.next()
+
+    def _augmented_space(self, raw_space):
+        """
+        Returns the space of the augmented version of a batch in
+        `raw_space`.
+        """
+        return Conv2DSpace(
+            shape=self.dataset.augmentation.get_output_shape(raw_space.shape),
+            num_channels=raw_space.num_channels,
+            axes=raw_space.axes,
+            dtype=raw_space.dtype)
+
+    @property
+    def num_examples(self):
+        """
+        The total number of examples over which the iterator operates.
+        """
+        return self.raw_iterator.num_examples
+
+    @property
+    def batch_size(self):
+        """
+        The (maximum) number of examples in each batch.
+        """
+        return self.raw_iterator.batch_size
+
+    @property
+    def num_batches(self):
+        """
+        The total number of batches that the iterator will ever return.
+        """
+        return self.raw_iterator.num_batches
+
+
+class _Ready(object):
+    """
+    Holds an already computed value behind the `get` interface of
+    `multiprocessing.pool.AsyncResult`.
+    """
+    def __init__(self, value):
+        self._value = value
+
+    def get(self):
+        """
+        Returns the held value.
+        """
+        return self._value
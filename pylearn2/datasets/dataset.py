@@ -19,7 +19,8 @@ class Dataset(object):
         return self.iterator()
 
     def iterator(self, mode=None, batch_size=None, num_batches=None,
-                 rng=None, data_specs=None, return_tuple=False):
+                 rng=None, data_specs=None, return_tuple=False, prefetch=0,
+                 num_buffers=0):
         """
         Return an iterator for this dataset with the specified
         behaviour. Unspecified values are filled-in by the default.
@@ -77,6 +78,18 @@ class Dataset(object):
             at each iteration. If False, it will return the minibatch
             itself. This flag has no effect if data_specs is composite.
             Default: False.
+        prefetch : int, optional
+            If positive, the iterator retrieves up to `prefetch` upcoming
+            batches on background threads while the current one is being
+            used. Batch order and random number generator state are the
+            same as without prefetching. Only supported by datasets that
+            return a `FiniteDatasetIterator`. Default: 0.
+        num_buffers : int, optional
+            If positive, batches are written into a ring of `num_buffers`
+            reused arrays per source instead of newly allocated ones, so
+            each returned batch is overwritten `num_buffers` batches later.
+            Must be larger than `prefetch`. Only supported by datasets
+            that return a `FiniteDatasetIterator`. Default: 0.
 
         Returns
         -------
@@ -267,7 +267,7 @@ class DenseDesignMatrix(Dataset):
     @functools.wraps(Dataset.iterator)
     def iterator(self, mode=None, batch_size=None, num_batches=None,
                  rng=None, data_specs=None,
-                 return_tuple=False):
+                 return_tuple=False, prefetch=0, num_buffers=0):
 
         [mode, batch_size, num_batches, rng, data_specs] = self._init_iterator(
             mode, batch_size, num_batches, rng, data_specs)
@@ -301,7 +301,9 @@ class DenseDesignMatrix(Dataset):
                                           rng),
                                      data_specs=data_specs,
                                      return_tuple=return_tuple,
-                                     convert=convert)
+                                     convert=convert,
+                                     prefetch=prefetch,
+                                     num_buffers=num_buffers)
 
     def get_data(self):
         """
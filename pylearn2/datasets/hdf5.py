@@ -17,12 +17,14 @@ except ImportError:
     tables = None
 import warnings
 from os.path import isfile
+import numpy as np
 from pylearn2.compat import OrderedDict
 from pylearn2.datasets import cache
 from pylearn2.datasets.dataset import Dataset
 from pylearn2.datasets.hdf5_deprecated import HDF5DatasetDeprecated
 from pylearn2.utils import safe_zip, wraps, py_integer_types
-from pylearn2.utils.iteration import FiniteDatasetIterator
+from pylearn2.utils.iteration import (FiniteDatasetIterator,
+                                      BlockShuffledSequentialSubsetIterator)
 from pylearn2.utils.exc import reraise_as
 from pylearn2.space import Space, CompositeSpace
 from theano.compat.six import string_types
@@ -86,9 +88,9 @@ class HDF5Dataset(Dataset):
             return HDF5DatasetDeprecated(filename, X, topo_view, y, load_all,
                                          cache_size, **kwargs)
         else:
-            return super(HDF5Dataset, cls).__new__(
-                cls, filename, sources, spaces, aliases, load_all, cache_size,
-                use_h5py, **kwargs)
+            # object.__new__ takes no extra arguments; they are consumed
+            # by __init__.
+            return super(HDF5Dataset, cls).__new__(cls)
 
     def __init__(self, filename, sources, spaces, aliases=None, load_all=False,
                  cache_size=None, use_h5py='auto', **kwargs):
@@ -186,8 +188,9 @@ class HDF5Dataset(Dataset):
                     data[s, a] = self._fhandler[s][:]
                 else:
                     data[s, a] = self._fhandler[s]
-                    # hdf5 handle has no ndim
-                    data[s].ndim = len(data[s].shape)
+                    # older hdf5 handles have no ndim
+                    if not hasattr(data[s], 'ndim'):
+                        data[s].ndim = len(data[s].shape)
         else:
             for s, a in safe_zip(sources, aliases):
                 if load_all:
@@ -198,10 +201,15 @@ class HDF5Dataset(Dataset):
 
     @wraps(Dataset.iterator, assigned=(), updated=(), append=True)
     def iterator(self, mode=None, data_specs=None, batch_size=None,
-                 num_batches=None, rng=None, return_tuple=False, **kwargs):
+                 num_batches=None, rng=None, return_tuple=False, prefetch=0,
+                 num_buffers=0, **kwargs):
         """
         if data_specs is set to None, the aliases (or sources) and spaces
         provided when the dataset object has been created will be used.
+
+        With the 'block_shuffled_sequential' mode, the blocks are aligned
+        with the HDF5 chunks of the data, unless `block_size` is given
+        as a keyword argument.
         """
         if data_specs is None:
             data_specs = (self._get_sources, self._get_spaces)
@@ -210,14 +218,46 @@ class HDF5Dataset(Dataset):
             mode, batch_size, num_batches, rng, data_specs)
         convert = None
 
+        mode_kwargs = {}
+        # Look through the wrapper of as_even, e.g. for the
+        # 'even_block_shuffled_sequential' mode
+        base_mode = getattr(mode, '_base_iterator_cls', None) or mode
+        if (isinstance(base_mode, type) and
+                issubclass(base_mode, BlockShuffledSequentialSubsetIterator)):
+            block_size = kwargs.get('block_size')
+            if block_size is None:
+                block_size = self._get_chunk_rows()
+                if block_size is not None and batch_size is not None:
+                    # Make blocks hold a whole number of batches
+                    block_size = max(block_size // batch_size, 1) * batch_size
+            mode_kwargs['block_size'] = block_size
+
         return FiniteDatasetIterator(self,
                                      mode(self.get_num_examples(),
                                           batch_size,
                                           num_batches,
-                                          rng),
+                                          rng,
+                                          **mode_kwargs),
                                      data_specs=data_specs,
                                      return_tuple=return_tuple,
-                                     convert=convert)
+                                     convert=convert,
+                                     prefetch=prefetch,
+                                     num_buffers=num_buffers)
+
+    def _get_chunk_rows(self):
+        """
+        Returns the largest number of examples in an HDF5 chunk of any
+        source, or None if no source is chunked on disk.
+        """
+        rows = None
+        for data in self.data.values():
+            # h5py exposes `chunks`, pytables `chunkshape`
+            chunks = getattr(data, 'chunks', None)
+            if chunks is None:
+                chunks = getattr(data, 'chunkshape', None)
+            if chunks:
+                rows = max(rows, chunks[0]) if rows else chunks[0]
+        return rows
 
     def _get_sources(self):
         """
@@ -293,11 +333,14 @@ class HDF5Dataset(Dataset):
             'sources should be an instance of tuple and not empty')
         assert all([isinstance(el, string_types) for el in sources]), (
             'sources elements should be strings')
-        assert isinstance(indexes, (tuple, list, slice, py_integer_types)), (
-            'indexes should be either an int, a slice or a tuple/list of ints')
-        if isinstance(indexes, (tuple, list)):
-            assert len(indexes) > 0 and all([isinstance(i, py_integer_types)
-                                            for i in indexes]), (
+        assert isinstance(indexes, (tuple, list, np.ndarray, slice,
+                                    py_integer_types)), (
+            'indexes should be either an int, a slice or a tuple/list/array '
+            'of ints')
+        if isinstance(indexes, (tuple, list, np.ndarray)):
+            indexes = np.asarray(indexes)
+            assert (indexes.ndim == 1 and len(indexes) > 0 and
+                    indexes.dtype.kind in 'iu'), (
                 'indexes elements should be ints')
 
         rval = []
@@ -309,16 +352,10 @@ class HDF5Dataset(Dataset):
                     'The requested source %s is not part of the dataset' %
                     sources[s], *e.args))
             if (isinstance(indexes, (slice, py_integer_types)) or
-                    len(indexes) == 1):
+                    isinstance(sdata, np.ndarray)):
                 rval.append(sdata[indexes])
             else:
-                warnings.warn('Accessing non sequential elements of an '
-                              'HDF5 file will be at best VERY slow. Avoid '
-                              'using iteration schemes that access '
-                              'random/shuffled data with hdf5 datasets!!')
-                val = []
-                [val.append(sdata[idx]) for idx in indexes]
-                rval.append(val)
+                rval.append(_read_coalesced(sdata, indexes))
         return tuple(rval)
 
     @wraps(Dataset.get_num_examples, assigned=(), updated=())
@@ -347,6 +384,41 @@ class HDF5Dataset(Dataset):
         return data.shape[0]
 
 
+def _read_coalesced(sdata, indexes):
+    """
+    Reads the examples at `indexes` from an on-disk array.
+
+    The indexes are sorted and merged into runs of consecutive
+    examples, and each run is read with a single slice into one
+    preallocated array, so the number of disk accesses is the number of
+    runs rather than the number of examples.
+
+    Parameters
+    ----------
+    sdata : h5py or pytables array
+        The on-disk data, with examples along the first axis.
+    indexes : numpy.ndarray
+        A vector of example indexes, in any order, possibly repeated.
+
+    Returns
+    -------
+    rval : numpy.ndarray
+        The requested examples, in the order given by `indexes`.
+    """
+    unique, inverse = np.unique(indexes, return_inverse=True)
+    rval = np.empty((len(unique),) + tuple(sdata.shape[1:]),
+                    dtype=sdata.dtype)
+    breaks = np.flatnonzero(np.diff(unique) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(unique)]))
+    for start, stop in safe_zip(starts, stops):
+        rval[start:stop] = sdata[unique[start]:unique[stop - 1] + 1]
+    if len(unique) == len(indexes) and np.all(np.diff(indexes) > 0):
+        # indexes were already sorted, no reordering is needed
+        return rval
+    return rval[inverse]
+
+
 class alias_dict(OrderedDict):
     """
     A class that behaves like a dictionary, but let you associates a key and
@@ -13,15 +13,17 @@ __email__ = "pylearn-dev@googlegroups"
 
 
 import copy
+import ctypes
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import time
 import warnings
 import os
 import numpy
 from theano.compat.six.moves import xrange
-import scipy
 try:
-    from scipy import linalg
+    from scipy import linalg, ndimage, signal
 except ImportError:
     warnings.warn("Could not import scipy.linalg")
 import theano
@@ -44,6 +46,269 @@ log = logging.getLogger(__name__)
 convert_axes = Conv2DSpace.convert_numpy
 
 
+def _check_chunk_size(chunk_size):
+    """
+    Checks that `chunk_size` is a positive integer and returns it as an
+    int.
+    """
+    if chunk_size is None or int(chunk_size) != chunk_size or chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer, got %s"
+                         % str(chunk_size))
+    return int(chunk_size)
+
+
+def transform_in_chunks(dataset, fn, chunk_size, memmap_path=None):
+    """
+    Replaces the design matrix of `dataset` by `fn` applied to blocks of
+    at most `chunk_size` consecutive rows, so that only one block of the
+    input and of the output has to be held in memory at a time.
+
+    The transformed blocks are written back into the design matrix
+    itself when they have the same number of columns and a dtype that
+    can be safely stored in it (which covers writable memmaps and
+    PyTables arrays). Otherwise a new design matrix is allocated, as a
+    `.npy` memmap at `memmap_path` if it is given, and handed to
+    `dataset.set_design_matrix`.
+
+    Parameters
+    ----------
+    dataset : DenseDesignMatrix
+        The dataset whose design matrix is transformed.
+    fn : callable
+        Maps a block of rows of the design matrix to a block of rows of
+        the new design matrix.
+    chunk_size : int
+        Maximum number of rows to transform at once.
+    memmap_path : str, optional
+        Where to store the new design matrix if it can't be written in
+        place. If None, it is kept in memory.
+    """
+    chunk_size = _check_chunk_size(chunk_size)
+    X = dataset.get_design_matrix()
+    num_examples = X.shape[0]
+    out = None
+    for start in xrange(0, num_examples, chunk_size):
+        stop = min(start + chunk_size, num_examples)
+        log.debug("transforming rows %d to %d" % (start, stop))
+        new = fn(X[start:stop])
+        if out is None:
+            flags = getattr(X, 'flags', None)
+            writeable = flags is None or flags.writeable
+            if (writeable and new.shape[1:] == X.shape[1:] and
+                    numpy.can_cast(new.dtype, X.dtype, 'same_kind')):
+                out = X
+            elif memmap_path is not None:
+                out = numpy.lib.format.open_memmap(
+                    memmap_path, mode='w+', dtype=new.dtype,
+                    shape=(num_examples,) + new.shape[1:])
+            else:
+                out = numpy.empty((num_examples,) + new.shape[1:],
+                                  dtype=new.dtype)
+        out[start:stop] = new
+    if out is not None and out is not X:
+        if hasattr(out, 'flush'):
+            out.flush()
+        dataset.set_design_matrix(out)
+
+
+# Maximum number of random patches gathered at once by ExtractPatches
+_GATHER_CHUNK_SIZE = 10000
+
+# Smallest kernel for which LeCunLCN smooths with FFTs by default
+_LCN_FFT_KERNEL_SIZE = 63
+
+
+def _on_gpu():
+    """
+    Returns True if Theano computes on a GPU, in which case the
+    preprocessors that have a Theano implementation use it.
+    """
+    device = theano.config.device
+    return device.startswith('gpu') or device.startswith('cuda')
+
+
+def _fork_context():
+    """
+    Returns a multiprocessing context that forks, so that the workers
+    inherit the arrays of the parent without pickling them.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def _run_in_processes(fn, num_items, num_workers):
+    """
+    Calls `fn(start, stop)` on consecutive ranges covering
+    `xrange(num_items)`, each in its own forked process if `num_workers`
+    is larger than 1. `fn` must write its results to shared memory or
+    to a memmap.
+
+    Parameters
+    ----------
+    fn : callable
+        Processes the items from `start` to `stop`.
+    num_items : int
+        Number of items to process.
+    num_workers : int
+        Number of processes to split the items across.
+    """
+    if num_workers > 1 and not hasattr(os, 'fork'):
+        warnings.warn("Can't fork on this platform, running in a single "
+                      "process")
+        num_workers = 1
+    if num_workers <= 1 or num_items <= 1:
+        fn(0, num_items)
+        return
+    ctx = _fork_context()
+    bounds = numpy.linspace(0, num_items, num_workers + 1).astype('int64')
+    workers = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if start < stop:
+            worker = ctx.Process(target=fn, args=(int(start), int(stop)))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+    failed = 0
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            failed += 1
+    if failed:
+        raise RuntimeError("%d of %d worker processes failed"
+                           % (failed, len(workers)))
+
+
+def _allocate_topo(shape, dtype, memmap_path=None, shared=False):
+    """
+    Allocates a topological view of shape `shape`, with the channels
+    last, whose memory is laid out with the channels first. This is the
+    layout of the design matrix of a `DenseDesignMatrix`, so that
+    `set_topological_view` doesn't copy it.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the topological view, with the channels last.
+    dtype : str
+        Dtype of the elements.
+    memmap_path : str, optional
+        If given, the memory is a `.npy` memmap at this path.
+    shared : bool, optional
+        If True, the memory is shared with the processes forked later.
+    """
+    storage_shape = (shape[0], shape[-1]) + tuple(shape[1:-1])
+    if memmap_path is not None:
+        storage = numpy.lib.format.open_memmap(memmap_path, mode='w+',
+                                               dtype=dtype,
+                                               shape=storage_shape)
+    elif shared:
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(storage_shape))
+        buf = _fork_context().RawArray('b', max(1, size * dtype.itemsize))
+        storage = numpy.frombuffer(buf, dtype=dtype,
+                                   count=size).reshape(storage_shape)
+    else:
+        storage = numpy.empty(storage_shape, dtype=dtype)
+    ndim = len(shape)
+    return storage.transpose((0,) + tuple(xrange(2, ndim)) + (1,))
+
+
+def _is_shared(array):
+    """
+    Returns whether the memory of `array` is shared with forked
+    processes, i.e. whether it is a writable memmap or a `RawArray`.
+    """
+    base = array
+    while base is not None:
+        if isinstance(base, numpy.memmap) and base.mode != 'c':
+            return True
+        if isinstance(base, ctypes.Array):
+            return True
+        base = getattr(base, 'base', None)
+    return False
+
+
+def _output_buffer(out, shape, dtype, num_workers):
+    """
+    Returns the array that the workers of `_run_in_processes` should
+    fill. If `out` is None, it is allocated. If the workers would write
+    to a private copy of `out`, it is a shared buffer to copy to `out`
+    afterwards.
+
+    Parameters
+    ----------
+    out : ndarray or None
+        The array requested by the caller.
+    shape : tuple
+        The shape the output must have.
+    dtype : str
+        Dtype of the output, if it is allocated.
+    num_workers : int
+        Number of processes the output is filled by.
+    """
+    if out is None:
+        return _allocate_topo(shape, dtype, shared=num_workers > 1)
+    if out.shape != shape:
+        raise ValueError("out has shape %s, but the output has shape %s"
+                         % (out.shape, shape))
+    if num_workers > 1 and not _is_shared(out):
+        return _allocate_topo(shape, out.dtype, shared=True)
+    return out
+
+
+def _split_view(array, shape):
+    """
+    Returns a view of `array` with shape `shape`, obtained by splitting
+    some of its axes, raising an error rather than copying it.
+    """
+    view = array.view()
+    try:
+        view.shape = shape
+    except AttributeError:
+        raise ValueError("Can't view an array of shape %s and strides %s "
+                         "with shape %s without copying it"
+                         % (array.shape, array.strides, shape))
+    return view
+
+
+def _sliding_windows(X, window_shape, steps=None):
+    """
+    Returns a read-only strided view of all the windows of a topological
+    view, without copying it.
+
+    Parameters
+    ----------
+    X : ndarray
+        Topological view, with the examples first and the channels last.
+    window_shape : tuple
+        Shape of the windows along the topological dimensions.
+    steps : tuple, optional
+        Distance between consecutive windows along each topological
+        dimension (1 by default). A step of 0 only keeps the first window.
+
+    Returns
+    -------
+    windows : ndarray
+        View of shape `(examples,) + window counts + window_shape +
+        (channels,)`.
+    """
+    num_dims = len(window_shape)
+    if steps is None:
+        steps = (1,) * num_dims
+    counts = tuple(1 if step == 0 else
+                   (X.shape[i + 1] - window_shape[i]) // step + 1
+                   for i, step in enumerate(steps))
+    shape = (X.shape[0],) + counts + tuple(window_shape) + (X.shape[-1],)
+    strides = ((X.strides[0],) +
+               tuple(step * X.strides[i + 1] for i, step in enumerate(steps)) +
+               X.strides[1:])
+    windows = numpy.lib.stride_tricks.as_strided(X, shape=shape,
+                                                 strides=strides)
+    windows.flags.writeable = False
+    return windows
+
+
 class Preprocessor(object):
 
     """
@@ -113,6 +378,92 @@ class Preprocessor(object):
         raise NotImplementedError(str(type(self)) +
                                   " does not implement an apply method.")
 
+    # Whether this preprocessor implements the streaming protocol, i.e.
+    # `partial_fit`, `finish_fit` and `transform_chunk`.
+    supports_chunks = False
+
+    def partial_fit(self, X):
+        """
+        Updates the statistics this preprocessor is fit on with one chunk
+        of a design matrix.
+
+        Calling `partial_fit` on every chunk of a design matrix and then
+        `finish_fit` must fit the same parameters as
+        `apply(dataset, can_fit=True)` would on the whole matrix.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement partial_fit.")
+
+    def finish_fit(self):
+        """
+        Sets the parameters of this preprocessor from the statistics
+        accumulated by `partial_fit`, and clears them so that the next
+        call to `partial_fit` starts a new fit. Default implementation
+        is no-op.
+        """
+        pass
+
+    def transform_chunk(self, X):
+        """
+        Returns the preprocessed version of one chunk of a design matrix,
+        using the parameters that were fit previously.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement transform_chunk.")
+
+    def _should_fit(self, can_fit):
+        """
+        Returns True if `apply_in_chunks` must make a `partial_fit` pass
+        over the data before transforming it.
+
+        Parameters
+        ----------
+        can_fit : bool
+            The `can_fit` argument of `apply_in_chunks`.
+        """
+        return can_fit
+
+    def apply_in_chunks(self, dataset, chunk_size, can_fit=False,
+                        memmap_path=None):
+        """
+        Same as `apply`, but reads the design matrix of `dataset` in
+        chunks of at most `chunk_size` rows, so that the memory usage
+        is bounded even when the design matrix is too large to be loaded
+        at once (e.g. a `DenseDesignMatrixPyTables` or a memmap).
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to act on.
+        chunk_size : int
+            Maximum number of rows to read at once.
+        can_fit : bool
+            See `apply`.
+        memmap_path : str, optional
+            See `transform_in_chunks`.
+        """
+        if not self.supports_chunks:
+            raise NotImplementedError(str(type(self)) +
+                                      " can't be applied in chunks.")
+        chunk_size = _check_chunk_size(chunk_size)
+        if self._should_fit(can_fit):
+            X = dataset.get_design_matrix()
+            for start in xrange(0, X.shape[0], chunk_size):
+                self.partial_fit(X[start:start + chunk_size])
+            self.finish_fit()
+        transform_in_chunks(dataset, self.transform_chunk, chunk_size,
+                            memmap_path)
+
     def invert(self):
         """
         Do any necessary prep work to be able to support the "inverse" method
@@ -174,10 +525,25 @@ class Pipeline(Preprocessor):
     Parameters
     ----------
     items : WRITEME
+    chunk_size : int, optional
+        If specified, the items that support it are fit and applied
+        with `apply_in_chunks`, reading the design matrix in blocks of
+        at most `chunk_size` rows. The other items are applied normally.
+    memmap_dir : str, optional
+        Directory in which to store, as `.npy` memmaps, the design
+        matrices created by items that change the number of columns of
+        the data when they are applied in chunks. Only used if
+        `chunk_size` is specified.
     """
 
-    def __init__(self, items=None):
+    supports_chunks = True
+
+    def __init__(self, items=None, chunk_size=None, memmap_dir=None):
         self.items = items if items is not None else []
+        if chunk_size is not None:
+            chunk_size = _check_chunk_size(chunk_size)
+        self.chunk_size = chunk_size
+        self.memmap_dir = memmap_dir
 
     def apply(self, dataset, can_fit=False):
         """
@@ -185,9 +551,44 @@ class Pipeline(Preprocessor):
 
             WRITEME
         """
+        chunk_size = getattr(self, 'chunk_size', None)
+        if chunk_size is not None:
+            self.apply_in_chunks(dataset, chunk_size, can_fit)
+            return
         for item in self.items:
             item.apply(dataset, can_fit)
 
+    def apply_in_chunks(self, dataset, chunk_size, can_fit=False,
+                        memmap_path=None):
+        """
+        Applies the items one after the other, block by block. Items
+        that don't support chunks are applied normally.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to act on.
+        chunk_size : int
+            Maximum number of rows to read at once.
+        can_fit : bool
+            See `Preprocessor.apply`.
+        memmap_path : str, optional
+            Directory to use instead of `self.memmap_dir`.
+        """
+        memmap_dir = memmap_path if memmap_path is not None \
+            else getattr(self, 'memmap_dir', None)
+        for i, item in enumerate(self.items):
+            if not getattr(item, 'supports_chunks', False):
+                log.info("%s does not support chunks, applying it to the "
+                         "whole design matrix" % type(item).__name__)
+                item.apply(dataset, can_fit)
+                continue
+            item_path = None
+            if memmap_dir is not None:
+                item_path = os.path.join(memmap_dir, 'pipeline_item_%d.npy'
+                                         % i)
+            item.apply_in_chunks(dataset, chunk_size, can_fit, item_path)
+
 
 class ExtractGridPatches(Preprocessor):
 
@@ -196,23 +597,48 @@ class ExtractGridPatches(Preprocessor):
     regular grid from each image.  The order of the images is
     preserved.
 
+    The patches are copied from a strided view of all the grid positions,
+    one block of images at a time.
+
     Parameters
     ----------
     patch_shape : WRITEME
     patch_stride : WRITEME
+    memmap_path : str, optional
+        If given, the patches are written to a `.npy` memmap at this path
+        instead of being kept in memory.
+    num_workers : int, optional
+        Number of processes to split the images across.
     """
 
-    def __init__(self, patch_shape, patch_stride):
+    def __init__(self, patch_shape, patch_stride, memmap_path=None,
+                 num_workers=1):
         self.patch_shape = patch_shape
         self.patch_stride = patch_stride
+        self.memmap_path = memmap_path
+        self.num_workers = num_workers
 
-    def apply(self, dataset, can_fit=False):
+    def extract(self, X, out=None):
         """
-        .. todo::
+        Returns the patches of a topological view.
 
-            WRITEME
+        Parameters
+        ----------
+        X : ndarray
+            Topological view, with the examples first and the channels
+            last.
+        out : ndarray, optional
+            Where to write the patches, e.g. a preallocated array or a
+            memmap. By default a new array is allocated. If `num_workers`
+            is larger than 1 and `out` isn't shared memory, the workers
+            fill a shared buffer which is then copied to `out`.
+
+        Returns
+        -------
+        patches : ndarray
+            The patches, ordered by image then by position on the grid,
+            with the last topological dimension varying fastest.
         """
-        X = dataset.get_topological_view()
         num_topological_dimensions = len(X.shape) - 2
         if num_topological_dimensions != len(self.patch_shape):
             raise ValueError("ExtractGridPatches with "
@@ -220,63 +646,55 @@ class ExtractGridPatches(Preprocessor):
                              + " topological dimensions called on"
                              + " dataset with " +
                              str(num_topological_dimensions) + ".")
-        num_patches = X.shape[0]
-        max_strides = [X.shape[0] - 1]
         for i in xrange(num_topological_dimensions):
             patch_width = self.patch_shape[i]
             data_width = X.shape[i + 1]
-            last_valid_coord = data_width - patch_width
-            if last_valid_coord < 0:
+            if data_width < patch_width:
                 raise ValueError('On topological dimension ' + str(i) +
                                  ', the data has width ' + str(data_width) +
                                  ' but the requested patch width is ' +
                                  str(patch_width))
-            stride = self.patch_stride[i]
-            if stride == 0:
-                max_stride_this_axis = 0
-            else:
-                max_stride_this_axis = last_valid_coord / stride
-            num_strides_this_axis = max_stride_this_axis + 1
-            max_strides.append(max_stride_this_axis)
-            num_patches *= num_strides_this_axis
-        # batch size
-        output_shape = [num_patches]
-        # topological dimensions
-        for dim in self.patch_shape:
-            output_shape.append(dim)
-        # number of channels
-        output_shape.append(X.shape[-1])
-        output = numpy.zeros(output_shape, dtype=X.dtype)
-        channel_slice = slice(0, X.shape[-1])
-        coords = [0] * (num_topological_dimensions + 1)
-        keep_going = True
-        i = 0
-        while keep_going:
-            args = [coords[0]]
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j + 1] * self.patch_stride[j]
-                args.append(slice(coord, coord + self.patch_shape[j]))
-            args.append(channel_slice)
-            patch = X[args]
-            output[i, :] = patch
-            i += 1
-            # increment coordinates
-            j = 0
-            keep_going = False
-            while not keep_going:
-                if coords[-(j + 1)] < max_strides[-(j + 1)]:
-                    coords[-(j + 1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j + 1)] = 0
-                    if j == num_topological_dimensions:
-                        break
-                    j = j + 1
+
+        windows = _sliding_windows(X, self.patch_shape, self.patch_stride)
+        grid_shape = windows.shape[:num_topological_dimensions + 1]
+        output_shape = ((int(numpy.prod(grid_shape)),) +
+                        tuple(self.patch_shape) + (X.shape[-1],))
+        num_workers = getattr(self, 'num_workers', 1)
+        buf = _output_buffer(out, output_shape, X.dtype, num_workers)
+        grid = _split_view(buf, windows.shape)
+
+        def fill(start, stop):
+            grid[start:stop] = windows[start:stop]
+
+        _run_in_processes(fill, X.shape[0], num_workers)
+        if out is None:
+            out = buf
+        elif buf is not out:
+            out[...] = buf
+        return out
+
+    def apply(self, dataset, can_fit=False):
+        """
+        .. todo::
+
+            WRITEME
+        """
+        X = dataset.get_topological_view()
+        out = None
+        memmap_path = getattr(self, 'memmap_path', None)
+        if memmap_path is not None:
+            windows = _sliding_windows(X, self.patch_shape, self.patch_stride)
+            num_patches = int(numpy.prod(windows.shape[:len(X.shape) - 1]))
+            out = _allocate_topo((num_patches,) + tuple(self.patch_shape) +
+                                 (X.shape[-1],), X.dtype, memmap_path)
+        output = self.extract(X, out)
+        num_examples = X.shape[0]
         dataset.set_topological_view(output)
 
         # fix lables
         if dataset.y is not None:
-            dataset.y = numpy.repeat(dataset.y, num_patches / X.shape[0])
+            dataset.y = numpy.repeat(dataset.y,
+                                     output.shape[0] // num_examples, axis=0)
 
 
 class ReassembleGridPatches(Preprocessor):
@@ -290,20 +708,25 @@ class ReassembleGridPatches(Preprocessor):
     ----------
     orig_shape : WRITEME
     patch_shape : WRITEME
+    memmap_path : str, optional
+        If given, the examples are written to a `.npy` memmap at this path
+        instead of being kept in memory.
+    num_workers : int, optional
+        Number of processes to split the examples across.
     """
 
-    def __init__(self, orig_shape, patch_shape):
+    def __init__(self, orig_shape, patch_shape, memmap_path=None,
+                 num_workers=1):
         self.patch_shape = patch_shape
         self.orig_shape = orig_shape
+        self.memmap_path = memmap_path
+        self.num_workers = num_workers
 
-    def apply(self, dataset, can_fit=False):
+    def _check_shapes(self, patches):
         """
-        .. todo::
-
-            WRITEME
+        Returns the number of patches along each topological dimension
+        and the number of examples the patches assemble into.
         """
-        patches = dataset.get_topological_view()
-
         num_topological_dimensions = len(patches.shape) - 2
 
         if num_topological_dimensions != len(self.patch_shape):
@@ -313,72 +736,94 @@ class ReassembleGridPatches(Preprocessor):
                              " with " +
                              str(num_topological_dimensions) + ".")
         num_patches = patches.shape[0]
-        num_examples = num_patches
+        grid_shape = []
         for im_dim, patch_dim in zip(self.orig_shape, self.patch_shape):
             if im_dim % patch_dim != 0:
                 raise Exception('Trying to assemble patches of shape ' +
                                 str(self.patch_shape) + ' into images of ' +
                                 'shape ' + str(self.orig_shape))
-            patches_this_dim = im_dim / patch_dim
-            if num_examples % patches_this_dim != 0:
-                raise Exception('Trying to re-assemble ' + str(num_patches) +
-                                ' patches of shape ' + str(self.patch_shape) +
-                                ' into images of shape ' + str(self.orig_shape)
-                                )
-            num_examples /= patches_this_dim
-
-        # batch size
-        reassembled_shape = [num_examples]
-        # topological dimensions
-        for dim in self.orig_shape:
-            reassembled_shape.append(dim)
-        # number of channels
-        reassembled_shape.append(patches.shape[-1])
-        reassembled = numpy.zeros(reassembled_shape, dtype=patches.dtype)
-        channel_slice = slice(0, patches.shape[-1])
-        coords = [0] * (num_topological_dimensions + 1)
-        max_strides = [num_examples - 1]
-        for dim, pd in zip(self.orig_shape, self.patch_shape):
-            assert dim % pd == 0
-            max_strides.append(dim / pd - 1)
-        keep_going = True
-        i = 0
-        while keep_going:
-            args = [coords[0]]
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j + 1]
-                args.append(slice(coord * self.patch_shape[j],
-                                  (coord + 1) * self.patch_shape[j]))
-                next_shape_coord = reassembled.shape[j + 1]
-                assert (coord + 1) * self.patch_shape[j] <= next_shape_coord
-
-            args.append(channel_slice)
-
-            try:
-                patch = patches[i, :]
-            except IndexError:
-                reraise_as(IndexError('Gave index of ' + str(i) +
-                                      ', : into thing of shape ' +
-                                      str(patches.shape)))
-            reassembled[args] = patch
-            i += 1
-            j = 0
-            keep_going = False
-            while not keep_going:
-                if coords[-(j + 1)] < max_strides[-(j + 1)]:
-                    coords[-(j + 1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j + 1)] = 0
-                    if j == num_topological_dimensions:
-                        break
-                    j = j + 1
+            grid_shape.append(im_dim // patch_dim)
+        patches_per_example = int(numpy.prod(grid_shape))
+        if num_patches % patches_per_example != 0:
+            raise Exception('Trying to re-assemble ' + str(num_patches) +
+                            ' patches of shape ' + str(self.patch_shape) +
+                            ' into images of shape ' + str(self.orig_shape))
+        return tuple(grid_shape), num_patches // patches_per_example
+
+    def reassemble(self, patches, out=None):
+        """
+        Returns the examples assembled from their patches.
+
+        Parameters
+        ----------
+        patches : ndarray
+            Topological view of the patches, ordered as by
+            `ExtractGridPatches`.
+        out : ndarray, optional
+            Where to write the examples, e.g. a preallocated array or a
+            memmap. By default a new array is allocated. If `num_workers`
+            is larger than 1 and `out` isn't shared memory, the workers
+            fill a shared buffer which is then copied to `out`.
+
+        Returns
+        -------
+        examples : ndarray
+            Topological view of the examples.
+        """
+        grid_shape, num_examples = self._check_shapes(patches)
+        num_dims = len(grid_shape)
+        num_channels = patches.shape[-1]
+        reassembled_shape = ((num_examples,) + tuple(self.orig_shape) +
+                             (num_channels,))
+        num_workers = getattr(self, 'num_workers', 1)
+        buf = _output_buffer(out, reassembled_shape, patches.dtype,
+                             num_workers)
+
+        # Viewed with one axis per position on the grid and one per
+        # coordinate in the patch, the patches only need to be transposed
+        interleaved = (num_examples,)
+        for grid_dim, patch_dim in zip(grid_shape, self.patch_shape):
+            interleaved += (grid_dim, patch_dim)
+        dst = _split_view(buf, interleaved + (num_channels,))
+        src = patches.reshape((num_examples,) + grid_shape +
+                              tuple(self.patch_shape) + (num_channels,))
+        axes = [0]
+        for i in xrange(num_dims):
+            axes.extend([1 + i, 1 + num_dims + i])
+        axes.append(1 + 2 * num_dims)
+        src = src.transpose(axes)
+
+        def fill(start, stop):
+            dst[start:stop] = src[start:stop]
+
+        _run_in_processes(fill, num_examples, num_workers)
+        if out is None:
+            out = buf
+        elif buf is not out:
+            out[...] = buf
+        return out
+
+    def apply(self, dataset, can_fit=False):
+        """
+        .. todo::
 
+            WRITEME
+        """
+        patches = dataset.get_topological_view()
+        out = None
+        memmap_path = getattr(self, 'memmap_path', None)
+        if memmap_path is not None:
+            _, num_examples = self._check_shapes(patches)
+            out = _allocate_topo((num_examples,) + tuple(self.orig_shape) +
+                                 (patches.shape[-1],), patches.dtype,
+                                 memmap_path)
+        reassembled = self.reassemble(patches, out)
+        num_patches = patches.shape[0]
         dataset.set_topological_view(reassembled)
 
         # fix labels
         if dataset.y is not None:
-            dataset.y = dataset.y[::patches.shape[0] / reassembled_shape[0]]
+            dataset.y = dataset.y[::num_patches // reassembled.shape[0]]
 
 
 class ExtractPatches(Preprocessor):
@@ -387,29 +832,60 @@ class ExtractPatches(Preprocessor):
     Converts an image dataset into a dataset of patches
     extracted at random from the original dataset.
 
+    The positions of all the patches are drawn at once, in the same order
+    as drawing them one by one, and the patches are gathered from a
+    strided view of all the positions in blocks.
+
     Parameters
     ----------
     patch_shape : WRITEME
     num_patches : WRITEME
     rng : WRITEME
+    memmap_path : str, optional
+        If given, the patches are written to a `.npy` memmap at this path
+        instead of being kept in memory.
+    num_workers : int, optional
+        Number of processes to split the patches across.
     """
 
-    def __init__(self, patch_shape, num_patches, rng=None):
+    def __init__(self, patch_shape, num_patches, rng=None, memmap_path=None,
+                 num_workers=1):
         self.patch_shape = patch_shape
         self.num_patches = num_patches
         self.start_rng = make_np_rng(copy.copy(rng),
                                      [1, 2, 3],
                                      which_method="randint")
+        self.memmap_path = memmap_path
+        self.num_workers = num_workers
 
-    def apply(self, dataset, can_fit=False):
+    def _output_shape(self, X):
         """
-        .. todo::
+        Returns the shape of the topological view of the patches.
+        """
+        return ((self.num_patches,) + tuple(self.patch_shape) +
+                (X.shape[-1],))
 
-            WRITEME
+    def extract(self, X, out=None):
         """
-        rng = copy.copy(self.start_rng)
+        Returns patches drawn at random from a topological view.
 
-        X = dataset.get_topological_view()
+        Parameters
+        ----------
+        X : ndarray
+            Topological view, with the examples first and the channels
+            last.
+        out : ndarray, optional
+            Where to write the patches, e.g. a preallocated array or a
+            memmap. By default a new array is allocated. If `num_workers`
+            is larger than 1 and `out` isn't shared memory, the workers
+            fill a shared buffer which is then copied to `out`.
+
+        Returns
+        -------
+        patches : ndarray
+            The patches.
+        """
+        rng = copy.copy(self.start_rng)
 
         num_topological_dimensions = len(X.shape) - 2
 
@@ -420,26 +896,48 @@ class ExtractPatches(Preprocessor):
                              + "dataset with "
                              + str(num_topological_dimensions) + ".")
 
-        # batch size
-        output_shape = [self.num_patches]
-        # topological dimensions
-        for dim in self.patch_shape:
-            output_shape.append(dim)
-        # number of channels
-        output_shape.append(X.shape[-1])
-        output = numpy.zeros(output_shape, dtype=X.dtype)
-        channel_slice = slice(0, X.shape[-1])
-        for i in xrange(self.num_patches):
-            args = []
-            args.append(rng.randint(X.shape[0]))
-
-            for j in xrange(num_topological_dimensions):
-                max_coord = X.shape[j + 1] - self.patch_shape[j]
-                coord = rng.randint(max_coord + 1)
-                args.append(slice(coord, coord + self.patch_shape[j]))
-            args.append(channel_slice)
-            output[i, :] = X[args]
-        dataset.set_topological_view(output)
+        # Draw the example and the coordinates of each patch
+        num_positions = [X.shape[0]]
+        for j in xrange(num_topological_dimensions):
+            num_positions.append(X.shape[j + 1] - self.patch_shape[j] + 1)
+        if min(num_positions) < 1:
+            raise ValueError("Can't extract patches of shape %s from "
+                             "examples of shape %s"
+                             % (str(self.patch_shape), str(X.shape[1:-1])))
+        positions = rng.randint(0, numpy.tile(num_positions,
+                                              self.num_patches))
+        positions = positions.reshape((self.num_patches,
+                                       num_topological_dimensions + 1))
+
+        output_shape = self._output_shape(X)
+        num_workers = getattr(self, 'num_workers', 1)
+        buf = _output_buffer(out, output_shape, X.dtype, num_workers)
+        windows = _sliding_windows(X, self.patch_shape)
+
+        def fill(start, stop):
+            for i in xrange(start, stop, _GATHER_CHUNK_SIZE):
+                end = min(i + _GATHER_CHUNK_SIZE, stop)
+                buf[i:end] = windows[tuple(positions[i:end].T)]
+
+        _run_in_processes(fill, self.num_patches, num_workers)
+        if out is None:
+            out = buf
+        elif buf is not out:
+            out[...] = buf
+        return out
+
+    def apply(self, dataset, can_fit=False):
+        """
+        .. todo::
+
+            WRITEME
+        """
+        X = dataset.get_topological_view()
+        out = None
+        memmap_path = getattr(self, 'memmap_path', None)
+        if memmap_path is not None:
+            out = _allocate_topo(self._output_shape(X), X.dtype, memmap_path)
+        dataset.set_topological_view(self.extract(X, out))
         dataset.y = None
 
 
@@ -654,9 +1152,12 @@ class RemoveMean(ExamplewisePreprocessor):
         semantics as the `axis` parameter of `numpy.mean`.
     """
 
+    supports_chunks = True
+
     def __init__(self, axis=0):
         self._axis = axis
         self._mean = None
+        self._partial_stats = None
 
     def apply(self, dataset, can_fit=True):
         """
@@ -674,6 +1175,52 @@ class RemoveMean(ExamplewisePreprocessor):
         X -= self._mean
         dataset.set_design_matrix(X)
 
+    def partial_fit(self, X):
+        """
+        Adds the count and the sum of the elements of one chunk of a
+        design matrix, in float64, to the statistics of the mean.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        if self._axis not in (0, None):
+            raise ValueError("RemoveMean can only be fit in chunks with "
+                             "axis=0 or axis=None, not axis=%s"
+                             % str(self._axis))
+        if getattr(self, '_partial_stats', None) is None:
+            self._partial_stats = [0, 0., X.dtype]
+        stats = self._partial_stats
+        if self._axis is None:
+            stats[0] += X.size
+            stats[1] += X.sum(dtype='float64')
+        else:
+            stats[0] += X.shape[0]
+            stats[1] += X.sum(axis=0, dtype='float64')
+
+    def finish_fit(self):
+        """
+        Sets the mean from the sum and the count accumulated by
+        `partial_fit`, cast back to the dtype of the data.
+        """
+        count, total, dtype = self._partial_stats
+        self._partial_stats = None
+        self._mean = numpy.asarray(total / count).astype(dtype)
+
+    def transform_chunk(self, X):
+        """
+        Returns one chunk of a design matrix minus the stored mean.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        if self._mean is None:
+            raise ValueError("RemoveMean object has no stored mean")
+        return X - self._mean
+
     def as_block(self):
         """
         .. todo::
@@ -709,12 +1256,15 @@ class Standardize(ExamplewisePreprocessor):
         Default is `1e-4`.
     """
 
+    supports_chunks = True
+
     def __init__(self, global_mean=False, global_std=False, std_eps=1e-4):
         self._global_mean = global_mean
         self._global_std = global_std
         self._std_eps = std_eps
         self._mean = None
         self._std = None
+        self._partial_stats = None
 
     def apply(self, dataset, can_fit=False):
         """
@@ -733,6 +1283,67 @@ class Standardize(ExamplewisePreprocessor):
         new = (X - self._mean) / (self._std_eps + self._std)
         dataset.set_design_matrix(new)
 
+    def partial_fit(self, X):
+        """
+        Accumulates the per-column counts, means and sums of squared
+        deviations of `X` in float64, merging them with those of the
+        previous chunks with the pairwise update of Chan et al.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        count = X.shape[0]
+        mean = X.mean(axis=0, dtype='float64')
+        m2 = ((X - mean) ** 2).sum(axis=0)
+        if getattr(self, '_partial_stats', None) is None:
+            self._partial_stats = [count, mean, m2, X.dtype]
+            return
+        stats = self._partial_stats
+        total = stats[0] + count
+        delta = mean - stats[1]
+        stats[1] = stats[1] + delta * (count / float(total))
+        stats[2] = (stats[2] + m2 +
+                    delta ** 2 * (stats[0] * count / float(total)))
+        stats[0] = total
+
+    def finish_fit(self):
+        """
+        Sets the mean and the standard deviation, per column or global
+        depending on `global_mean` and `global_std`, from the statistics
+        accumulated by `partial_fit`. The global standard deviation adds
+        the spread of the column means to the per-column deviations.
+        """
+        count, mean, m2, dtype = self._partial_stats
+        self._partial_stats = None
+        global_mean = mean.mean()
+        if self._global_mean:
+            self._mean = numpy.asarray(global_mean, dtype=dtype)
+        else:
+            self._mean = mean.astype(dtype)
+        if self._global_std:
+            global_m2 = m2.sum() + count * ((mean - global_mean) ** 2).sum()
+            std = numpy.sqrt(global_m2 / (count * mean.shape[0]))
+        else:
+            std = numpy.sqrt(m2 / count)
+        self._std = numpy.asarray(std, dtype=dtype)
+
+    def transform_chunk(self, X):
+        """
+        Returns one chunk of a design matrix centered and divided by the
+        stored standard deviation plus `std_eps`.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        if self._mean is None or self._std is None:
+            raise ValueError("Standardize object has no stored mean or "
+                             "standard deviation")
+        return (X - self._mean) / (self._std_eps + self._std)
+
     def as_block(self):
         """
         .. todo::
@@ -979,7 +1590,7 @@ class PCA_ViewConverter(object):
                                                                 dspace)
 
 
-class PCA(object):
+class PCA(Preprocessor):
 
     """
     .. todo::
@@ -994,10 +1605,13 @@ class PCA(object):
         If True, the preprocessed data will have zero mean and unit covariance.
     """
 
+    supports_chunks = True
+
     def __init__(self, num_components, whiten=False):
         self._num_components = num_components
         self._whiten = whiten
         self._pca = None
+        self._partial_stats = None
         # TODO: Is storing these really necessary? This computation
         # can't really be merged since we're basically creating the
         # functions in apply(); I see no reason to keep these around.
@@ -1014,18 +1628,9 @@ class PCA(object):
             if not can_fit:
                 raise ValueError("can_fit is False, but PCA preprocessor "
                                  "object has no fitted model stored")
-            from pylearn2.models import pca
-            self._pca = pca.CovEigPCA(num_components=self._num_components,
-                                      whiten=self._whiten)
+            self._pca = self._make_pca()
             self._pca.train(dataset.get_design_matrix())
-            self._transform_func = function([self._input],
-                                            self._pca(self._input))
-            self._invert_func = function([self._output],
-                                         self._pca.reconstruct(self._output))
-            self._convert_weights_func = function(
-                [self._output],
-                self._pca.reconstruct(self._output, add_mean=False)
-            )
+            self._compile_functions()
 
         orig_data = dataset.get_design_matrix()
         dataset.set_design_matrix(
@@ -1041,6 +1646,125 @@ class PCA(object):
 
         log.info('original variance: {0}'.format(orig_var.sum()))
         log.info('processed variance: {0}'.format(proc_var.sum()))
+        self._convert_view_converter(dataset)
+
+    def _make_pca(self):
+        """
+        Returns the (untrained) PCA model used by this preprocessor.
+        """
+        from pylearn2.models import pca
+        return pca.CovEigPCA(num_components=self._num_components,
+                             whiten=self._whiten)
+
+    def _compile_functions(self):
+        """
+        Compiles the functions projecting to and from the trained PCA
+        model.
+        """
+        self._transform_func = function([self._input],
+                                        self._pca(self._input))
+        self._invert_func = function([self._output],
+                                     self._pca.reconstruct(self._output))
+        self._convert_weights_func = function(
+            [self._output],
+            self._pca.reconstruct(self._output, add_mean=False)
+        )
+
+    def _should_fit(self, can_fit):
+        """
+        Like `apply`, only fits if there is no fitted model yet.
+        """
+        if self._pca is None:
+            if not can_fit:
+                raise ValueError("can_fit is False, but PCA preprocessor "
+                                 "object has no fitted model stored")
+            return True
+        return False
+
+    def partial_fit(self, X):
+        """
+        Accumulates the sum and the scatter matrix `X.T X` of one chunk of
+        a design matrix, in float64.
+
+        The rows are shifted by the mean of the first chunk before being
+        accumulated, so that the covariance doesn't lose precision when
+        the mean is large compared to the spread of the data.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        if getattr(self, '_partial_stats', None) is None:
+            n = X.shape[1]
+            shift = numpy.asarray(X, dtype='float64').mean(axis=0)
+            self._partial_stats = [0, numpy.zeros(n), numpy.zeros((n, n)),
+                                   shift]
+        stats = self._partial_stats
+        if X.shape[0] == 0:
+            return
+        X64 = numpy.array(X, dtype='float64')
+        X64 -= stats[3]
+        stats[0] += X.shape[0]
+        stats[1] += X64.sum(axis=0)
+        stats[2] += numpy.dot(X64.T, X64)
+
+    def finish_fit(self):
+        """
+        Trains the PCA model on the covariance matrix accumulated by
+        `partial_fit`.
+        """
+        count, total, scatter, shift = self._partial_stats
+        self._partial_stats = None
+        shifted_mean = total / count
+        # Same normalization as numpy.cov
+        covariance = ((scatter - count * numpy.outer(shifted_mean,
+                                                     shifted_mean)) /
+                      (count - 1))
+        self._pca = self._make_pca()
+        self._pca.train_from_covariance(covariance, shift + shifted_mean)
+        self._compile_functions()
+
+    def transform_chunk(self, X):
+        """
+        Returns the projection of one chunk of a design matrix on the
+        principal components of the fitted model.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        return self._transform_func(X)
+
+    def apply_in_chunks(self, dataset, chunk_size, can_fit=False,
+                        memmap_path=None):
+        """
+        Projects the design matrix of `dataset` chunk by chunk, fitting
+        the model first if needed, then makes the view converter of
+        `dataset` map the components back to the original space.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to act on.
+        chunk_size : int
+            Maximum number of rows to read at once.
+        can_fit : bool
+            See `apply`.
+        memmap_path : str, optional
+            Path of a `.npy` memmap in which to store the projected
+            design matrix, which has fewer columns than the original one.
+        """
+        super(PCA, self).apply_in_chunks(dataset, chunk_size, can_fit,
+                                         memmap_path)
+        self._convert_view_converter(dataset)
+
+    def _convert_view_converter(self, dataset):
+        """
+        Makes the view converter of `dataset` map the PCA features back
+        to the original space.
+        """
         if hasattr(dataset, 'view_converter'):
             if dataset.view_converter is not None:
                 new_converter = PCA_ViewConverter(self._transform_func,
@@ -1122,6 +1846,8 @@ class GlobalContrastNormalization(Preprocessor):
         Defaults to False if nothing is specified
     """
 
+    supports_chunks = True
+
     def __init__(self, subtract_mean=True,
                  scale=1., sqrt_bias=0., use_std=False, min_divisor=1e-8,
                  batch_size=None):
@@ -1150,22 +1876,31 @@ class GlobalContrastNormalization(Preprocessor):
                                           min_divisor=self._min_divisor)
             dataset.set_design_matrix(X)
         else:
-            data = dataset.get_design_matrix()
-            data_size = data.shape[0]
-            last = (numpy.floor(data_size / float(self._batch_size)) *
-                    self._batch_size)
-            for i in xrange(0, data_size, self._batch_size):
-                stop = i + self._batch_size
-                log.info("GCN processing data from %d to %d" % (i, stop))
-                X = data[i:stop]
-                X = global_contrast_normalize(
-                    X,
-                    scale=self._scale,
-                    subtract_mean=self._subtract_mean,
-                    use_std=self._use_std,
-                    sqrt_bias=self._sqrt_bias,
-                    min_divisor=self._min_divisor)
-                dataset.set_design_matrix(X, start=i)
+            self.apply_in_chunks(dataset, self._batch_size)
+
+    def _should_fit(self, can_fit):
+        """
+        GCN has no parameters to fit.
+        """
+        return False
+
+    def transform_chunk(self, X):
+        """
+        Returns one chunk of a design matrix with each row normalized by
+        `global_contrast_normalize`. The rows are independent, so no
+        statistics need to be fit.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        return global_contrast_normalize(X,
+                                         scale=self._scale,
+                                         subtract_mean=self._subtract_mean,
+                                         use_std=self._use_std,
+                                         sqrt_bias=self._sqrt_bias,
+                                         min_divisor=self._min_divisor)
 
 
 class ZCA(Preprocessor):
@@ -1195,10 +1930,23 @@ class ZCA(Preprocessor):
         When self.apply(dataset, can_fit=True) store not just the
         preprocessing matrix, but its inverse. This is necessary when
         using this preprocessor to instantiate a ZCA_Dataset.
+    chunk_size : int, optional
+        If given, `fit` accumulates the covariance over chunks of at most
+        this many rows, and `apply` whitens the design matrix chunk by
+        chunk, in place when possible (see `apply_in_chunks`). Otherwise
+        the whole design matrix is processed at once.
+
+    Notes
+    -----
+    The covariance is always accumulated in float64, and the whitening
+    matrices are stored with the dtype of the data they were fit on, so
+    that float32 data is whitened in float32.
     """
 
+    supports_chunks = True
+
     def __init__(self, n_components=None, n_drop_components=None,
-                 filter_bias=0.1, store_inverse=True):
+                 filter_bias=0.1, store_inverse=True, chunk_size=None):
         warnings.warn("This ZCA preprocessor class is known to yield very "
                       "different results on different platforms. If you plan "
                       "to conduct experiments with this preprocessing on "
@@ -1220,10 +1968,14 @@ class ZCA(Preprocessor):
         self.store_inverse = store_inverse
         self.P_ = None  # set by fit()
         self.inv_P_ = None  # set by fit(), if self.store_inverse is True
+        self._partial_stats = None  # accumulated by partial_fit()
+        if chunk_size is not None:
+            chunk_size = _check_chunk_size(chunk_size)
+        self.chunk_size = chunk_size
 
         # Analogous to DenseDesignMatrix.design_loc. If not None, the
-        # matrices P_ and inv_P_ will be saved together in <save_path>
-        # (or <save_path>.npz, if the suffix is omitted).
+        # matrices P_ and inv_P_ will be stored as .npy files next to
+        # <save_path> and memory-mapped (see _matrix_path).
         self.matrices_save_path = None
 
     @staticmethod
@@ -1241,6 +1993,9 @@ class ZCA(Preprocessor):
         matrix_b : WRITEME
         matrix_c : WRITEME
         """
+        if not _on_gpu():
+            return numpy.dot(matrix_a, matrix_b, matrix_c)
+
         if not hasattr(ZCA._gpu_matrix_dot, 'theano_func'):
             ma, mb = theano.tensor.matrices('A', 'B')
             mc = theano.tensor.dot(ma, mb)
@@ -1275,6 +2030,8 @@ class ZCA(Preprocessor):
         mat : WRITEME
         diags : WRITEME
         """
+        if not _on_gpu():
+            return numpy.dot(mat * diags, mat.T)
 
         floatX = theano.config.floatX
 
@@ -1311,14 +2068,17 @@ class ZCA(Preprocessor):
         """
         Analogous to DenseDesignMatrix.use_design_loc().
 
-        If a matrices_save_path is set, when this ZCA is pickled, the internal
-        parameter matrices will be saved separately to `matrices_save_path`, as
-        a numpy .npz archive. This uses half the memory that a normal pickling
-        does.
+        If a matrices_save_path is set, the internal parameter matrices are
+        saved separately as `.npy` files next to `matrices_save_path` (see
+        `_matrix_path`) as soon as they are fit, and memory-mapped from
+        there. Pickling this ZCA then only writes the matrices if they
+        changed, and unpickling it maps them rather than loading them, so
+        large whitening matrices are never held in memory twice.
 
         Parameters
         ----------
-        matrices_save_path : WRITEME
+        matrices_save_path : str
+            Base path of the matrices. A `.npz` suffix is ignored.
         """
         if matrices_save_path is not None:
             assert isinstance(matrices_save_path, str)
@@ -1336,27 +2096,60 @@ class ZCA(Preprocessor):
                               '\t"%s"')
 
         self.matrices_save_path = matrices_save_path
+        if matrices_save_path is not None and self.P_ is not None:
+            self._save_matrices()
+
+    def _matrix_path(self, name):
+        """
+        Returns the path of the `.npy` file storing the matrix `name`
+        (`'P_'` or `'inv_P_'`).
+        """
+        base = self.matrices_save_path
+        if base.endswith('.npz'):
+            base = base[:-len('.npz')]
+        return '%s.%s.npy' % (base, name)
+
+    def _save_matrices(self):
+        """
+        Writes the matrices that aren't already mapped from their file in
+        `matrices_save_path`, and replaces them by read-only memmaps.
+        """
+        for name in ('P_', 'inv_P_'):
+            matrix = getattr(self, name)
+            if matrix is None:
+                continue
+            path = self._matrix_path(name)
+            if (isinstance(matrix, numpy.memmap) and
+                    os.path.abspath(matrix.filename) == path):
+                continue
+            if os.path.exists(path):
+                # The old file may still be mapped, by this ZCA or another
+                # one: don't write through its mapping
+                os.remove(path)
+            out = numpy.lib.format.open_memmap(path, mode='w+',
+                                               dtype=matrix.dtype,
+                                               shape=matrix.shape)
+            out[...] = matrix
+            out.flush()
+            del out
+            setattr(self, name, numpy.load(path, mmap_mode='r'))
 
     def __getstate__(self):
         """
         Used by pickle.  Returns a dictionary to pickle in place of
         self.__dict__.
 
-        If self.matrices_save_path is set, this saves the matrices P_ and
-        inv_P_ separately in matrices_save_path as a .npz archive, which uses
+        If self.matrices_save_path is set, the matrices P_ and inv_P_ are
+        saved separately as .npy files (if they aren't already), which uses
         much less space & memory than letting pickle handle them.
         """
         result = copy.copy(self.__dict__)  # shallow copy
         if self.matrices_save_path is not None:
-            matrices = {'P_': self.P_}
-            if self.inv_P_ is not None:
-                matrices['inv_P_'] = self.inv_P_
-
-            numpy.savez(self.matrices_save_path, **matrices)
+            self._save_matrices()
 
             # Removes the matrices from the dictionary to be pickled.
-            for key, matrix in matrices.items():
-                del result[key]
+            for key in ('P_', 'inv_P_'):
+                result.pop(key, None)
 
         return result
 
@@ -1375,18 +2168,25 @@ class ZCA(Preprocessor):
         if 'matrices_save_path' not in state:
             state['matrices_save_path'] = None
 
-        if state['matrices_save_path'] is not None:
-            matrices = numpy.load(state['matrices_save_path'])
-
-            # puts matrices' items into state, overriding any colliding keys in
-            # state.
-            state = dict(state.items() + matrices.items())
-            del matrices
-
         self.__dict__.update(state)
 
+        if self.matrices_save_path is not None:
+            if os.path.exists(self._matrix_path('P_')):
+                for name in ('P_', 'inv_P_'):
+                    path = self._matrix_path(name)
+                    if os.path.exists(path):
+                        setattr(self, name, numpy.load(path, mmap_mode='r'))
+            else:
+                # Old pickles saved the matrices in a .npz archive
+                matrices = numpy.load(self.matrices_save_path)
+                for name in matrices.files:
+                    setattr(self, name, matrices[name])
+                del matrices
+
         if not hasattr(self, "inv_P_"):
             self.inv_P_ = None
+        if not hasattr(self, "chunk_size"):
+            self.chunk_size = None
 
     def fit(self, X):
         """
@@ -1402,28 +2202,115 @@ class ZCA(Preprocessor):
         Implementation details:
         Stores result as `self.P_`.
         If self.store_inverse is true, this also computes `self.inv_P_`.
+        The covariance is accumulated with `partial_fit`, over chunks of
+        `self.chunk_size` rows if it is set, so `X` is never copied as a
+        whole.
         """
 
         assert X.dtype in ['float32', 'float64']
-        assert not contains_nan(X)
         assert len(X.shape) == 2
-        n_samples = X.shape[0]
-        if self.copy:
-            X = X.copy()
-        # Center data
-        self.mean_ = numpy.mean(X, axis=0)
-        X -= self.mean_
-
         log.info('computing zca of a {0} matrix'.format(X.shape))
         t1 = time.time()
 
-        bias = self.filter_bias * scipy.sparse.identity(X.shape[1],
-                                                        theano.config.floatX)
+        chunk_size = getattr(self, 'chunk_size', None) or max(X.shape[0], 1)
+        self._partial_stats = None
+        for start in xrange(0, X.shape[0], chunk_size):
+            self.partial_fit(X[start:start + chunk_size])
 
-        covariance = ZCA._gpu_matrix_dot(X.T, X) / X.shape[0] + bias
         t2 = time.time()
         log.info("cov estimate took {0} seconds".format(t2 - t1))
+        self.finish_fit()
 
+    def partial_fit(self, X):
+        """
+        Accumulates the sum and the scatter matrix `X.T X` of one chunk of
+        a design matrix, in float64.
+
+        The rows are shifted by the mean of the first chunk before being
+        accumulated, so that the covariance doesn't lose precision when
+        the mean is large compared to the spread of the data. Only the
+        upper triangle of the scatter matrix is accumulated, with a
+        symmetric rank-k update.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        assert X.dtype in ['float32', 'float64']
+        assert not contains_nan(X)
+        assert len(X.shape) == 2
+        if getattr(self, '_partial_stats', None) is None:
+            n = X.shape[1]
+            shift = numpy.asarray(X, dtype='float64').mean(axis=0)
+            self._partial_stats = [0, numpy.zeros(n),
+                                   numpy.zeros((n, n), order='F'),
+                                   X.dtype, shift]
+        stats = self._partial_stats
+        if X.shape[0] == 0:
+            return
+        X64 = numpy.array(X, dtype='float64')
+        X64 -= stats[4]
+        stats[0] += X.shape[0]
+        stats[1] += X64.sum(axis=0)
+        # X64.T is Fortran-ordered, so BLAS reads it without a copy
+        stats[2] = linalg.blas.dsyrk(1.0, X64.T, beta=1.0, c=stats[2],
+                                     overwrite_c=True)
+
+    def finish_fit(self):
+        """
+        Fits the whitening matrices from the statistics accumulated by
+        `partial_fit`.
+        """
+        count, total, scatter, dtype, shift = self._partial_stats
+        self._partial_stats = None
+        # Only the upper triangle was accumulated
+        scatter = numpy.triu(scatter)
+        scatter += numpy.triu(scatter, 1).T
+        shifted_mean = total / count
+        covariance = scatter / count - numpy.outer(shifted_mean, shifted_mean)
+        covariance.flat[::covariance.shape[0] + 1] += self.filter_bias
+        self.mean_ = (shift + shifted_mean).astype(dtype)
+        self._fit_covariance(covariance, dtype)
+
+    def _should_fit(self, can_fit):
+        """
+        Like `apply`, only fits if this `ZCA` wasn't fit before.
+        """
+        if not self.has_fit_:
+            assert can_fit
+            return True
+        return False
+
+    def transform_chunk(self, X):
+        """
+        Returns one chunk of a design matrix, centered and multiplied by
+        the whitening matrix. The result has the dtype of `P_`.
+
+        Parameters
+        ----------
+        X : ndarray
+            A block of rows of the design matrix.
+        """
+        assert X.dtype in ['float32', 'float64']
+        # Whiten in the dtype of P_, since BLAS can't mix dtypes
+        X = numpy.asarray(X, dtype=self.P_.dtype)
+        return ZCA._gpu_matrix_dot(X - self.mean_, self.P_)
+
+    def _fit_covariance(self, covariance, dtype=None):
+        """
+        Computes `self.P_` (and `self.inv_P_`) from the regularized
+        covariance matrix of the data.
+
+        Parameters
+        ----------
+        covariance : ndarray
+            Covariance matrix, with `filter_bias` already added to its
+            diagonal.
+        dtype : str, optional
+            The dtype in which to store the matrices. By default, they
+            keep the dtype of the computation.
+        """
         t1 = time.time()
         eigs, eigv = linalg.eigh(covariance)
         t2 = time.time()
@@ -1463,23 +2350,23 @@ class ZCA(Preprocessor):
         else:
             self.inv_P_ = None
 
+        if dtype is not None:
+            self.P_ = numpy.asarray(self.P_, dtype=dtype)
+            if self.inv_P_ is not None:
+                self.inv_P_ = numpy.asarray(self.inv_P_, dtype=dtype)
+        if getattr(self, 'matrices_save_path', None) is not None:
+            self._save_matrices()
+
     def apply(self, dataset, can_fit=False):
         """
         .. todo::
 
             WRITEME
         """
-        # Compiles apply.x_minus_mean_times_p(), a numeric Theano function that
-        # evauates dot(X - mean, P)
-        if not hasattr(ZCA, '_x_minus_mean_times_p'):
-            x_symbol = tensor.matrix('X')
-            mean_symbol = tensor.vector('mean')
-            p_symbol = tensor.matrix('P_')
-            new_x_symbol = tensor.dot(x_symbol - mean_symbol, p_symbol)
-            ZCA._x_minus_mean_times_p = theano.function([x_symbol,
-                                                         mean_symbol,
-                                                         p_symbol],
-                                                        new_x_symbol)
+        chunk_size = getattr(self, 'chunk_size', None)
+        if chunk_size is not None:
+            self.apply_in_chunks(dataset, chunk_size, can_fit)
+            return
 
         X = dataset.get_design_matrix()
         assert X.dtype in ['float32', 'float64']
@@ -1487,8 +2374,7 @@ class ZCA(Preprocessor):
             assert can_fit
             self.fit(X)
 
-        new_X = ZCA._gpu_matrix_dot(X - self.mean_, self.P_)
-        dataset.set_design_matrix(new_X)
+        dataset.set_design_matrix(self.transform_chunk(X))
 
     def inverse(self, X):
         """
@@ -1534,14 +2420,27 @@ class LeCunLCN(ExamplewisePreprocessor):
     channels : list or None, optional
         List of channels to normalize.
         If none, will apply it on all channels.
+    backend : str, optional
+        'theano' compiles `lecun_lcn`. 'separable' and 'fft' use
+        `lecun_lcn_numpy`, which smooths with two 1D Gaussian filters or
+        with FFTs. By default, 'theano' is used on a GPU, and otherwise
+        'fft' for large kernels and 'separable' for the others.
+    num_workers : int, optional
+        Number of threads normalizing parts of each batch, with the numpy
+        backends.
     """
 
     def __init__(self, img_shape, kernel_size=7, batch_size=5000,
-                 threshold=1e-4, channels=None):
+                 threshold=1e-4, channels=None, backend=None, num_workers=1):
         self._img_shape = img_shape
         self._kernel_size = kernel_size
         self._batch_size = batch_size
         self._threshold = threshold
+        if backend not in (None, 'theano', 'separable', 'fft'):
+            raise ValueError("backend should be None, 'theano', 'separable' "
+                             "or 'fft', got %s" % str(backend))
+        self._backend = backend
+        self._num_workers = num_workers
         if channels is None:
             self._channels = range(3)
         else:
@@ -1552,26 +2451,67 @@ class LeCunLCN(ExamplewisePreprocessor):
             else:
                 raise ValueError("channels should be either a list or int")
 
-    def transform(self, x):
+    def _get_backend(self):
         """
-        .. todo::
+        Returns the backend to use, resolving the default one.
+        """
+        backend = getattr(self, '_backend', None)
+        if backend is not None:
+            return backend
+        if _on_gpu():
+            return 'theano'
+        if self._kernel_size >= _LCN_FFT_KERNEL_SIZE:
+            return 'fft'
+        return 'separable'
 
-            WRITEME properly
+    def transform(self, x):
+        """
+        Normalizes the channels of `x` in place.
 
         Parameters
         ----------
-        X : WRITEME
+        x : ndarray
             data with axis [b, 0, 1, c]
-        """
-        for i in self._channels:
-            assert isinstance(i, int)
-            assert i >= 0 and i <= x.shape[3]
 
-            x[:, :, :, i] = lecun_lcn(x[:, :, :, i],
-                                      self._img_shape,
-                                      self._kernel_size,
-                                      self._threshold)
-            return x
+        Returns
+        -------
+        x : ndarray
+            The same array, normalized.
+        """
+        backend = self._get_backend()
+        num_workers = getattr(self, '_num_workers', 1)
+        pool = None
+        if backend != 'theano' and num_workers > 1 and len(x) > 1:
+            pool = ThreadPool(num_workers)
+        try:
+            for i in self._channels:
+                assert isinstance(i, int)
+                assert i >= 0 and i <= x.shape[3]
+
+                if backend == 'theano':
+                    x[:, :, :, i] = lecun_lcn(x[:, :, :, i],
+                                              self._img_shape,
+                                              self._kernel_size,
+                                              self._threshold)
+                    continue
+
+                def normalize(bounds):
+                    channel = x[bounds[0]:bounds[1], :, :, i]
+                    lecun_lcn_numpy(channel, self._kernel_size,
+                                    self._threshold, method=backend,
+                                    out=channel)
+
+                if pool is None:
+                    normalize((0, len(x)))
+                else:
+                    bounds = numpy.linspace(0, len(x), num_workers + 1)
+                    bounds = bounds.astype('int64')
+                    pool.map(normalize, zip(bounds[:-1], bounds[1:]))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return x
 
     def apply(self, dataset, can_fit=False):
         """
@@ -1598,6 +2538,11 @@ class LeCunLCN(ExamplewisePreprocessor):
             transformed = convert_axes(transformed,
                                        axes,
                                        dataset.view_converter.axes)
+            if (isinstance(dataset.X, numpy.ndarray) and
+                    numpy.may_share_memory(transformed, dataset.X)):
+                # transform normalized the topological view of dataset.X
+                # in place
+                continue
             if self._batch_size != data_size:
                 if isinstance(dataset.X, numpy.ndarray):
                     # TODO have a separate class for non pytables datasets
@@ -1614,7 +2559,8 @@ class LeCunLCN(ExamplewisePreprocessor):
                                                  dataset.view_converter.axes,
                                                  start=i)
 
-        if self._batch_size == data_size:
+        if (self._batch_size == data_size and
+                not numpy.may_share_memory(transformed, dataset.X)):
             dataset.set_topological_view(transformed,
                                          dataset.view_converter.axes)
 
@@ -1828,6 +2774,77 @@ def lecun_lcn(input, img_shape, kernel_shape, threshold=1e-4):
     return f(input)
 
 
+def lecun_lcn_numpy(input, kernel_shape, threshold=1e-4, method='separable',
+                    out=None):
+    """
+    Yann LeCun's local contrast normalization, computed with numpy and
+    scipy. This gives the same results as `lecun_lcn`, up to rounding.
+
+    The Gaussian kernel of `gaussian_filter` is the outer product of a 1D
+    Gaussian with itself, so the images can be smoothed by filtering
+    their rows and then their columns, in O(kernel_shape) operations per
+    pixel instead of O(kernel_shape ** 2). For large kernels, smoothing
+    with FFTs is faster still. The computation is done in float64.
+
+    Parameters
+    ----------
+    input : ndarray
+        Images, with axes [b, 0, 1].
+    kernel_shape : int
+        Width of the Gaussian kernel. It must be odd.
+    threshold : float, optional
+        Threshold for the denominator.
+    method : str, optional
+        'separable' or 'fft'.
+    out : ndarray, optional
+        Where to write the normalized images. It can be `input` itself.
+
+    Returns
+    -------
+    out : ndarray
+        The normalized images, with the dtype of `input` if `out` isn't
+        given.
+    """
+    if kernel_shape % 2 != 1:
+        raise ValueError("kernel_shape must be odd, got %d" % kernel_shape)
+    x = numpy.asarray(input, dtype='float64')
+    if method == 'separable':
+        mid = kernel_shape // 2
+        kernel = numpy.exp(-(numpy.arange(kernel_shape) - mid) ** 2 / 8.)
+        kernel /= kernel.sum()
+
+        def smooth(images):
+            rval = ndimage.correlate1d(images, kernel, axis=1,
+                                       mode='constant')
+            return ndimage.correlate1d(rval, kernel, axis=2, mode='constant',
+                                       output=rval)
+    elif method == 'fft':
+        kernel = gaussian_filter(kernel_shape).astype('float64')
+        kernel = kernel.reshape((1, kernel_shape, kernel_shape))
+
+        def smooth(images):
+            return signal.fftconvolve(images, kernel, mode='same')
+    else:
+        raise ValueError("method should be 'separable' or 'fft', got %s"
+                         % str(method))
+
+    # For each pixel, remove the Gaussian-weighted mean of its
+    # neighborhood
+    centered = x - smooth(x)
+    # and divide by the norm of the neighborhood, if it's larger than its
+    # mean over the image. FFTs can give small negative sums of squares.
+    denom = numpy.sqrt(numpy.maximum(smooth(x ** 2), 0.))
+    per_img_mean = denom.mean(axis=(1, 2))
+    divisor = numpy.maximum(per_img_mean[:, None, None], denom, out=denom)
+    numpy.maximum(divisor, threshold, out=divisor)
+    centered /= divisor
+
+    if out is None:
+        return centered.astype(input.dtype)
+    out[...] = centered
+    return out
+
+
 def gaussian_filter(kernel_shape):
     """
     .. todo::
@@ -0,0 +1,397 @@
+"""
+Content-addressed on-disk cache for preprocessed datasets.
+
+Preprocessing a large dataset (e.g. GCN followed by ZCA on CIFAR-10) can
+take much longer than the rest of the setup of an experiment. Rather than
+writing a dedicated script that saves the preprocessed dataset, an
+experiment can load it through a `PreprocessedDatasetCache`:
+
+.. code-block:: yaml
+
+    dataset: &train
+        !obj:pylearn2.datasets.preprocessing_cache.load_preprocessed {
+            dataset_class: !import pylearn2.datasets.cifar10.CIFAR10,
+            dataset_kwargs: {which_set: 'train', gcn: 55.},
+            preprocessor: &prepro
+                !obj:pylearn2.datasets.preprocessing.ZCA {},
+            can_fit: True,
+        }
+
+The first launch builds the dataset, applies the preprocessor and stores
+the design matrix as a `.npy` file, next to the pickled dataset (without
+its design matrix) and the fitted preprocessor. The following launches
+memory-map the design matrix and restore the fitted state into
+`preprocessor`, so that it can still be applied to other datasets (e.g.
+the test set, with `can_fit: False`).
+
+Entries are keyed by a hash of the dataset class and constructor
+arguments, of the class and parameters of the preprocessor (including
+any parameters that were fit before), of `can_fit`, and of the source
+code of the modules defining these classes. The least recently used
+entries are deleted when the cache grows beyond `max_size` bytes.
+"""
+import hashlib
+import inspect
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import theano
+from theano.compat import six
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.utils import serial
+from pylearn2.utils import string_utils
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '${PYLEARN2_DATA_PATH}/preprocessed_cache'
+
+
+def _describe(obj, modules, seen):
+    """
+    Returns a hashable, deterministic description of `obj`.
+
+    Numpy arrays and shared variables are described by their content,
+    objects by their class and attributes. Compiled Theano functions and
+    symbolic variables are ignored, since they only depend on the other
+    attributes. The names of the modules defining the classes and
+    functions that are encountered are added to `modules`.
+
+    Parameters
+    ----------
+    obj : object
+        The object to describe.
+    modules : set
+        Set to which the names of the modules are added.
+    seen : set
+        Ids of the objects being described, to break reference cycles.
+    """
+    if obj is None or isinstance(obj, (bool, float, complex) +
+                                 six.integer_types + six.string_types):
+        return repr(obj)
+    if isinstance(obj, six.binary_type):
+        return hashlib.sha1(obj).hexdigest()
+    if isinstance(obj, np.generic):
+        return (str(obj.dtype), repr(obj.item()))
+    if isinstance(obj, np.ndarray):
+        data = np.ascontiguousarray(obj)
+        return ('ndarray', str(obj.dtype), obj.shape,
+                hashlib.sha1(data.view(np.uint8)).hexdigest())
+    if isinstance(obj, theano.compile.SharedVariable):
+        return _describe(obj.get_value(borrow=True), modules, seen)
+    if isinstance(obj, (theano.gof.Variable,
+                        theano.compile.function_module.Function)):
+        return None
+    if isinstance(obj, six.class_types) or inspect.isroutine(obj):
+        module = getattr(obj, '__module__', None)
+        if module is not None:
+            modules.add(module)
+        return '%s.%s' % (module, getattr(obj, '__name__', repr(obj)))
+    if id(obj) in seen:
+        return 'cycle'
+    seen.add(id(obj))
+    try:
+        if isinstance(obj, (list, tuple)):
+            return (type(obj).__name__,
+                    tuple(_describe(elem, modules, seen) for elem in obj))
+        if isinstance(obj, dict):
+            items = [(_describe(key, modules, seen),
+                      _describe(value, modules, seen))
+                     for key, value in obj.items()]
+            return ('dict', tuple(sorted(items, key=repr)))
+        cls = type(obj)
+        modules.add(cls.__module__)
+        state = getattr(obj, '__dict__', {})
+        return ('%s.%s' % (cls.__module__, cls.__name__),
+                _describe(state, modules, seen))
+    finally:
+        seen.discard(id(obj))
+
+
+def _module_sources_digest(modules):
+    """
+    Returns a digest of the source files of the given modules, so that
+    cache entries are invalidated when the code that created them
+    changes.
+
+    Parameters
+    ----------
+    modules : iterable of str
+        Names of the modules.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(modules):
+        module = sys.modules.get(name)
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        if not path.endswith('.py') or not os.path.isfile(path):
+            continue
+        digest.update(name.encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _entry_size(path):
+    """
+    Returns the total size in bytes of the files in directory `path`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of a cache entry.
+    """
+    size = 0
+    for name in os.listdir(path):
+        size += os.path.getsize(os.path.join(path, name))
+    return size
+
+
+class PreprocessedDatasetCache(object):
+    """
+    A directory of preprocessed `DenseDesignMatrix` datasets, indexed by
+    a hash of how they were created.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory holding the cache entries. Environment variables are
+        expanded. Created if it doesn't exist.
+    max_size : int, optional
+        If specified, the least recently used entries are deleted
+        whenever the cache grows beyond this many bytes. The entry that
+        was just stored is always kept.
+    version : str, optional
+        Extra string that is hashed into the keys, e.g. to invalidate
+        the entries when code outside of the modules of the dataset and
+        preprocessor classes changes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=None,
+                 version=None):
+        self.cache_dir = string_utils.preprocess(cache_dir)
+        if max_size is not None and max_size <= 0:
+            raise ValueError("max_size must be positive, got %s"
+                             % str(max_size))
+        self.max_size = max_size
+        self.version = version
+
+    def key(self, dataset_class, dataset_kwargs, preprocessor,
+            can_fit=False):
+        """
+        Returns the hexadecimal key of the entry holding the result of
+        applying `preprocessor` to `dataset_class(**dataset_kwargs)`.
+
+        Parameters
+        ----------
+        dataset_class : callable
+            Class (or function) building the dataset.
+        dataset_kwargs : dict
+            Arguments of `dataset_class`.
+        preprocessor : Preprocessor
+            The preprocessor, in its current (possibly fitted) state.
+        can_fit : bool, optional
+            Argument of `preprocessor.apply`.
+        """
+        modules = set()
+        seen = set()
+        description = (_describe(dataset_class, modules, seen),
+                       _describe(dataset_kwargs, modules, seen),
+                       _describe(preprocessor, modules, seen),
+                       bool(can_fit), self.version)
+        digest = hashlib.sha1(repr(description).encode('utf-8'))
+        digest.update(_module_sources_digest(modules).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        """
+        Returns the directory of the entry `key`.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `self.key`.
+        """
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key, preprocessor=None):
+        """
+        Returns the dataset stored under `key`, with a memory-mapped,
+        copy-on-write design matrix, or None if there is no such entry.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `self.key`.
+        preprocessor : Preprocessor, optional
+            If given, the fitted state of the stored preprocessor is
+            copied into it.
+        """
+        path = self._entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            dataset = serial.load(os.path.join(path, 'dataset.pkl'),
+                                  retry=False)
+            X = np.load(os.path.join(path, 'X.npy'), mmap_mode='c')
+            if preprocessor is not None:
+                fitted = serial.load(os.path.join(path, 'preprocessor.pkl'),
+                                     retry=False)
+                preprocessor.__dict__.update(fitted.__dict__)
+        except Exception as e:
+            log.warning("Ignoring unreadable cache entry %s: %s" % (path, e))
+            return None
+        dataset.X = X
+        # Mark the entry as recently used
+        os.utime(path, None)
+        log.info("Loaded preprocessed dataset from %s" % path)
+        return dataset
+
+    def store(self, key, dataset, preprocessor):
+        """
+        Stores a preprocessed dataset and its preprocessor under `key`.
+
+        The entry is written to a temporary directory that is then
+        renamed, so that concurrent processes never see partial entries.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by `self.key`.
+        dataset : DenseDesignMatrix
+            The preprocessed dataset.
+        preprocessor : Preprocessor
+            The preprocessor that was applied to `dataset`.
+        """
+        if not isinstance(dataset, DenseDesignMatrix):
+            raise TypeError("Only DenseDesignMatrix datasets can be "
+                            "cached, got %s" % type(dataset))
+        serial.mkdir(self.cache_dir)
+        path = self._entry_path(key)
+        tmp_path = tempfile.mkdtemp(prefix='.tmp_' + key, dir=self.cache_dir)
+        try:
+            np.save(os.path.join(tmp_path, 'X.npy'),
+                    dataset.get_design_matrix())
+            # Pickle a shallow copy without the design matrix, which is
+            # stored (and loaded) separately.
+            stripped = object.__new__(type(dataset))
+            stripped.__dict__.update(dataset.__dict__)
+            stripped.__dict__.update(X=None, design_loc=None, compress=False)
+            serial.save(os.path.join(tmp_path, 'dataset.pkl'), stripped)
+            serial.save(os.path.join(tmp_path, 'preprocessor.pkl'),
+                        preprocessor)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process stored the same entry first.
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+        log.info("Stored preprocessed dataset in %s" % path)
+        if self.max_size is not None:
+            self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the total size of
+        the cache is at most `self.max_size` bytes.
+
+        Parameters
+        ----------
+        keep : str, optional
+            Key of an entry that must not be deleted.
+        """
+        if self.max_size is None or not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), _entry_size(path),
+                                name))
+            except OSError:
+                # Deleted by another process in the meantime
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            log.info("Evicting cache entry %s" % name)
+            shutil.rmtree(os.path.join(self.cache_dir, name),
+                          ignore_errors=True)
+            total -= size
+
+    def get(self, dataset_class, preprocessor, dataset_kwargs=None,
+            can_fit=False):
+        """
+        Returns `dataset_class(**dataset_kwargs)` preprocessed by
+        `preprocessor`, loading it from the cache if possible and
+        storing it otherwise.
+
+        Parameters
+        ----------
+        dataset_class : callable
+            Class (or function) building a `DenseDesignMatrix`.
+        preprocessor : Preprocessor
+            The preprocessor to apply. On a cache hit, it receives the
+            state it would have after being applied.
+        dataset_kwargs : dict, optional
+            Arguments of `dataset_class`.
+        can_fit : bool, optional
+            Argument of `preprocessor.apply`.
+        """
+        if dataset_kwargs is None:
+            dataset_kwargs = {}
+        t1 = time.time()
+        key = self.key(dataset_class, dataset_kwargs, preprocessor, can_fit)
+        dataset = self.load(key, preprocessor)
+        if dataset is not None:
+            log.info("Cache hit took %f seconds" % (time.time() - t1))
+            return dataset
+        dataset = dataset_class(**dataset_kwargs)
+        preprocessor.apply(dataset, can_fit)
+        self.store(key, dataset, preprocessor)
+        return dataset
+
+
+def load_preprocessed(dataset_class, preprocessor, dataset_kwargs=None,
+                      can_fit=False, cache_dir=DEFAULT_CACHE_DIR,
+                      max_size=None, version=None):
+    """
+    Convenience function to use a `PreprocessedDatasetCache` from YAML.
+    See the module docstring.
+
+    Parameters
+    ----------
+    dataset_class : callable
+        See `PreprocessedDatasetCache.get`.
+    preprocessor : Preprocessor
+        See `PreprocessedDatasetCache.get`.
+    dataset_kwargs : dict, optional
+        See `PreprocessedDatasetCache.get`.
+    can_fit : bool, optional
+        See `PreprocessedDatasetCache.get`.
+    cache_dir : str, optional
+        See `PreprocessedDatasetCache`.
+    max_size : int, optional
+        See `PreprocessedDatasetCache`.
+    version : str, optional
+        See `PreprocessedDatasetCache`.
+    """
+    cache = PreprocessedDatasetCache(cache_dir, max_size, version)
+    return cache.get(dataset_class, preprocessor, dataset_kwargs, can_fit)
@@ -19,12 +19,69 @@ import gzip
 floatX = theano.config.floatX
 logger = logging.getLogger(__name__)
 from pylearn2.space import CompositeSpace, VectorSpace
-from pylearn2.utils import safe_zip
+from pylearn2.utils import py_integer_types, safe_zip
 from pylearn2.utils.exc import reraise_as
 from pylearn2.utils.iteration import (
     FiniteDatasetIterator,
     resolve_iterator_class
 )
+from pylearn2.utils.rng import make_np_rng
+
+
+def take_csr_rows(X, rows):
+    """
+    Gathers rows of a CSR matrix.
+
+    The positions of the nonzero elements of the requested rows in
+    `X.data` and `X.indices` are computed from `X.indptr` with a few
+    vectorized operations, so that the cost only depends on the number
+    of nonzero elements gathered, as for contiguous reads.
+
+    Parameters
+    ----------
+    X : scipy.sparse.csr_matrix
+        The matrix to read from.
+    rows : slice or 1-D array of ints
+        The rows to gather, in the order they should be returned.
+
+    Returns
+    -------
+    batch : scipy.sparse.csr_matrix
+        A matrix with one row per requested row. If `rows` is a slice
+        with unit step, it shares its data with `X`.
+    """
+    indptr = X.indptr
+    if isinstance(rows, slice):
+        start, stop, step = rows.indices(X.shape[0])
+        if step == 1:
+            stop = max(start, stop)
+            begin, end = indptr[start], indptr[stop]
+            return scipy.sparse.csr_matrix(
+                (X.data[begin:end], X.indices[begin:end],
+                 indptr[start:stop + 1] - begin),
+                shape=(stop - start, X.shape[1]))
+        rows = numpy.arange(start, stop, step)
+    rows = numpy.asarray(rows)
+    if rows.size == 0:
+        rows = rows.astype(indptr.dtype)
+    if rows.ndim != 1 or rows.dtype.kind not in 'iu':
+        raise ValueError("rows should be a 1-D array of ints")
+    if len(rows) and (rows.min() < -X.shape[0] or
+                      rows.max() >= X.shape[0]):
+        raise IndexError("row index out of range for a matrix with %d rows"
+                         % X.shape[0])
+    rows = numpy.where(rows < 0, rows + X.shape[0], rows)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    new_indptr = numpy.zeros(len(rows) + 1, dtype=indptr.dtype)
+    numpy.cumsum(lengths, out=new_indptr[1:])
+    # Position in X of each element of the batch: the start of its row
+    # in X plus its offset in the row of the batch.
+    offsets = numpy.arange(new_indptr[-1], dtype=indptr.dtype)
+    offsets += numpy.repeat(starts - new_indptr[:-1], lengths)
+    return scipy.sparse.csr_matrix(
+        (X.data[offsets], X.indices[offsets], new_indptr),
+        shape=(len(rows), X.shape[1]))
 
 
 class SparseDataset(Dataset):
@@ -46,13 +103,20 @@ class SparseDataset(Dataset):
         used only when load_path is specified.
         indicates whether the input matrix is zipped or not.
         defaults to True.
+    rng : object, optional
+        A random number generator used for picking random indices into
+        the design matrix when choosing minibatches.
     """
 
+    _default_seed = (17, 2, 946)
+
     def __init__(self, load_path=None,
-                 from_scipy_sparse_dataset=None, zipped_npy=True):
+                 from_scipy_sparse_dataset=None, zipped_npy=True, rng=None):
 
         self.load_path = load_path
         self.y = None
+        self.rng = make_np_rng(rng, self._default_seed,
+                               which_method=['permutation', 'randint'])
 
         if self.load_path is not None:
             if zipped_npy is True:
@@ -70,6 +134,8 @@ class SparseDataset(Dataset):
                 msg = "from_scipy_sparse_dataset is not sparse : %s" \
                       % type(self.X)
                 raise TypeError(msg)
+            if not scipy.sparse.isspmatrix_csr(self.X):
+                self.X = self.X.tocsr()
 
         X_space = VectorSpace(dim=self.X.shape[1], sparse=True)
         self.X_space = X_space
@@ -89,9 +155,8 @@ class SparseDataset(Dataset):
     @wraps(Dataset.get_batch_design)
     def get_batch_design(self, batch_size, include_labels=False):
         """Method inherited from Dataset"""
-        self.iterator(mode='shuffled_sequential',
-                      batch_size=batch_size, num_batches=None)
-        return self.next()
+        return self.iterator(mode='random_slice', batch_size=batch_size,
+                             num_batches=1).next()
 
     @wraps(Dataset.get_batch_topo)
     def get_batch_topo(self, batch_size):
@@ -105,7 +170,7 @@ class SparseDataset(Dataset):
     @wraps(Dataset.iterator)
     def iterator(self, mode=None, batch_size=None, num_batches=None,
                  rng=None, data_specs=None,
-                 return_tuple=False):
+                 return_tuple=False, prefetch=0, num_buffers=0):
 
         if data_specs is None:
             data_specs = self._iter_data_specs
@@ -156,7 +221,42 @@ class SparseDataset(Dataset):
                                           rng),
                                      data_specs=data_specs,
                                      return_tuple=return_tuple,
-                                     convert=convert)
+                                     convert=convert,
+                                     prefetch=prefetch,
+                                     num_buffers=num_buffers)
+
+    def get(self, sources, indexes):
+        """
+        Retrieves the requested elements from the dataset.
+
+        Parameters
+        ----------
+        sources : tuple
+            A tuple of source identifiers
+        indexes : slice or list
+            A slice or a list of indexes
+
+        Returns
+        -------
+        rval : tuple
+            A tuple of batches, one for each source. Features are
+            returned as CSR matrices, see `take_csr_rows`.
+        """
+        if isinstance(indexes, py_integer_types):
+            indexes = [indexes]
+        rval = []
+        for source in sources:
+            if source == 'features':
+                try:
+                    rval.append(take_csr_rows(self.X, indexes))
+                except IndexError as e:
+                    reraise_as(ValueError("Index out of range: " + str(e)))
+            elif source == 'targets' and self.y is not None:
+                rval.append(self.y[indexes])
+            else:
+                raise ValueError("The dataset does not provide a source "
+                                 "with name: %s." % source)
+        return tuple(rval)
 
     def __iter__(self):
         """
@@ -176,7 +276,7 @@ class SparseDataset(Dataset):
         try:
             mini_batch = self.X[indx]
         except IndexError as e:
-            reraise_as(ValueError("Index out of range" + str(e)))
+            reraise_as(ValueError("Index out of range: " + str(e)))
             # the ind of minibatch goes beyond the boundary
         return mini_batch
 
@@ -0,0 +1,140 @@
+"""
+Tests for pylearn2.datasets.augmentation
+"""
+import numpy as np
+from nose.tools import assert_raises
+
+from pylearn2.datasets.augmentation import (AugmentedDataset,
+                                            RandomWindowAndFlip,
+                                            random_window_and_flip)
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.space import CompositeSpace, Conv2DSpace, VectorSpace
+
+
+def _make_dataset(axes=('b', 0, 1, 'c')):
+    rng = np.random.RandomState(0)
+    topo = rng.rand(10, 5, 5, 2).astype('float32')
+    y = rng.rand(10, 3).astype('float32')
+    return DenseDesignMatrix(topo_view=topo, y=y, axes=axes), topo
+
+
+def _windows(image, window_shape, flip):
+    """
+    All the windows (and their reflections) of a (rows, cols, channels)
+    image.
+    """
+    rows, cols = window_shape
+    rval = []
+    for i in range(image.shape[0] - rows + 1):
+        for j in range(image.shape[1] - cols + 1):
+            window = image[i:i + rows, j:j + cols]
+            rval.append(window)
+            if flip:
+                rval.append(window[:, ::-1])
+    return rval
+
+
+def test_random_window_and_flip():
+    """
+    Check that every output image is a window of its input image, for
+    both supported axis orders.
+    """
+    rng = np.random.RandomState(1)
+    topo = rng.rand(6, 5, 4, 3).astype('float32')
+    for axes in [('b', 0, 1, 'c'), ('c', 0, 1, 'b')]:
+        batch = topo.transpose([('b', 0, 1, 'c').index(a) for a in axes])
+        out = random_window_and_flip(batch, (3, 2), axes=axes, rng=0)
+        out = out.transpose([axes.index(a) for a in ('b', 0, 1, 'c')])
+        assert out.shape == (6, 3, 2, 3)
+        for b in range(6):
+            assert any(np.all(out[b] == w)
+                       for w in _windows(topo[b], (3, 2), True))
+    assert_raises(ValueError, random_window_and_flip, topo, (6, 2))
+
+
+def test_random_window_and_flip_padding():
+    """
+    Check that padding adds zeros around the images.
+    """
+    topo = np.ones((20, 2, 2, 1), dtype='float32')
+    out = random_window_and_flip(topo, (2, 2), pad=2, rng=0)
+    assert out.shape == (20, 2, 2, 1)
+    assert np.any(out == 0)
+    assert set(np.unique(out)) <= set([0, 1])
+    full = random_window_and_flip(topo, (6, 6), pad=2, rng=0)
+    assert np.all(full.sum(axis=(1, 2, 3)) == 4)
+
+
+def test_augmented_dataset_iterator():
+    """
+    Check the spaces, targets and windows returned by the iterator.
+    """
+    dataset, topo = _make_dataset()
+    augmented = AugmentedDataset(dataset, RandomWindowAndFlip((3, 3)))
+    space, source = augmented.get_data_specs()
+    assert space.components[0].shape == (3, 3)
+
+    data_specs = (CompositeSpace((Conv2DSpace((3, 3), num_channels=2,
+                                              axes=('c', 0, 1, 'b')),
+                                  VectorSpace(3))),
+                  ('features', 'targets'))
+    seen = 0
+    for X, y in augmented.iterator(mode='sequential', batch_size=4,
+                                   data_specs=data_specs):
+        assert X.shape == (2, 3, 3, y.shape[0])
+        for b in range(y.shape[0]):
+            np.testing.assert_equal(y[b], dataset.y[seen])
+            assert any(np.all(X[..., b].transpose(1, 2, 0) == w)
+                       for w in _windows(topo[seen], (3, 3), True))
+            seen += 1
+    assert seen == 10
+
+    X = augmented.iterator(mode='sequential', batch_size=4,
+                           data_specs=(VectorSpace(18), 'features')).next()
+    assert X.shape == (4, 18)
+
+
+def test_augmented_dataset_workers_deterministic():
+    """
+    Check that the augmented data does not depend on whether a worker
+    pool is used.
+    """
+    dataset, _ = _make_dataset()
+    data_specs = (Conv2DSpace((3, 3), num_channels=2), 'features')
+    batches = []
+    for num_workers in [0, 2]:
+        augmented = AugmentedDataset(dataset, RandomWindowAndFlip((3, 3)),
+                                     num_workers=num_workers)
+        batches.append(list(augmented.iterator(mode='shuffled_sequential',
+                                               batch_size=3, rng=5,
+                                               data_specs=data_specs)))
+        augmented.close()
+        assert augmented._pool is None
+    assert len(batches[0]) == len(batches[1]) == 4
+    for a, b in zip(*batches):
+        np.testing.assert_equal(a, b)
+
+
+def test_augmented_dataset_num_buffers():
+    """
+    Check that with a ring of `num_buffers` buffers, each batch of
+    targets stays valid until `num_buffers` - 1 more batches are drawn,
+    with or without a worker pool.
+    """
+    dataset, _ = _make_dataset()
+    data_specs = (CompositeSpace((Conv2DSpace((3, 3), num_channels=2),
+                                  VectorSpace(3))),
+                  ('features', 'targets'))
+    for num_workers in [0, 2]:
+        augmented = AugmentedDataset(dataset, RandomWindowAndFlip((3, 3)),
+                                     num_workers=num_workers)
+        previous = None
+        for X, y in augmented.iterator(mode='sequential', batch_size=2,
+                                       data_specs=data_specs, num_buffers=2):
+            if previous is not None:
+                np.testing.assert_equal(previous, dataset.y[start - 2:start])
+            start = 2 if previous is None else start + 2
+            np.testing.assert_equal(y, dataset.y[start - 2:start])
+            previous = y
+        assert start == 10
+        augmented.close()
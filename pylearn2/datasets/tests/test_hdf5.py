@@ -99,6 +99,45 @@ def test_hdf5_load_all():
     # cleanup
     os.remove(filename)
 
+
+def test_hdf5_shuffled_get():
+    """Read shuffled and block-shuffled batches from a chunked file."""
+    skip_if_no_h5py()
+    import h5py
+    from pylearn2.datasets.hdf5 import HDF5Dataset
+    from pylearn2.space import VectorSpace
+
+    handle, filename = tempfile.mkstemp()
+    X = np.random.RandomState(1).rand(50, 3).astype('float32')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('X', data=X, chunks=(10, 3))
+    dataset = HDF5Dataset(filename, sources=['X'], spaces=[VectorSpace(3)],
+                          aliases=['features'], use_h5py=True)
+
+    indexes = np.array([7, 3, 4, 5, 40, 3, 12])
+    batch, = dataset.get(('features',), indexes)
+    assert isinstance(batch, np.ndarray)
+    np.testing.assert_equal(batch, X[indexes])
+    batch, = dataset.get(('features',), [1, 2, 8])
+    np.testing.assert_equal(batch, X[[1, 2, 8]])
+
+    for mode in ['shuffled_sequential', 'block_shuffled_sequential']:
+        iterator = dataset.iterator(mode=mode, batch_size=5, rng=0,
+                                    data_specs=(VectorSpace(3), 'features'))
+        seen = np.concatenate(list(iterator))
+        np.testing.assert_equal(np.sort(seen, axis=0), np.sort(X, axis=0))
+    iterator = dataset.iterator(mode='block_shuffled_sequential',
+                                batch_size=5, rng=0,
+                                data_specs=(VectorSpace(3), 'features'))
+    assert iterator._subset_iterator.block_size == 10
+    iterator = dataset.iterator(mode='even_block_shuffled_sequential',
+                                batch_size=5, rng=0,
+                                data_specs=(VectorSpace(3), 'features'))
+    assert iterator._subset_iterator._base_iterator.block_size == 10
+
+    dataset._fhandler.close()
+    os.remove(filename)
+
 design_matrix_yaml = """
 !obj:pylearn2.train.Train {
     dataset: &train !obj:pylearn2.datasets.hdf5.HDF5Dataset {
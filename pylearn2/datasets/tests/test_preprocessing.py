@@ -3,7 +3,13 @@ Unit tests for ./preprocessing.py
 """
 
 import copy
+import os
+import pickle
+import shutil
+import tempfile
 import numpy as np
+from six.moves import xrange
+from scipy.signal import convolve2d
 
 from theano import config
 import theano
@@ -15,11 +21,18 @@ from pylearn2.datasets import dense_design_matrix
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.datasets.preprocessing import (GlobalContrastNormalization,
                                              ExtractGridPatches,
+                                             ExtractPatches,
                                              ReassembleGridPatches,
                                              LeCunLCN,
+                                             gaussian_filter,
+                                             lecun_lcn_numpy,
                                              RGB_YUV,
                                              ZCA,
-                                             PCA)
+                                             PCA,
+                                             Pipeline,
+                                             RemoveMean,
+                                             Standardize,
+                                             transform_in_chunks)
 
 
 class testGlobalContrastNormalization:
@@ -107,6 +120,70 @@ def test_extract_reassemble():
         assert False
 
 
+def test_extract_grid_patches_stride():
+    """ Tests ExtractGridPatches with a stride different from the patch
+    shape against slicing the patches one by one """
+
+    rng = np.random.RandomState([1, 3, 7])
+    topo = rng.randn(3, 9, 8, 2)
+    dataset = DenseDesignMatrix(topo_view=topo, y=np.arange(3)[:, None])
+
+    ExtractGridPatches((3, 4), (2, 3), num_workers=2).apply(dataset)
+
+    expected = [topo[i, r:r + 3, c:c + 4]
+                for i in range(3) for r in range(0, 7, 2)
+                for c in range(0, 5, 3)]
+    assert np.all(dataset.get_topological_view() == np.array(expected))
+    assert np.all(dataset.y[:, 0] == np.repeat(np.arange(3), 8))
+
+
+def test_extract_patches_memmap():
+    """ Tests that ExtractPatches gives the same patches when writing them
+    to a memmap from several processes """
+
+    rng = np.random.RandomState([1, 3, 7])
+    topo = as_floatX(rng.randn(10, 8, 9, 3))
+    expected = DenseDesignMatrix(topo_view=topo)
+    ExtractPatches((3, 4), 50, rng=5).apply(expected)
+
+    save_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(save_dir, 'patches.npy')
+        dataset = DenseDesignMatrix(topo_view=topo)
+        ExtractPatches((3, 4), 50, rng=5, memmap_path=path,
+                       num_workers=3).apply(dataset)
+        assert isinstance(dataset.X, np.memmap)
+        assert np.all(dataset.X == expected.X)
+        del dataset
+    finally:
+        shutil.rmtree(save_dir)
+
+
+def test_extract_out_num_workers():
+    """ Tests that the patches are written to a plain array passed as out
+    when they are extracted by several processes """
+
+    rng = np.random.RandomState([1, 3, 7])
+    topo = as_floatX(rng.randn(4, 9, 9, 2))
+
+    grid = ExtractGridPatches((3, 3), (3, 3))
+    expected = grid.extract(topo)
+    grid.num_workers = 2
+    out = np.zeros_like(expected)
+    assert grid.extract(topo, out) is out
+    assert np.all(out == expected)
+
+    reassemble = ReassembleGridPatches((9, 9), (3, 3), num_workers=2)
+    out = np.zeros_like(topo)
+    assert reassemble.reassemble(expected, out) is out
+    assert np.all(out == topo)
+
+    expected = ExtractPatches((3, 4), 20, rng=5).extract(topo)
+    out = np.zeros_like(expected)
+    ExtractPatches((3, 4), 20, rng=5, num_workers=2).extract(topo, out)
+    assert np.all(out == expected)
+
+
 class testLeCunLCN:
 
     """
@@ -171,6 +248,56 @@ class testLeCunLCN:
 
         assert isfinite(result)
 
+    def test_numpy_backends(self):
+        """
+        Test that the separable and FFT backends compute the same
+        normalization as the convolutions of `lecun_lcn`
+        """
+
+        rng = np.random.RandomState([1, 2, 3])
+        images = rng.uniform(0, 255, (4, 12, 10))
+        kernel_size = 5
+        kernel = gaussian_filter(kernel_size).astype('float64')
+        mid = kernel_size // 2
+
+        def smooth(image):
+            return convolve2d(image, kernel, mode='full')[mid:-mid, mid:-mid]
+
+        expected = []
+        for image in images:
+            denom = np.sqrt(smooth(image ** 2))
+            divisor = np.maximum(np.maximum(denom.mean(), denom), 1e-4)
+            expected.append((image - smooth(image)) / divisor)
+
+        for method in ['separable', 'fft']:
+            result = lecun_lcn_numpy(images, kernel_size, method=method)
+            assert_allclose(result, np.array(expected), rtol=1e-6, atol=1e-8)
+
+    def test_in_place(self):
+        """
+        Test that all the channels are normalized in place in the design
+        matrix, with several threads giving the same result as one
+        """
+
+        rng = np.random.RandomState([1, 2, 3])
+        X = as_floatX(rng.randn(6, 16 * 16 * 3))
+        topo = X.reshape((6, 3, 16, 16)).transpose(0, 2, 3, 1)
+        expected = np.concatenate([lecun_lcn_numpy(topo[:, :, :, i], 7)
+                                   for i in range(3)], axis=1)
+
+        view_converter = dense_design_matrix.DefaultViewConverter((16, 16, 3))
+        for num_workers in [1, 3]:
+            dataset = DenseDesignMatrix(X=X.copy(),
+                                        view_converter=view_converter)
+            X_before = dataset.X
+            preprocessor = LeCunLCN(img_shape=[16, 16], batch_size=4,
+                                    backend='separable',
+                                    num_workers=num_workers)
+            dataset.apply_preprocessor(preprocessor)
+            assert dataset.X is X_before
+            assert_allclose(dataset.X, expected.reshape((6, -1)), rtol=1e-5,
+                            atol=1e-5)
+
 
 def test_rgb_yuv():
     """
@@ -312,6 +439,51 @@ class testZCA:
         finally:
             config.floatX = orig_floatX
 
+    def test_zca_chunks(self):
+        """
+        Confirm that fitting and applying ZCA in chunks of float32 data,
+        far from the origin, gives the same results as doing it at once
+        in float64.
+        """
+        X = self.X + 1e4
+        expected = DenseDesignMatrix(X=X.copy())
+        ZCA(filter_bias=0.0).apply(expected, can_fit=True)
+
+        dataset = DenseDesignMatrix(X=X.astype('float32'))
+        preprocessor = ZCA(filter_bias=0.0, chunk_size=3)
+        preprocessor.apply(dataset, can_fit=True)
+        assert preprocessor.P_.dtype == 'float32'
+        assert dataset.get_design_matrix().dtype == 'float32'
+        assert_allclose(dataset.get_design_matrix(),
+                        expected.get_design_matrix(), rtol=1e-3, atol=1e-3)
+
+    def test_zca_matrices_save_path(self):
+        """
+        Confirm that with a matrices_save_path, the matrices are memmaps
+        of .npy files that are not pickled, and are mapped again when
+        unpickling.
+        """
+        save_dir = tempfile.mkdtemp()
+        try:
+            preprocessor = ZCA()
+            preprocessor.set_matrices_save_path(os.path.join(save_dir,
+                                                             'zca.npz'))
+            preprocessor.fit(self.X)
+            assert isinstance(preprocessor.P_, np.memmap)
+            assert isinstance(preprocessor.inv_P_, np.memmap)
+            assert os.path.exists(os.path.join(save_dir, 'zca.P_.npy'))
+
+            state = preprocessor.__getstate__()
+            assert 'P_' not in state and 'inv_P_' not in state
+            pickled = pickle.dumps(preprocessor)
+            loaded = pickle.loads(pickled)
+            assert isinstance(loaded.P_, np.memmap)
+            assert_allclose(loaded.P_, preprocessor.P_)
+            assert_allclose(loaded.inv_P_, preprocessor.inv_P_)
+            del preprocessor, loaded
+        finally:
+            shutil.rmtree(save_dir)
+
 
 class testPCA:
     """
@@ -367,3 +539,96 @@ class testPCA:
 
         assert self.dataset.get_design_matrix().shape[1] ==\
             self.num_components - 1
+
+    def test_partial_fit_large_offset(self):
+        """
+        Checks that the covariance accumulated by partial_fit doesn't lose
+        precision when the mean is large compared to the spread.
+        """
+        rng = np.random.RandomState([1, 2, 3])
+        X = 1e6 + rng.randn(100, 5)
+        sut = PCA(5)
+        for i in xrange(0, X.shape[0], 30):
+            sut.partial_fit(X[i:i + 30])
+        sut.finish_fit()
+        W = sut._pca.W.get_value()
+        v = sut._pca.v.get_value()
+        assert_allclose(np.dot(W * v, W.T), np.cov(X.T), atol=1e-5)
+        assert_allclose(sut._pca.mean.get_value(), X.mean(axis=0))
+
+
+def test_apply_in_chunks():
+    """
+    Checks that fitting and applying preprocessors in chunks gives the
+    same results as applying them to the whole design matrix.
+    """
+    rng = np.random.RandomState([1, 2, 3])
+    X = as_floatX(rng.randn(23, 6) * rng.uniform(1, 5, 6) + 3)
+    makers = [lambda: RemoveMean(),
+              lambda: RemoveMean(axis=None),
+              lambda: Standardize(),
+              lambda: Standardize(global_mean=True, global_std=True),
+              lambda: GlobalContrastNormalization(scale=2., use_std=True),
+              lambda: ZCA(),
+              lambda: PCA(4, whiten=True)]
+    for make in makers:
+        expected = DenseDesignMatrix(X=X.copy())
+        make().apply(expected, can_fit=True)
+        dataset = DenseDesignMatrix(X=X.copy())
+        preprocessor = make()
+        preprocessor.apply_in_chunks(dataset, 5, can_fit=True)
+        # The principal components are only defined up to their sign
+        assert_allclose(abs(dataset.get_design_matrix()),
+                        abs(expected.get_design_matrix()),
+                        rtol=1e-4, atol=1e-4)
+
+        # The fitted parameters are reused on new data
+        expected = DenseDesignMatrix(X=X[:7].copy())
+        dataset = DenseDesignMatrix(X=X[:7].copy())
+        preprocessor.apply(expected)
+        preprocessor.apply_in_chunks(dataset, 3)
+        assert_allclose(dataset.get_design_matrix(),
+                        expected.get_design_matrix(), rtol=1e-4, atol=1e-4)
+
+
+def test_pipeline_chunks():
+    """
+    Checks that a Pipeline with a chunk_size writes the results in place
+    when it can, and into memmaps otherwise.
+    """
+    rng = np.random.RandomState([1, 2, 3])
+    X = as_floatX(rng.randn(20, 8))
+    expected = DenseDesignMatrix(X=X.copy())
+    Pipeline([Standardize(), PCA(3)]).apply(expected, can_fit=True)
+
+    memmap_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(memmap_dir, 'X.npy')
+        np.save(path, X)
+        design = np.load(path, mmap_mode='r+')
+        dataset = DenseDesignMatrix(X=design)
+        pipeline = Pipeline([Standardize(), PCA(3)], chunk_size=6,
+                            memmap_dir=memmap_dir)
+        pipeline.apply(dataset, can_fit=True)
+        result = dataset.get_design_matrix()
+        assert isinstance(result, np.memmap)
+        assert result.shape == (20, 3)
+        assert_allclose(abs(result), abs(expected.get_design_matrix()),
+                        rtol=1e-4, atol=1e-4)
+        # Standardize was applied in place
+        assert_allclose(np.load(path).std(axis=0), np.ones(8), rtol=1e-3)
+        del design, result, dataset
+    finally:
+        shutil.rmtree(memmap_dir)
+
+
+def test_transform_in_chunks_new_shape():
+    """
+    Checks that transform_in_chunks allocates a new design matrix when
+    the number of columns changes.
+    """
+    X = as_floatX(np.arange(30).reshape(10, 3))
+    dataset = DenseDesignMatrix(X=X)
+    transform_in_chunks(dataset, lambda x: x[:, :2] * 2, 4)
+    assert_allclose(dataset.get_design_matrix(), X[:, :2] * 2)
+    assert_allclose(X, np.arange(30).reshape(10, 3))
@@ -0,0 +1,91 @@
+"""
+Tests for pylearn2.datasets.preprocessing_cache
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.datasets.preprocessing import Pipeline, Standardize, ZCA
+from pylearn2.datasets.preprocessing_cache import (PreprocessedDatasetCache,
+                                                   load_preprocessed)
+
+
+class CountingStandardize(Standardize):
+    """
+    A Standardize preprocessor counting how many times it is applied.
+    """
+    applied = 0
+
+    def apply(self, dataset, can_fit=False):
+        CountingStandardize.applied += 1
+        super(CountingStandardize, self).apply(dataset, can_fit)
+
+
+def test_load_preprocessed():
+    """
+    Checks that the second load comes from the cache, with the same data
+    and a fitted preprocessor.
+    """
+    rng = np.random.RandomState(0)
+    X = rng.randn(20, 4).astype('float32') * 3 + 1
+    y = rng.randn(20, 1).astype('float32')
+    cache_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for i in range(2):
+            preprocessor = Pipeline([CountingStandardize(), ZCA()])
+            dataset = load_preprocessed(DenseDesignMatrix, preprocessor,
+                                        {'X': X, 'y': y}, can_fit=True,
+                                        cache_dir=cache_dir)
+            results.append((dataset, preprocessor))
+        assert CountingStandardize.applied == 1
+        (first, _), (second, preprocessor) = results
+        assert isinstance(second.X, np.memmap)
+        np.testing.assert_allclose(first.X, second.X)
+        np.testing.assert_allclose(first.y, second.y)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # The restored preprocessor is fitted, and applies to new data
+        test = load_preprocessed(DenseDesignMatrix, preprocessor,
+                                 {'X': X[:5]}, cache_dir=cache_dir)
+        np.testing.assert_allclose(test.X, first.X[:5], rtol=1e-5, atol=1e-5)
+        assert len(os.listdir(cache_dir)) == 2
+
+        # Different arguments give a different entry
+        load_preprocessed(DenseDesignMatrix,
+                          Pipeline([CountingStandardize(), ZCA()]),
+                          {'X': X[:10]}, can_fit=True, cache_dir=cache_dir)
+        assert CountingStandardize.applied == 3
+        assert len(os.listdir(cache_dir)) == 3
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_eviction():
+    """
+    Checks that the least recently used entries are evicted.
+    """
+    rng = np.random.RandomState(0)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = PreprocessedDatasetCache(cache_dir)
+        keys = []
+        for i in range(3):
+            kwargs = {'X': rng.randn(100, 10)}
+            keys.append(cache.key(DenseDesignMatrix, kwargs, Standardize(),
+                                  True))
+            cache.get(DenseDesignMatrix, Standardize(), kwargs, True)
+            # Make the modification times distinct
+            os.utime(os.path.join(cache_dir, keys[-1]), (i, i))
+        entry_size = sum(os.path.getsize(os.path.join(cache_dir, keys[0], f))
+                         for f in os.listdir(os.path.join(cache_dir,
+                                                          keys[0])))
+        assert cache.load(keys[0]) is not None
+        cache.max_size = int(2.5 * entry_size)
+        cache.evict()
+        assert sorted(os.listdir(cache_dir)) == sorted([keys[0], keys[2]])
+    finally:
+        shutil.rmtree(cache_dir)
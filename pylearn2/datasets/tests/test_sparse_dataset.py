@@ -3,7 +3,8 @@ Unit tests for ../sparse_dataset.py
 """
 
 import numpy as np
-from pylearn2.datasets.sparse_dataset import SparseDataset
+from nose.tools import assert_raises
+from pylearn2.datasets.sparse_dataset import SparseDataset, take_csr_rows
 from pylearn2.train import Train
 from pylearn2.models.model import Model
 from pylearn2.space import VectorSpace
@@ -138,6 +139,56 @@ def test_training_a_model():
 
     train.main_loop()
 
+
+def test_take_csr_rows():
+    """
+    Checks that take_csr_rows gathers the same rows as fancy indexing.
+    """
+    rng = np.random.RandomState([2014, 4, 22])
+    X = rng.binomial(1, 0.3, (50, 7)) * rng.randn(50, 7)
+    X[[3, 10]] = 0
+    x = csr_matrix(X)
+    for rows in [[3, 0, 10, 49, 3, -1], [], slice(5, 17), slice(45, 60),
+                 slice(None, None, 3)]:
+        batch = take_csr_rows(x, rows)
+        assert isinstance(batch, csr_matrix)
+        np.testing.assert_equal(batch.toarray(), X[rows])
+    assert_raises(IndexError, take_csr_rows, x, [50])
+
+
+def test_iterator_modes():
+    """
+    Checks that every iteration mode returns the requested rows, as
+    sparse or dense batches.
+    """
+    rng = np.random.RandomState([2014, 4, 22])
+    X = rng.binomial(1, 0.3, (20, 5)) * rng.randn(20, 5)
+    dense_specs = (VectorSpace(dim=5), 'features')
+    for mode in ['sequential', 'shuffled_sequential', 'random_slice',
+                 'random_uniform', 'even_sequential',
+                 'even_shuffled_sequential', 'block_shuffled_sequential']:
+        # Same rng, so that stochastic modes visit the same rows
+        ds, dense_ds = [SparseDataset(from_scipy_sparse_dataset=csr_matrix(X),
+                                      rng=0) for i in range(2)]
+        it = ds.iterator(mode=mode, batch_size=6, num_batches=3)
+        dense_it = dense_ds.iterator(mode=mode, batch_size=6, num_batches=3,
+                                     data_specs=dense_specs, num_buffers=2)
+        for batch, dense in zip(it, dense_it):
+            assert isinstance(batch, csr_matrix)
+            assert isinstance(dense, np.ndarray)
+            np.testing.assert_allclose(batch.toarray(), dense)
+            # Every row of the batch is a row of X
+            for row in dense:
+                assert np.any(np.all(np.isclose(X, row), axis=1))
+
+    # The buffers are reused, so the batches have to be copied
+    batches = [batch.copy() for batch in
+               ds.iterator(mode='shuffled_sequential', batch_size=6,
+                           data_specs=dense_specs, num_buffers=2)]
+    np.testing.assert_allclose(np.sort(np.concatenate(batches), axis=0),
+                               np.sort(X, axis=0))
+
+
 if __name__ == '__main__':
     test_iterator()
     test_training_a_model()
@@ -3,11 +3,20 @@ Unit tests for ../transformer_dataset.py
 """
 
 import os
+import shutil
+import tempfile
+
+import numpy as np
+import theano
+from nose.tools import assert_raises
+from theano import tensor
 
 import pylearn2
 from pylearn2.blocks import Block
 from pylearn2.datasets.csv_dataset import CSVDataset
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.datasets.transformer_dataset import TransformerDataset
+from pylearn2.space import CompositeSpace, VectorSpace
 
 
 def test_transformer_iterator():
@@ -25,3 +34,88 @@ def test_transformer_iterator():
         iter(iterator)
     except TypeError:
         assert False, "TransformerIterator isn't iterable"
+
+
+class CountingBlock(Block):
+    """
+    A linear Block counting how many times it is applied.
+    """
+    def __init__(self, W):
+        super(CountingBlock, self).__init__()
+        self.W = W
+        self.calls = 0
+
+    def __call__(self, inputs):
+        return tensor.dot(inputs, self.W)
+
+    def perform(self, X):
+        self.calls += 1
+        return super(CountingBlock, self).perform(X)
+
+    def get_input_space(self):
+        return VectorSpace(self.W.shape[0])
+
+    def get_output_space(self):
+        return VectorSpace(self.W.shape[1])
+
+
+def _make_dataset(**kwargs):
+    rng = np.random.RandomState(0)
+    X = rng.randn(10, 3).astype(theano.config.floatX)
+    y = rng.randn(10, 1).astype(theano.config.floatX)
+    W = rng.randn(3, 2).astype(theano.config.floatX)
+    raw = DenseDesignMatrix(X=X, y=y)
+    return TransformerDataset(raw, CountingBlock(W), **kwargs), X, y, W
+
+
+def test_transform_batches():
+    """
+    Checks that transforming several minibatches at once gives the same
+    batches with fewer calls to the transformer.
+    """
+    data_specs = (CompositeSpace((VectorSpace(2), VectorSpace(1))),
+                  ('features', 'targets'))
+    dataset, X, y, W = _make_dataset(transform_batches=3)
+    batches = list(dataset.iterator('sequential', 3, data_specs=data_specs))
+    assert len(batches) == 4
+    assert dataset.transformer.calls == 2
+    np.testing.assert_allclose(np.concatenate([b[0] for b in batches]),
+                               np.dot(X, W), rtol=1e-5)
+    np.testing.assert_allclose(np.concatenate([b[1] for b in batches]), y)
+    assert_raises(ValueError, dataset.iterator, 'sequential', 3,
+                  data_specs=data_specs, num_buffers=2)
+
+
+def test_cache():
+    """
+    Checks that the cached features are computed once and read by the
+    iterators afterwards, in memory and in a memmap.
+    """
+    data_specs = (CompositeSpace((VectorSpace(2), VectorSpace(1))),
+                  ('features', 'targets'))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for cache in ['memory', 'memmap']:
+            dataset, X, y, W = _make_dataset(
+                cache=cache, cache_chunk_size=4,
+                cache_path=os.path.join(tmp_dir, 'features.npy'))
+            for epoch in range(2):
+                for mode in ['sequential', 'shuffled_sequential']:
+                    seen = []
+                    for features, targets in dataset.iterator(
+                            mode, 3, data_specs=data_specs):
+                        for f, t in zip(features, targets):
+                            i = np.where(y[:, 0] == t[0])[0][0]
+                            np.testing.assert_allclose(f, np.dot(X[i], W),
+                                                       rtol=1e-5)
+                            seen.append(i)
+                    assert sorted(seen) == list(range(10))
+            # 10 examples in chunks of 4
+            assert dataset.transformer.calls == 3
+            dataset.clear_cache()
+            del features
+            dataset.iterator('sequential', 3, data_specs=data_specs).next()
+            assert dataset.transformer.calls == 6
+            del dataset
+    finally:
+        shutil.rmtree(tmp_dir)
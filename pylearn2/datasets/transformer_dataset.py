@@ -9,22 +9,35 @@ __license__ = "3-clause BSD"
 __maintainer__ = "LISA Lab"
 __email__ = "pylearn-dev@googlegroups"
 
+import collections
+import logging
+
+import numpy as np
 from theano.compat.six import Iterator
 
 from pylearn2.datasets.dataset import Dataset
-from pylearn2.space import CompositeSpace
+from pylearn2.space import CompositeSpace, Conv2DSpace
 from pylearn2.utils.data_specs import is_flat_specs
+from pylearn2.utils.iteration import (FiniteDatasetIterator,
+                                      resolve_iterator_class)
+from pylearn2.utils.rng import make_np_rng
 from pylearn2.utils import wraps
 
 
+log = logging.getLogger(__name__)
+
+
 class TransformerDataset(Dataset):
     """
     A dataset that applies a transformation on the fly
     as examples are requested.
     """
 
+    _default_seed = (17, 2, 946)
+
     def __init__(self, raw, transformer, cpu_only=False,
-                 space_preserving=False):
+                 space_preserving=False, transform_batches=1, cache=None,
+                 cache_path=None, cache_chunk_size=1024):
         """
             .. todo::
 
@@ -36,9 +49,186 @@ class TransformerDataset(Dataset):
                 Provides raw data
             transformer: pylearn2 Block
                 To transform the data
+            transform_batches : int, optional
+                Number of consecutive minibatches of `raw` that the
+                iterator concatenates and transforms with a single call
+                to the transformer, so that its (compiled) function runs
+                on large chunks rather than on every minibatch.
+            cache : None, 'memory' or 'memmap', optional
+                If not None, the transformer is assumed to be frozen:
+                the first time features are requested, the whole raw
+                dataset is transformed once (in chunks of
+                `cache_chunk_size` examples) and stored in memory or in
+                a memmap at `cache_path`. The iterators then read the
+                stored features instead of running the transformer,
+                e.g. so that layer-wise pretraining doesn't run all the
+                lower layers again on every epoch. Call `clear_cache`
+                if the transformer changes.
+            cache_path : str, optional
+                Path of the `.npy` file holding the memmapped features.
+                Required if `cache` is 'memmap'.
+            cache_chunk_size : int, optional
+                Number of examples transformed at once when filling the
+                cache.
         """
+        if transform_batches < 1:
+            raise ValueError("transform_batches must be at least 1, got %d"
+                             % transform_batches)
+        if cache not in (None, 'memory', 'memmap'):
+            raise ValueError("cache must be None, 'memory' or 'memmap', got "
+                             + str(cache))
+        if cache == 'memmap' and cache_path is None:
+            raise ValueError("cache_path is required when cache is 'memmap'")
         self.__dict__.update(locals())
         del self.self
+        self._cache = None
+        self.rng = make_np_rng(getattr(raw, 'rng', None), self._default_seed,
+                               which_method=['permutation', 'randint'])
+
+    def __getstate__(self):
+        """
+        Drops the cached features, they are recomputed when needed.
+        """
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Supports instances pickled before caching was added.
+        """
+        state.setdefault('transform_batches', 1)
+        state.setdefault('cache', None)
+        state.setdefault('cache_path', None)
+        state.setdefault('cache_chunk_size', 1024)
+        state.setdefault('_cache', None)
+        self.__dict__.update(state)
+
+    def _feature_spaces(self):
+        """
+        Returns the space in which the transformer reads the raw
+        features, and the space of the transformed features.
+        """
+        if self.space_preserving:
+            raw_space, raw_source = self.raw.get_data_specs()
+            if isinstance(raw_space, CompositeSpace):
+                raw_space = raw_space.components[
+                    tuple(raw_source).index('features')]
+            return raw_space, raw_space
+        return (self.transformer.get_input_space(),
+                self.transformer.get_output_space())
+
+    def get_data_specs(self):
+        """
+        Returns the data_specs of the transformed data: the features, in
+        the output space of the transformer, followed by the other
+        sources of the raw dataset.
+        """
+        raw_space, raw_source = self.raw.get_data_specs()
+        if isinstance(raw_space, CompositeSpace):
+            raw_spaces = tuple(raw_space.components)
+            raw_source = tuple(raw_source)
+        else:
+            raw_spaces = (raw_space,)
+            raw_source = (raw_source,)
+        feature_space = self._feature_spaces()[1]
+        if self._cache is not None:
+            feature_space = self._cache_space
+        spaces = (feature_space,) + tuple(
+            sp for sp, src in zip(raw_spaces, raw_source)
+            if src != 'features')
+        sources = ('features',) + tuple(src for src in raw_source
+                                        if src != 'features')
+        if len(sources) == 1:
+            return (spaces[0], sources[0])
+        return (CompositeSpace(spaces), sources)
+
+    def clear_cache(self):
+        """
+        Discards the cached features, e.g. after the transformer was
+        modified.
+        """
+        self._cache = None
+
+    def _fill_cache(self):
+        """
+        Transforms the whole raw dataset once and stores the result in
+        `self._cache`.
+        """
+        input_space, output_space = self._feature_spaces()
+        # Store the features with the batch axis first, so that they can
+        # be indexed by example
+        cache_space = output_space
+        if (isinstance(output_space, Conv2DSpace) and
+                output_space.axes[0] != 'b'):
+            cache_space = Conv2DSpace(output_space.shape,
+                                      num_channels=output_space.num_channels,
+                                      axes=('b', 0, 1, 'c'),
+                                      dtype=output_space.dtype)
+        num_examples = self.raw.get_num_examples()
+        iterator = self.raw.iterator(mode='sequential',
+                                     batch_size=self.cache_chunk_size,
+                                     data_specs=(input_space, 'features'))
+        cache = None
+        start = 0
+        log.info("Caching the transformed features of %d examples"
+                 % num_examples)
+        for batch in iterator:
+            rval = self.transformer.perform(batch)
+            if cache_space != output_space:
+                rval = output_space.np_format_as(rval, cache_space)
+            if cache is None:
+                shape = (num_examples,) + rval.shape[1:]
+                if self.cache == 'memmap':
+                    cache = np.lib.format.open_memmap(self.cache_path,
+                                                      mode='w+',
+                                                      dtype=rval.dtype,
+                                                      shape=shape)
+                else:
+                    cache = np.empty(shape, dtype=rval.dtype)
+            cache[start:start + rval.shape[0]] = rval
+            start += rval.shape[0]
+        assert start == num_examples
+        if self.cache == 'memmap':
+            cache.flush()
+        self._cache_space = cache_space
+        self._cache = cache
+
+    def _raw_data(self, source):
+        """
+        Returns all the data of a raw source other than 'features'.
+        """
+        raw_space, raw_source = self.raw.get_data_specs()
+        data = self.raw.get_data()
+        if not isinstance(raw_source, tuple):
+            raw_source = (raw_source,)
+            data = (data,)
+        return data[raw_source.index(source)]
+
+    def get(self, sources, indexes):
+        """
+        Retrieves the requested elements from the cached features and
+        the other raw sources. Only available if `cache` is not None.
+
+        Parameters
+        ----------
+        sources : tuple
+            A tuple of source identifiers
+        indexes : slice or list
+            A slice or a list of indexes
+
+        Returns
+        -------
+        rval : tuple
+            A tuple of batches, one for each source
+        """
+        if self.cache is None:
+            raise ValueError("get is only supported when cache is used")
+        if self._cache is None:
+            self._fill_cache()
+        return tuple(self._cache[indexes] if source == 'features'
+                     else self._raw_data(source)[indexes]
+                     for source in sources)
 
     def get_batch_design(self, batch_size, include_labels=False):
         """
@@ -65,7 +255,8 @@ class TransformerDataset(Dataset):
         return TransformerDataset(raw=self.raw.get_test_set(),
                                   transformer=self.transformer,
                                   cpu_only=self.cpu_only,
-                                  space_preserving=self.space_preserving)
+                                  space_preserving=self.space_preserving,
+                                  transform_batches=self.transform_batches)
 
     def get_batch_topo(self, batch_size):
         """
@@ -81,12 +272,25 @@ class TransformerDataset(Dataset):
 
     def iterator(self, mode=None, batch_size=None, num_batches=None,
                  rng=None, data_specs=None,
-                 return_tuple=False):
+                 return_tuple=False, prefetch=0, num_buffers=0):
         """
         .. todo::
 
             WRITEME
         """
+        if self.cache is not None:
+            return self._cached_iterator(mode, batch_size, num_batches, rng,
+                                         data_specs, return_tuple,
+                                         prefetch, num_buffers)
+
+        if num_buffers and num_buffers < self.transform_batches + prefetch:
+            raise ValueError("num_buffers (%d) must be at least "
+                             "transform_batches + prefetch (%d), otherwise "
+                             "raw batches would be overwritten before they "
+                             "are transformed"
+                             % (num_buffers, self.transform_batches +
+                                prefetch))
+
         # Build the right data_specs to query self.raw
         if data_specs is not None:
             assert is_flat_specs(data_specs)
@@ -127,13 +331,42 @@ class TransformerDataset(Dataset):
         raw_iterator = self.raw.iterator(
             mode=mode, batch_size=batch_size,
             num_batches=num_batches, rng=rng,
-            data_specs=raw_data_specs, return_tuple=return_tuple)
+            data_specs=raw_data_specs, return_tuple=return_tuple,
+            prefetch=prefetch, num_buffers=num_buffers)
 
         final_iterator = TransformerIterator(raw_iterator, self,
                                              data_specs=data_specs)
 
         return final_iterator
 
+    def _cached_iterator(self, mode, batch_size, num_batches, rng,
+                         data_specs, return_tuple, prefetch, num_buffers):
+        """
+        Iterator reading the cached features, see `iterator`.
+        """
+        if data_specs is None:
+            data_specs = self.get_data_specs()
+        assert is_flat_specs(data_specs)
+        source = data_specs[1]
+        if not isinstance(source, tuple):
+            source = (source,)
+        if 'features' in source and self._cache is None:
+            self._fill_cache()
+        if mode is None:
+            raise ValueError('iteration mode not provided for %s' % str(self))
+        mode = resolve_iterator_class(mode)
+        if rng is None and mode.stochastic:
+            rng = self.rng
+        return FiniteDatasetIterator(self,
+                                     mode(self.get_num_examples(),
+                                          batch_size,
+                                          num_batches,
+                                          rng),
+                                     data_specs=data_specs,
+                                     return_tuple=return_tuple,
+                                     prefetch=prefetch,
+                                     num_buffers=num_buffers)
+
     def has_targets(self):
         """
         .. todo::
@@ -204,6 +437,8 @@ class TransformerIterator(Iterator):
         self.stochastic = raw_iterator.stochastic
         self.uneven = raw_iterator.uneven
         self.data_specs = data_specs
+        # Transformed batches waiting to be returned
+        self._pending = collections.deque()
 
     def __iter__(self):
         """
@@ -219,8 +454,57 @@ class TransformerIterator(Iterator):
 
             WRITEME
         """
-        raw_batch = self.raw_iterator.next()
+        if self._pending:
+            return self._pending.popleft()
+
+        # Read several raw batches, to transform them together
+        raw_batches = []
+        for i in range(self.transformer_dataset.transform_batches):
+            try:
+                raw_batches.append(self.raw_iterator.next())
+            except StopIteration:
+                if not raw_batches:
+                    raise
+                break
+        if len(raw_batches) == 1:
+            return self._transform_batch(raw_batches[0])
+
+        tuples = isinstance(raw_batches[0], tuple)
+        features = [b[0] if tuples else b for b in raw_batches]
+        in_space = self._raw_feature_space()
+        chunk = np.concatenate(features, axis=in_space.get_batch_axis())
+        chunk = self._transform_batch((chunk,) if tuples else chunk)
+        if tuples:
+            chunk = chunk[0]
 
+        out_space = self.data_specs[0]
+        if isinstance(out_space, CompositeSpace):
+            out_space = out_space.components[0]
+        sizes = [in_space.np_batch_size(f) for f in features]
+        split = np.split(chunk, np.cumsum(sizes)[:-1],
+                         axis=out_space.get_batch_axis())
+        for transformed, raw_batch in zip(split, raw_batches):
+            if tuples:
+                self._pending.append((transformed,) + raw_batch[1:])
+            else:
+                self._pending.append(transformed)
+        return self._pending.popleft()
+
+    def _raw_feature_space(self):
+        """
+        Returns the space of the raw features read from `raw_iterator`.
+        """
+        if self.transformer_dataset.space_preserving:
+            space = self.data_specs[0]
+            if isinstance(space, CompositeSpace):
+                space = space.components[0]
+            return space
+        return self.transformer_dataset.transformer.get_input_space()
+
+    def _transform_batch(self, raw_batch):
+        """
+        Applies the transformer to the features of `raw_batch`.
+        """
         # Apply transformation on raw_batch, and format it
         # in the requested Space
         transformer = self.transformer_dataset.transformer
@@ -1,15 +1,17 @@
 """K-means as a postprocessing Block subclass."""
 
 import logging
+from multiprocessing.pool import ThreadPool
 import numpy
+import scipy.sparse
 from theano.compat.six.moves import xrange
 from pylearn2.blocks import Block
 from pylearn2.models.model import Model
 from pylearn2.space import VectorSpace
 from pylearn2.utils import sharedX
-from pylearn2.utils.mem import improve_memory_error_message
 from pylearn2.utils import wraps
 from pylearn2.utils import contains_nan
+from pylearn2.utils.rng import make_np_rng
 import warnings
 
 try:
@@ -22,6 +24,35 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Number of elements of the blocks of the distance matrix computed at once
+# when chunk_size is not specified
+_CHUNK_ELEMENTS = 2 ** 22
+
+
+def _squared_distances(X, mu, mu_sq=None):
+    """
+    Returns the matrix of squared euclidean distances between the rows of
+    `X` and the rows of `mu`, computed with a single matrix product.
+
+    Parameters
+    ----------
+    X : numpy.ndarray
+        Matrix of shape (n, m).
+    mu : numpy.ndarray
+        Matrix of shape (k, m).
+    mu_sq : numpy.ndarray, optional
+        The squared norms of the rows of `mu`, if already computed.
+    """
+    if mu_sq is None:
+        mu_sq = numpy.square(mu).sum(axis=1)
+    dists = numpy.dot(X, mu.T)
+    dists *= -2
+    dists += numpy.square(X).sum(axis=1)[:, numpy.newaxis]
+    dists += mu_sq
+    # Rounding errors may make the distances slightly negative
+    numpy.maximum(dists, 0, out=dists)
+    return dists
+
 
 class KMeans(Block, Model):
     """
@@ -38,13 +69,36 @@ class KMeans(Block, Model):
         Threshold of distance to clusters under which k-means stops
         iterating.
     max_iter : int, optional
-        Maximum number of iterations. Defaults to infinity.
+        Maximum number of iterations (epochs in mini-batch mode).
+        Defaults to infinity.
     verbose : bool
         WRITEME
+    init : str, optional
+        How the means are initialized when they are not given to
+        `train_all`: 'random' picks k random examples, 'kmeans++' uses
+        the k-means++ seeding (Arthur & Vassilvitskii, 2007), which
+        usually converges faster and to better solutions.
+    batch_size : int, optional
+        If specified, trains with mini-batch k-means (Sculley, 2010) on
+        batches of this size drawn from the dataset iterator, instead of
+        loading the whole design matrix. Each epoch moves every mean
+        towards the examples assigned to it with a learning rate
+        decreasing with the number of examples it was assigned.
+    chunk_size : int, optional
+        Number of examples whose distances to the means are computed at
+        once, bounding the memory used by the distance matrix. Defaults
+        to about 4M distances per chunk.
+    num_workers : int, optional
+        Number of threads computing the distances of different chunks in
+        parallel. The matrix products release the GIL.
+    seed : int or list of ints, optional
+        Seed of the random number generator used for the initialization
+        and the order of the mini-batches.
     """
 
     def __init__(self, k, nvis, convergence_th=1e-6, max_iter=None,
-                 verbose=False):
+                 verbose=False, init='random', batch_size=None,
+                 chunk_size=None, num_workers=1, seed=None):
         Block.__init__(self)
         Model.__init__(self)
 
@@ -62,6 +116,118 @@ class KMeans(Block, Model):
 
         self.verbose = verbose
 
+        if init not in ['random', 'kmeans++']:
+            raise ValueError("init must be 'random' or 'kmeans++', got %s"
+                             % str(init))
+        self.init = init
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size must be positive, got %s"
+                             % str(batch_size))
+        self.batch_size = batch_size
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("chunk_size must be positive, got %s"
+                             % str(chunk_size))
+        self.chunk_size = chunk_size
+        if num_workers < 1:
+            raise ValueError("num_workers must be positive, got %s"
+                             % str(num_workers))
+        self.num_workers = num_workers
+        self.seed = seed
+
+    def _chunks(self, n):
+        """
+        Returns the slices of the chunks of `n` examples.
+        """
+        chunk_size = getattr(self, 'chunk_size', None)
+        if chunk_size is None:
+            chunk_size = max(1, _CHUNK_ELEMENTS // self.k)
+        return [slice(start, min(start + chunk_size, n))
+                for start in xrange(0, n, chunk_size)]
+
+    def _assign(self, X, mu, pool=None):
+        """
+        Returns the index of the closest mean of each example, and the
+        squared distance to it, computing the distances by chunks.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Matrix of examples of shape (n, m).
+        mu : numpy.ndarray
+            Matrix of means of shape (k, m).
+        pool : ThreadPool, optional
+            If given, the chunks are processed by its threads.
+        """
+        n = X.shape[0]
+        inds = numpy.empty(n, dtype='int64')
+        min_dists = numpy.empty(n, dtype=X.dtype)
+        mu_sq = numpy.square(mu).sum(axis=1)
+
+        def assign_chunk(chunk):
+            dists = _squared_distances(X[chunk], mu, mu_sq)
+            inds[chunk] = dists.argmin(axis=1)
+            min_dists[chunk] = dists[numpy.arange(len(dists)), inds[chunk]]
+
+        chunks = self._chunks(n)
+        if pool is None or len(chunks) == 1:
+            for chunk in chunks:
+                assign_chunk(chunk)
+        else:
+            pool.map(assign_chunk, chunks)
+        return inds, min_dists
+
+    def _kmeans_plus_plus(self, X, rng, pool=None):
+        """
+        Returns k means chosen among the examples by greedy k-means++
+        seeding: candidates for each new mean are drawn with probability
+        proportional to the squared distance of the examples to the
+        closest mean already chosen, and the candidate reducing the
+        total squared distance the most is kept.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Matrix of examples of shape (n, m).
+        rng : numpy.random.RandomState
+            The random number generator.
+        pool : ThreadPool, optional
+            If given, the distances are computed by its threads.
+        """
+        n = X.shape[0]
+        mu = numpy.empty((self.k, X.shape[1]), dtype=X.dtype)
+        mu[0] = X[rng.randint(n)]
+        _, min_dists = self._assign(X, mu[:1], pool)
+        num_candidates = 2 + int(numpy.log(self.k))
+        for i in xrange(1, self.k):
+            cumulative = numpy.cumsum(min_dists, dtype='float64')
+            if cumulative[-1] > 0:
+                candidates = numpy.searchsorted(
+                    cumulative, rng.uniform(size=num_candidates) *
+                    cumulative[-1], side='right')
+                candidates = numpy.minimum(candidates, n - 1)
+            else:
+                # All the examples coincide with a mean
+                candidates = rng.randint(n, size=num_candidates)
+            best = None
+            for idx in candidates:
+                _, dists = self._assign(X, X[idx:idx + 1], pool)
+                numpy.minimum(min_dists, dists, out=dists)
+                potential = dists.sum(dtype='float64')
+                if best is None or potential < best[0]:
+                    best = (potential, idx, dists)
+            _, idx, min_dists = best
+            mu[i] = X[idx]
+        return mu
+
+    def _init_means(self, X, rng, pool=None):
+        """
+        Returns k initial means chosen among the examples of `X`.
+        """
+        if getattr(self, 'init', 'random') == 'kmeans++':
+            return self._kmeans_plus_plus(X, rng, pool)
+        indices = rng.randint(X.shape[0], size=self.k)
+        return X[indices]
+
     def train_all(self, dataset, mu=None):
         """
         Process kmeans algorithm on the input to localize clusters.
@@ -79,35 +245,60 @@ class KMeans(Block, Model):
 
         # TODO-- why does this sometimes return X and sometimes return nothing?
 
+        k = self.k
+        if mu is not None and not len(mu) == k:
+            raise Exception("You gave %i clusters"
+                            ", but k=%i were expected"
+                            % (len(mu), k))
+        rng = make_np_rng(getattr(self, 'seed', None), [2014, 8, 13],
+                          which_method=['randint', 'uniform'])
+        num_workers = getattr(self, 'num_workers', 1)
+        pool = ThreadPool(num_workers) if num_workers > 1 else None
+        try:
+            if getattr(self, 'batch_size', None) is not None:
+                mu = self._train_minibatch(dataset, mu, rng, pool)
+            else:
+                rval = self._train_full(dataset, mu, rng, pool)
+                if rval[0] is not None:
+                    return rval[0]
+                mu = rval[1]
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        self.mu = sharedX(mu)
+        self._params = [self.mu]
+
+    def _train_full(self, dataset, mu, rng, pool):
+        """
+        Runs k-means on the whole design matrix of `dataset`.
+
+        Returns
+        -------
+        rval : tuple
+            (X, None) if NaNs were found, (None, mu) otherwise.
+        """
         X = dataset.get_design_matrix()
 
         n, m = X.shape
         k = self.k
 
-        if milk is not None:
+        if (milk is not None and mu is None and
+                getattr(self, 'init', 'random') == 'random'):
             # use the milk implementation of k-means if it's available
             cluster_ids, mu = milk.kmeans(X, k)
         else:
             # our own implementation
 
-            # taking random inputs as initial clusters if user does not provide
-            # them.
-            if mu is not None:
-                if not len(mu) == k:
-                    raise Exception("You gave %i clusters"
-                                    ", but k=%i were expected"
-                                    % (len(mu), k))
-            else:
-                indices = numpy.random.randint(X.shape[0], size=k)
-                mu = X[indices]
+            # taking random inputs (or k-means++ seeds) as initial clusters
+            # if user does not provide them.
+            if mu is None:
+                mu = self._init_means(X, rng, pool)
+            mu = numpy.array(mu, dtype=X.dtype)
 
-            try:
-                dists = numpy.zeros((n, k))
-            except MemoryError as e:
-                improve_memory_error_message(e, "dying trying to allocate "
-                                                "dists matrix for {0} "
-                                                "examples and {1} "
-                                                "means".format(n, k))
+            # Entries of the assignment matrix summing the examples of each
+            # cluster, accumulated in float64
+            ones = numpy.ones(n)
 
             old_kills = {}
 
@@ -121,17 +312,14 @@ class KMeans(Block, Model):
                 # if numpy.sum(numpy.isnan(mu)) > 0:
                 if contains_nan(mu):
                     logger.info('nan found')
-                    return X
+                    return X, None
 
-                # computing distances
-                for i in xrange(k):
-                    dists[:, i] = numpy.square((X - mu[i, :])).sum(axis=1)
+                # computing distances and finding minimum distances
+                min_dist_inds, min_dists = self._assign(X, mu, pool)
 
                 if iter > 0:
                     prev_mmd = mmd
 
-                min_dists = dists.min(axis=1)
-
                 # mean minimum distance:
                 mmd = min_dists.mean()
 
@@ -142,56 +330,127 @@ class KMeans(Block, Model):
                     # converged
                     break
 
-                # finding minimum distances
-                min_dist_inds = dists.argmin(axis=1)
+                # computing means: sums of the examples of each cluster,
+                # with a sparse assignment matrix
+                counts = numpy.bincount(min_dist_inds, minlength=k)
+                assignment = scipy.sparse.csr_matrix(
+                    (ones, (min_dist_inds, numpy.arange(n))), shape=(k, n))
+                nonempty = counts > 0
+                sums = assignment.dot(X)
+                mu[nonempty] = sums[nonempty] / counts[nonempty, numpy.newaxis]
+                if contains_nan(mu):
+                    logger.info('nan found')
+                    return X, None
 
-                # computing means
-                i = 0
                 blacklist = []
                 new_kills = {}
-                while i < k:
-                    b = min_dist_inds == i
-                    if not numpy.any(b):
-                        killed_on_prev_iter = True
-                        # initializes empty cluster to be the mean of the d
-                        # data points farthest from their corresponding means
-                        if i in old_kills:
-                            d = old_kills[i] - 1
-                            if d == 0:
-                                d = 50
-                            new_kills[i] = d
-                        else:
-                            d = 5
-                        mu[i, :] = 0
-                        for j in xrange(d):
-                            idx = numpy.argmax(min_dists)
-                            min_dists[idx] = 0
-                            # chose point idx
-                            mu[i, :] += X[idx, :]
-                            blacklist.append(idx)
-                        mu[i, :] /= float(d)
-                        # cluster i was empty, reset it to d far out data
-                        # points recomputing distances for this cluster
-                        dists[:, i] = numpy.square((X - mu[i, :])).sum(axis=1)
-                        min_dists = dists.min(axis=1)
-                        for idx in blacklist:
-                            min_dists[idx] = 0
-                        min_dist_inds = dists.argmin(axis=1)
-                        # done
-                        i += 1
+                true_min_dists = min_dists.copy()
+                for i in numpy.flatnonzero(~nonempty):
+                    # initializes empty cluster to be the mean of the d
+                    # data points farthest from their corresponding means
+                    if i in old_kills:
+                        d = old_kills[i] - 1
+                        if d == 0:
+                            d = 50
+                        new_kills[i] = d
                     else:
-                        mu[i, :] = numpy.mean(X[b, :], axis=0)
-                        if contains_nan(mu):
-                            logger.info('nan found at {0}'.format(i))
-                            return X
-                        i += 1
+                        d = 5
+                    mu[i, :] = 0
+                    for j in xrange(d):
+                        idx = numpy.argmax(min_dists)
+                        min_dists[idx] = 0
+                        # chose point idx
+                        mu[i, :] += X[idx, :]
+                        blacklist.append(idx)
+                    mu[i, :] /= float(d)
+                    # cluster i was empty, reset it to d far out data
+                    # points recomputing distances for this cluster
+                    _, dists = self._assign(X, mu[i:i + 1], pool)
+                    numpy.minimum(true_min_dists, dists, out=true_min_dists)
+                    min_dists = true_min_dists.copy()
+                    min_dists[blacklist] = 0
 
                 old_kills = new_kills
 
                 iter += 1
 
-        self.mu = sharedX(mu)
-        self._params = [self.mu]
+        return None, mu
+
+    def _train_minibatch(self, dataset, mu, rng, pool):
+        """
+        Runs mini-batch k-means on batches of `self.batch_size` examples
+        drawn from the iterator of `dataset`.
+
+        Returns
+        -------
+        mu : numpy.ndarray
+            The means.
+        """
+        k = self.k
+        data_specs = (self.input_space, 'features')
+
+        def batches():
+            return dataset.iterator(mode='shuffled_sequential',
+                                    batch_size=self.batch_size,
+                                    data_specs=data_specs,
+                                    return_tuple=False, rng=rng)
+
+        if mu is None:
+            # Initialize the means on the first batches, with at least
+            # three examples per mean
+            sample = []
+            num_examples = 0
+            for X in batches():
+                sample.append(X)
+                num_examples += len(X)
+                if num_examples >= 3 * k:
+                    break
+            mu = self._init_means(numpy.concatenate(sample), rng, pool)
+        mu = numpy.array(mu, dtype='float64')
+        # Number of examples assigned to each mean so far
+        seen = numpy.zeros(k)
+
+        epoch = 0
+        mmd = prev_mmd = float('inf')
+        while True:
+            if self.verbose:
+                logger.info('mini-batch kmeans epoch {0}'.format(epoch))
+            total = 0.
+            num_examples = 0
+            for X in batches():
+                inds, min_dists = self._assign(X, mu.astype(X.dtype), pool)
+                total += min_dists.sum()
+                num_examples += len(X)
+                counts = numpy.bincount(inds, minlength=k)
+                sums = scipy.sparse.csr_matrix(
+                    (numpy.ones(len(X)), (inds, numpy.arange(len(X)))),
+                    shape=(k, len(X))).dot(X)
+                seen += counts
+                # Equivalent to moving mu[i] towards each of its examples
+                # in turn with a learning rate of 1 / seen[i]
+                nonempty = counts > 0
+                mu[nonempty] += ((sums[nonempty] -
+                                  counts[nonempty, numpy.newaxis] *
+                                  mu[nonempty]) /
+                                 seen[nonempty, numpy.newaxis])
+            if contains_nan(mu):
+                raise RuntimeError("NaN found in the means of mini-batch "
+                                   "k-means")
+            # Means that were never assigned an example are moved to the
+            # examples of the last batch that are farthest from their mean
+            empty = numpy.flatnonzero(seen == 0)
+            if len(empty) > 0:
+                far = numpy.argsort(-min_dists)[:len(empty)]
+                mu[empty[:len(far)]] = X[far]
+
+            prev_mmd = mmd
+            mmd = total / num_examples
+            logger.info('cost: {0}'.format(mmd))
+            epoch += 1
+            if epoch >= self.max_iter or abs(mmd - prev_mmd) < \
+                    self.convergence_th:
+                break
+        return mu
 
     @wraps(Model.continue_learning)
     def continue_learning(self):
@@ -226,12 +485,10 @@ class KMeans(Block, Model):
         -------
         WRITEME
         """
-        n, m = X.shape
-        k = self.k
         mu = self.mu
-        dists = numpy.zeros((n, k))
-        for i in xrange(k):
-            dists[:, i] = numpy.square((X - mu[i, :])).sum(axis=1)
+        if hasattr(mu, 'get_value'):
+            mu = mu.get_value()
+        dists = _squared_distances(X, mu)
         return dists / dists.sum(axis=1).reshape(-1, 1)
 
     def get_weights(self):
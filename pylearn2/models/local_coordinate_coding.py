@@ -27,16 +27,30 @@ class LocalCoordinateCoding(object):
     nvis : WRITEME
     nhid : WRITEME
     coeff : WRITEME
+    top_k : int, optional
+        If given, the code of each example may only use its `top_k`
+        nearest dictionary rows (anchors).
+    num_workers : int, optional
+        Number of processes the encoding is split across.
     """
 
-    def __init__(self, nvis, nhid, coeff):
+    def __init__(self, nvis, nhid, coeff, top_k=None, num_workers=1):
         self.nvis = nvis
         self.nhid = nhid
         self.coeff = float(coeff)
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be positive, got %d" % top_k)
+        self.top_k = top_k
+        self.num_workers = num_workers
         self.rng = make_np_rng(None, [1, 2, 3], which_method="randn")
 
         self.redo_everything()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_train_functions', None)
+        return state
+
     def get_output_channels(self):
         """
         .. todo::
@@ -53,6 +67,7 @@ class LocalCoordinateCoding(object):
         """
         self.W = shared(self.rng.randn(self.nhid, self.nvis), name='W')
         self.W.T.name = 'W.T'
+        self._train_functions = None
 
     def weights_format(self):
         """
@@ -62,40 +77,88 @@ class LocalCoordinateCoding(object):
         """
         return ['h', 'v']
 
+    def anchor_distances(self, X):
+        """
+        Returns the squared distances between the examples and the
+        dictionary rows, computed with a single matrix product.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Design matrix of examples.
+
+        Returns
+        -------
+        dists : numpy.ndarray
+            Matrix of shape (X.shape[0], nhid).
+        """
+        W = self.W.get_value(borrow=True)
+        dists = N.dot(X, W.T)
+        dists *= -2.
+        dists += N.square(X).sum(axis=1)[:, N.newaxis]
+        dists += N.square(W).sum(axis=1)
+        # Rounding errors can make the distance to a very close anchor
+        # negative.
+        N.maximum(dists, 0., out=dists)
+        return dists
+
+    def encode(self, X, batch_size=1000):
+        """
+        Computes the codes of a design matrix of examples.
+
+        The code of an example minimizes the reconstruction error plus
+        `coeff` times the sum of the absolute values of the coefficients,
+        each weighted by the squared distance to its anchor. This is a
+        weighted L1 problem on the dictionary shared by all the examples,
+        so the codes are found by a batched feature sign search.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Design matrix of examples.
+        batch_size : int, optional
+            Number of examples whose distances and codes are computed
+            together.
+
+        Returns
+        -------
+        gamma : numpy.ndarray
+            Matrix of shape (X.shape[0], nhid) containing the codes.
+        """
+        W = self.W.get_value(borrow=True)
+        X = N.asarray(X, dtype=W.dtype)
+        assert X.ndim == 2 and X.shape[1] == self.nvis
+        top_k = getattr(self, 'top_k', None)
+        weights = N.empty((X.shape[0], self.nhid), dtype=W.dtype)
+        for start in xrange(0, X.shape[0], batch_size):
+            stop = min(start + batch_size, X.shape[0])
+            c = 1e-10 + self.anchor_distances(X[start:stop])
+            if top_k is not None and top_k < self.nhid:
+                far = N.argpartition(c, top_k - 1, axis=1)[:, top_k:]
+                c[N.arange(stop - start)[:, N.newaxis], far] = N.inf
+            weights[start:stop] = self.coeff * c
+        return feature_sign_search(W.T, X, weights, batch_size=batch_size,
+                                   num_workers=getattr(self, 'num_workers',
+                                                       1))
+
     def optimize_gamma(self, example):
         """
         .. todo::
 
             WRITEME
         """
+        return self.encode(N.reshape(example, (1, self.nvis)))[0]
 
-        #variable names chosen to follow the arguments to l1ls_featuresign
-
-        Y = N.zeros((self.nvis,))
-        Y[:] = example
-        c = (1e-10 + N.square(self.W.get_value(borrow=True) -
-                              example).sum(axis=1))
-        A = self.W.get_value(borrow=True).T / c
-        x = feature_sign_search(A, Y, self.coeff)
-        g = x / c
-        return g
-
-    def train_batch(self, dataset, batch_size):
+    def _get_train_functions(self):
         """
-        .. todo::
-
-            WRITEME
+        Returns the functions optimizing W and computing the objective
+        on a batch, compiling them the first time.
         """
-        #TODO-- this results in compilation happening every time learn is
-        # called should cache the compilation results, including those
-        # inside cg
-        X = dataset.get_design_matrix()
-        m = X.shape[0]
-        assert X.shape[1] == self.nvis
+        if getattr(self, '_train_functions', None) is not None:
+            return self._train_functions
 
-        gamma = N.zeros((batch_size, self.nhid))
-        cur_gamma = T.vector(name='cur_gamma')
-        cur_v = T.vector(name='cur_v')
+        cur_gamma = T.matrix(name='cur_gamma')
+        cur_v = T.matrix(name='cur_v')
         recons = T.dot(cur_gamma, self.W)
         recons.name = 'recons'
 
@@ -108,39 +171,52 @@ class LocalCoordinateCoding(object):
         recons_error = T.sum(recons_diff_sq)
         recons_error.name = 'recons_error'
 
-        dict_dists = T.sum(T.sqr(self.W - cur_v), axis=1)
+        dict_dists = (T.sqr(cur_v).sum(axis=1).dimshuffle(0, 'x') +
+                      T.sqr(self.W).sum(axis=1).dimshuffle('x', 0) -
+                      2. * T.dot(cur_v, self.W.T))
         dict_dists.name = 'dict_dists'
 
         abs_gamma = abs(cur_gamma)
         abs_gamma.name = 'abs_gamma'
 
-        weighted_dists = T.dot(abs_gamma, dict_dists)
+        weighted_dists = T.sum(abs_gamma * dict_dists)
         weighted_dists.name = 'weighted_dists'
 
         penalty = self.coeff * weighted_dists
         penalty.name = 'penalty'
 
         #prevent directions of absolute flatness in the hessian
-        #W_sq = T.sqr(self.W)
-        #W_sq.name = 'W_sq'
-        #debug =  T.sum(W_sq)
         debug = 1e-10 * T.sum(dict_dists)
         debug.name = 'debug'
 
-        #J = debug
         J = recons_error + penalty + debug
         J.name = 'J'
 
+        new_W, = cg.linear_cg(J, [self.W], max_iters=3)
+
+        optimize_W = function([cur_v, cur_gamma], [],
+                              updates=[(self.W, new_W)])
         Jf = function([cur_v, cur_gamma], J)
+        self._train_functions = (optimize_W, Jf)
+        return self._train_functions
+
+    def train_batch(self, dataset, batch_size):
+        """
+        .. todo::
+
+            WRITEME
+        """
+        X = dataset.get_design_matrix()
+        m = X.shape[0]
+        assert X.shape[1] == self.nvis
+
+        optimize_W, Jf = self._get_train_functions()
 
         start = self.rng.randint(m - batch_size + 1)
-        batch_X = X[start:start + batch_size, :]
+        batch_X = N.cast[self.W.dtype](X[start:start + batch_size, :])
 
-        #TODO-- optimize gamma
         logger.info('optimizing gamma')
-        for i in xrange(batch_size):
-            #print str(i+1)+'/'+str(batch_size)
-            gamma[i, :] = self.optimize_gamma(batch_X[i, :])
+        gamma = self.encode(batch_X)
 
         logger.info('max min')
         logger.info(N.abs(gamma).min(axis=0).max())
@@ -149,14 +225,9 @@ class LocalCoordinateCoding(object):
 
         #Optimize W
         logger.info('optimizing W')
-        logger.warning("not tested since switching to Razvan's all-theano "
-                       "implementation of linear cg")
-        cg.linear_cg(J, [self.W], max_iters=3)
-
-        err = 0.
+        optimize_W(batch_X, gamma)
 
-        for i in xrange(batch_size):
-            err += Jf(batch_X[i, :], gamma[i, :])
+        err = Jf(batch_X, gamma)
         assert not N.isnan(err)
         assert not N.isinf(err)
         logger.info('err: {0}'.format(err))
@@ -53,6 +53,8 @@ except ImportError:
 # Local imports
 from pylearn2.blocks import Block
 from pylearn2.utils import sharedX
+from pylearn2.utils.rng import make_np_rng
+from pylearn2.space import VectorSpace
 
 
 logger = logging.getLogger()
@@ -125,13 +127,38 @@ class _PCABase(Block):
 
         # Compute eigen{values,vectors} of the covariance matrix.
         v, W = self._cov_eigen(X)
+        self._set_components(v, W, mean)
+
+    def _set_components(self, v, W, mean):
+        """
+        Stores the eigen{values,vectors} of the covariance matrix and the
+        feature means, and keeps only the wanted components.
+
+        Parameters
+        ----------
+        v : numpy.ndarray
+            Eigenvalues, in decreasing order
+        W : numpy.ndarray
+            Matrix containing the corresponding eigenvectors in its columns
+        mean : numpy.ndarray
+            Feature means of shape (d,)
+        """
+        if self.num_components is None:
+            self.num_components = W.shape[0]
 
         # Build Theano shared variables
         # For the moment, I do not use borrow=True because W and v are
         # subtensors, and I want the original memory to be freed
-        self.W = sharedX(W, name='W')
-        self.v = sharedX(v, name='v')
-        self.mean = sharedX(mean, name='mean')
+        # Reuse the shared variables if there are already components, so
+        # that functions compiled from this block see the new ones
+        if self.W is None:
+            self.W = sharedX(W, name='W')
+            self.v = sharedX(v, name='v')
+            self.mean = sharedX(mean, name='mean')
+        else:
+            self.W.set_value(numpy.asarray(W, dtype=self.W.dtype))
+            self.v.set_value(numpy.asarray(v, dtype=self.v.dtype))
+            self.mean.set_value(numpy.asarray(mean, dtype=self.mean.dtype))
 
         # Filter out unwanted components, permanently.
         self._update_cutoff()
@@ -474,11 +501,43 @@ class CovEigPCA(_PCABase):
         -------
         WRITEME
         """
-        v, W = linalg.eigh(self.cov(X.T))
+        return self._covariance_eigen(self.cov(X.T))
+
+    @staticmethod
+    def _covariance_eigen(covariance):
+        """
+        Eigen{values,vectors} of a covariance matrix, in decreasing order.
+
+        Parameters
+        ----------
+        covariance : numpy.ndarray
+            Covariance matrix of shape (d, d)
+
+        Returns
+        -------
+        WRITEME
+        """
+        v, W = linalg.eigh(covariance)
         # The resulting components are in *ascending* order of eigenvalue, and
         # W contains eigenvectors in its *columns*, so we simply reverse both.
         return v[::-1], W[:, ::-1]
 
+    def train_from_covariance(self, covariance, mean):
+        """
+        Compute the PCA transformation matrix from a covariance matrix that
+        was already estimated, e.g. by accumulating it over chunks of a
+        dataset that does not fit in memory.
+
+        Parameters
+        ----------
+        covariance : numpy.ndarray
+            Covariance matrix of shape (d, d)
+        mean : numpy.ndarray
+            Feature means of shape (d,)
+        """
+        v, W = self._covariance_eigen(covariance)
+        self._set_components(v, W, mean)
+
 
 class SVDPCA(_PCABase):
     """
@@ -508,6 +567,224 @@ class SVDPCA(_PCABase):
         return s ** 2, Vh.T
 
 
+class RandomizedPCA(_PCABase):
+    """
+    Computes the leading components with a randomized SVD (Halko, Martinsson
+    and Tropp, 2011), without forming the covariance matrix or the full SVD
+    of the data.
+
+    The range of the data is sampled by projecting it on
+    `num_components + oversampling` random directions, refined by a few
+    power iterations, and the small matrix obtained by projecting the data
+    on this range is decomposed exactly. The cost is linear in the number
+    of features, which makes it suitable for wide data when only the top
+    components are needed.
+
+    Parameters
+    ----------
+    oversampling : int, optional
+        Number of random directions sampled in addition to
+        `num_components`.
+    n_iter : int, optional
+        Number of power iterations. More iterations give more accurate
+        components when the spectrum decays slowly.
+    seed : int or RandomState, optional
+        Seed of the random projections.
+    kwargs : dict
+        Passed on to `_PCABase`. `num_components` should be given, since
+        all the components are computed otherwise.
+
+    Notes
+    -----
+    Only the leading components are computed, so `min_variance` is
+    relative to the variance they explain rather than to the total
+    variance.
+    """
+
+    def __init__(self, oversampling=10, n_iter=2, seed=None, **kwargs):
+        super(RandomizedPCA, self).__init__(**kwargs)
+        self.oversampling = oversampling
+        self.n_iter = n_iter
+        self.rng = make_np_rng(seed, [2015, 3, 19],
+                               which_method='normal')
+
+    @staticmethod
+    def _orthonormalize(Y):
+        """
+        Returns an orthonormal basis of the columns of `Y`.
+        """
+        Q, _ = linalg.qr(Y, mode='economic', overwrite_a=True)
+        return Q
+
+    def _cov_eigen(self, X):
+        """
+        Compute the leading eigen{values,vectors} of X's covariance matrix
+        by randomized SVD.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Centered matrix of shape (n, d)
+
+        Returns
+        -------
+        The leading eigenvalues in decreasing order and a matrix containing
+        the corresponding eigenvectors in its columns
+        """
+        n, d = X.shape
+        k = min(self.num_components, n, d)
+        rank = min(k + self.oversampling, n, d)
+        dtype = X.dtype if X.dtype.kind == 'f' else 'float64'
+
+        omega = self.rng.normal(size=(d, rank)).astype(dtype)
+        Q = self._orthonormalize(N.dot(X, omega))
+        for i in xrange(self.n_iter):
+            # Orthonormalize between the products to keep the small
+            # singular values from being lost to rounding
+            Q = self._orthonormalize(N.dot(X.T, Q))
+            Q = self._orthonormalize(N.dot(X, Q))
+
+        # Q spans the range of X, so X ~= Q B with B small
+        B = N.dot(Q.T, X)
+        _, s, Vh = linalg.svd(B, full_matrices=False)
+        # Scale the squared singular values like numpy.cov
+        return s[:k] ** 2 / max(n - 1, 1), Vh[:k].T
+
+
+class IncrementalPCA(_PCABase):
+    """
+    PCA fitted one minibatch at a time (Ross et al., 2008), for datasets
+    that don't fit in memory.
+
+    Only the mean, the leading singular values and the corresponding right
+    singular vectors of the data seen so far are kept. Each call to
+    `partial_fit` stacks them with the new centered minibatch and a row
+    correcting for the change of mean, and takes the SVD of this small
+    matrix, so that memory and time per minibatch are linear in the number
+    of features.
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        Size of the minibatches used by `train` and `train_dataset`. It
+        should be at least `num_components`.
+    kwargs : dict
+        Passed on to `_PCABase`. `num_components` should be given, since
+        all the components are kept otherwise.
+    """
+
+    def __init__(self, batch_size=1000, **kwargs):
+        super(IncrementalPCA, self).__init__(**kwargs)
+        self.batch_size = batch_size
+        self.n_samples_seen = 0
+        self._mean = None
+        self._singular_values = None
+        self._components = None
+
+    def partial_fit(self, X):
+        """
+        Updates the components with a minibatch.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Minibatch of shape (n, d)
+        """
+        X = N.asarray(X, dtype='float64')
+        n, d = X.shape
+        if n == 0:
+            return
+        if self.num_components is None:
+            self.num_components = d
+        if self._mean is not None and self._mean.shape[0] != d:
+            raise ValueError("Minibatch has %d features, but the previous "
+                             "ones had %d" % (d, self._mean.shape[0]))
+
+        batch_mean = X.mean(axis=0)
+        if self._mean is None:
+            mean = batch_mean
+            stacked = X - batch_mean
+        else:
+            n_old = self.n_samples_seen
+            n_total = n_old + n
+            mean = (self._mean +
+                    (batch_mean - self._mean) * (float(n) / n_total))
+            # The last row accounts for the difference between the mean of
+            # the previous data and the mean of the minibatch
+            correction = (N.sqrt(float(n_old) * n / n_total) *
+                          (self._mean - batch_mean))
+            stacked = N.vstack((self._singular_values[:, None] *
+                                self._components,
+                                X - batch_mean,
+                                correction))
+        _, s, Vh = linalg.svd(stacked, full_matrices=False)
+
+        k = self.num_components
+        self.n_samples_seen += n
+        self._mean = mean
+        self._singular_values = s[:k]
+        self._components = Vh[:k]
+        self._publish()
+
+    def _publish(self):
+        """
+        Sets the components used for projecting from the current estimates,
+        leaving the estimates intact for later updates.
+        """
+        n = self.n_samples_seen
+        v = self._singular_values ** 2 / max(n - 1, 1)
+        self._set_components(v, self._components.T, self._mean)
+
+    def train(self, X, mean=None):
+        """
+        Fits the PCA on `X`, one minibatch of `batch_size` examples at a
+        time. Components fitted earlier are updated rather than replaced.
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Matrix of shape (n, d) on which to train PCA. It can be a
+            memory-mapped array.
+        mean : None
+            Not supported: the mean is estimated along with the
+            components.
+        """
+        if mean is not None:
+            raise ValueError("IncrementalPCA estimates the mean itself, "
+                             "it can't be given to train")
+        for i in xrange(0, X.shape[0], self.batch_size):
+            self.partial_fit(X[i:i + self.batch_size])
+
+    def train_dataset(self, dataset, data_specs=None):
+        """
+        Fits the PCA on the minibatches of `batch_size` examples drawn from
+        the iterator of `dataset`, so the dataset never needs to be loaded
+        as a whole.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to fit
+        data_specs : tuple, optional
+            Data specs of the features, whose space must be a
+            `VectorSpace`. By default, the features of `dataset.X_space`
+            are flattened.
+        """
+        if data_specs is None:
+            space = getattr(dataset, 'X_space', None)
+            if space is None:
+                raise ValueError("%s has no X_space, data_specs must be "
+                                 "given" % str(type(dataset)))
+            data_specs = (VectorSpace(dim=space.get_total_dimension()),
+                          'features')
+        iterator = dataset.iterator(mode='sequential',
+                                    batch_size=self.batch_size,
+                                    data_specs=data_specs,
+                                    return_tuple=False)
+        for X in iterator:
+            self.partial_fit(X)
+
+
 class SparsePCA(_PCABase):
     """
     .. todo::
@@ -833,7 +1110,8 @@ if __name__ == "__main__":
                         help='File where the PCA pickle will be saved')
     parser.add_argument('-a', '--algorithm', action='store',
                         type=str,
-                        choices=['cov_eig', 'svd', 'online'],
+                        choices=['cov_eig', 'svd', 'online', 'randomized',
+                                 'incremental'],
                         default='cov_eig',
                         required=False,
                         help='Which algorithm to use to compute the PCA')
@@ -841,7 +1119,8 @@ if __name__ == "__main__":
                         type=int,
                         default=500,
                         required=False,
-                        help='Size of minibatches used in online algorithm')
+                        help='Size of minibatches used in online and '
+                             'incremental algorithms')
     parser.add_argument('-n', '--num-components', action='store',
                         type=int,
                         default=None,
@@ -883,6 +1162,11 @@ if __name__ == "__main__":
     elif args.algorithm == 'online':
         PCAImpl = OnlinePCA
         conf['minibatch_size'] = args.minibatch_size
+    elif args.algorithm == 'randomized':
+        PCAImpl = RandomizedPCA
+    elif args.algorithm == 'incremental':
+        PCAImpl = IncrementalPCA
+        conf['batch_size'] = args.minibatch_size
     else:
         # This should never happen.
         raise NotImplementedError(args.algorithm)
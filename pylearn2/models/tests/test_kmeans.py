@@ -26,3 +26,52 @@ def test_kmeans():
 
     train = Train(model=model, dataset=dataset)
     train.main_loop()
+
+
+def _blobs(rng, k=4, n=400, dim=5):
+    """
+    Returns n examples drawn around k well-separated centers.
+    """
+    centers = rng.normal(scale=10., size=(k, dim))
+    labels = rng.randint(k, size=n)
+    X = centers[labels] + rng.normal(size=(n, dim))
+    return X.astype('float32'), centers
+
+
+def _matches(mu, centers, atol):
+    """
+    Returns True if each center has a mean within atol of it.
+    """
+    dists = np.sqrt(np.square(mu[:, np.newaxis] - centers).sum(axis=2))
+    return np.all(dists.min(axis=0) < atol)
+
+
+def test_kmeans_plus_plus():
+    """
+    Tests that k-means++ seeding with chunked, multithreaded distances
+    recovers well-separated clusters.
+    """
+    rng = np.random.RandomState(0)
+    X, centers = _blobs(rng)
+    model = KMeans(k=4, nvis=5, init='kmeans++', chunk_size=37,
+                   num_workers=3, seed=1)
+    model.train_all(DenseDesignMatrix(X))
+    mu = model.get_params()[0].get_value()
+    assert _matches(mu, centers, 0.5)
+
+    # The probabilities are proportional to the distances
+    dists = np.square(X[:, np.newaxis] - mu).sum(axis=2)
+    np.testing.assert_allclose(model(X), dists / dists.sum(axis=1)[:, None],
+                               rtol=1e-3)
+
+
+def test_minibatch_kmeans():
+    """
+    Tests that mini-batch k-means recovers well-separated clusters.
+    """
+    rng = np.random.RandomState(0)
+    X, centers = _blobs(rng, n=2000)
+    model = KMeans(k=4, nvis=5, init='kmeans++', batch_size=100,
+                   max_iter=5, seed=1)
+    model.train_all(DenseDesignMatrix(X))
+    assert _matches(model.get_params()[0].get_value(), centers, 0.5)
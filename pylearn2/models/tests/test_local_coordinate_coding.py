@@ -0,0 +1,61 @@
+"""
+Tests for pylearn2.models.local_coordinate_coding
+"""
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.models.local_coordinate_coding import LocalCoordinateCoding
+from pylearn2.optimization.feature_sign import feature_sign_search
+from pylearn2.utils import serial
+
+
+def test_encode():
+    """
+    Checks that the batched encoding matches encoding each example
+    against its distance-scaled dictionary.
+    """
+    rng = np.random.RandomState([1, 2, 3])
+    X = rng.randn(20, 5)
+    model = LocalCoordinateCoding(nvis=5, nhid=12, coeff=1.)
+    W = model.W.get_value()
+    gamma = model.encode(X, batch_size=7)
+    for example, code in zip(X, gamma):
+        c = 1e-10 + np.square(W - example).sum(axis=1)
+        expected = feature_sign_search(W.T / c, example, model.coeff) / c
+        assert np.allclose(code, expected)
+    assert np.allclose(model.optimize_gamma(X[0]), gamma[0])
+
+
+def test_encode_top_k():
+    """
+    Checks that the codes only use the top_k nearest anchors.
+    """
+    rng = np.random.RandomState([1, 2, 3])
+    X = rng.randn(20, 5)
+    model = LocalCoordinateCoding(nvis=5, nhid=12, coeff=.1, top_k=3)
+    gamma = model.encode(X)
+    nearest = np.argsort(model.anchor_distances(X), axis=1)[:, :3]
+    for code, anchors in zip(gamma, nearest):
+        assert set(np.flatnonzero(code)) <= set(anchors)
+
+
+def test_train_batch():
+    """
+    Checks that the training functions are compiled once, and that
+    optimizing W decreases the objective.
+    """
+    rng = np.random.RandomState([1, 2, 3])
+    X = rng.randn(30, 5)
+    model = LocalCoordinateCoding(nvis=5, nhid=12, coeff=1.)
+    model.train_batch(DenseDesignMatrix(X=X), 10)
+    optimize_W, Jf = model._get_train_functions()
+    model.train_batch(DenseDesignMatrix(X=X), 10)
+    assert model._get_train_functions()[0] is optimize_W
+
+    gamma = model.encode(X)
+    before = Jf(X, gamma)
+    optimize_W(X, gamma)
+    assert Jf(X, gamma) < before
+
+    model = serial.from_string(serial.to_string(model))
+    assert model._get_train_functions()[0] is not optimize_W
@@ -0,0 +1,80 @@
+"""
+Tests of ../pca.py
+"""
+
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.models.pca import CovEigPCA, IncrementalPCA, RandomizedPCA
+
+
+def _low_rank_data(rng, n=500, d=40, k=5):
+    """
+    Returns data with `k` dominant directions plus a little noise.
+    """
+    scales = np.linspace(10, 5, k)
+    latent = rng.normal(size=(n, k)) * scales
+    basis = np.linalg.qr(rng.normal(size=(d, k)))[0].T
+    return (np.dot(latent, basis) + 0.01 * rng.normal(size=(n, d)) +
+            rng.normal(size=d))
+
+
+def _assert_same_components(pca, reference):
+    """
+    Checks that two trained PCAs have the same mean, eigenvalues and
+    eigenvectors (up to their sign).
+    """
+    np.testing.assert_allclose(pca.mean.get_value(),
+                               reference.mean.get_value(), atol=1e-5)
+    np.testing.assert_allclose(pca.v.get_value(),
+                               reference.v.get_value(), rtol=1e-4)
+    W = pca.W.get_value()
+    W_ref = reference.W.get_value()
+    np.testing.assert_allclose(np.abs((W * W_ref).sum(axis=0)), 1.,
+                               atol=1e-4)
+
+
+def test_randomized_pca():
+    """
+    RandomizedPCA finds the same components as the exact decomposition.
+    """
+    X = _low_rank_data(np.random.RandomState(0))
+    reference = CovEigPCA(num_components=5)
+    reference.train(X)
+    pca = RandomizedPCA(num_components=5, seed=1)
+    pca.train(X)
+    _assert_same_components(pca, reference)
+
+
+def test_incremental_pca():
+    """
+    IncrementalPCA fitted on minibatches, from an array or from a dataset
+    iterator, finds the same components as the exact decomposition.
+    """
+    X = _low_rank_data(np.random.RandomState(0))
+    reference = CovEigPCA(num_components=5)
+    reference.train(X)
+
+    pca = IncrementalPCA(num_components=5, batch_size=64)
+    pca.train(X)
+    assert pca.n_samples_seen == X.shape[0]
+    _assert_same_components(pca, reference)
+
+    pca = IncrementalPCA(num_components=5, batch_size=64)
+    pca.train_dataset(DenseDesignMatrix(X=X))
+    _assert_same_components(pca, reference)
+
+
+def test_incremental_pca_updates_function():
+    """
+    Functions compiled before a call to partial_fit use the updated
+    components.
+    """
+    rng = np.random.RandomState(0)
+    X = _low_rank_data(rng).astype('float32')
+    pca = IncrementalPCA(num_components=5)
+    pca.partial_fit(X[:100])
+    f = pca.function()
+    pca.partial_fit(X[100:])
+    expected = np.dot(X - pca.mean.get_value(), pca.W.get_value())
+    np.testing.assert_allclose(f(X), expected, rtol=1e-3, atol=1e-3)
@@ -10,6 +10,8 @@ __maintainer__ = "LISA Lab"
 __email__ = "pylearn-dev@googlegroups"
 
 import copy
+import sys
+import threading
 import time
 import warnings
 import logging
@@ -27,10 +29,11 @@ from pylearn2.datasets.dataset import Dataset
 from pylearn2.space import Space, CompositeSpace, NullSpace
 from pylearn2.utils import function, sharedX, safe_zip, safe_izip
 from pylearn2.utils.exc import reraise_as
+from pylearn2.utils import monitor_log
 from pylearn2.utils.iteration import is_stochastic
 from pylearn2.utils.data_specs import DataSpecsMapping
 from pylearn2.utils.string_utils import number_aware_alphabetical_key
-from pylearn2.utils.timing import log_timing
+from pylearn2.utils.timing import get_phase_timer, log_timing
 
 log = logging.getLogger(__name__)
 
@@ -74,10 +77,15 @@ class Monitor(object):
         self._num_batches = []
         self._dirty = True
         self._rng_seed = []
-        self.names_to_del = ['theano_function_mode']
+        self._subsample = []
+        self._subsample_calls = 0
+        self.names_to_del = ['theano_function_mode', '_pending']
         self.t0 = time.time()
         self.theano_function_mode = None
         self.on_channel_conflict = 'error'
+        self._asynchronous = False
+        self._pending = None
+        self._log = None
 
         # Initialize self._nested_data_specs, self._data_specs_mapping,
         # and self._flat_data_specs
@@ -129,7 +137,8 @@ class Monitor(object):
             self.theano_function_mode = mode
 
     def add_dataset(self, dataset, mode='sequential', batch_size=None,
-                    num_batches=None, seed=None):
+                    num_batches=None, seed=None, subsample=None,
+                    rotate_subsample=False):
         """
         Determines the data used to calculate the values of each channel.
 
@@ -150,6 +159,16 @@ class Monitor(object):
             batches will be calculated based on full dataset size).
         seed : int, optional
             Optional. The seed to be used for random iteration modes.
+        subsample : int, optional
+            If given, each monitoring step only evaluates the channels on
+            a random subset of this many examples of the dataset (rounded
+            up to a multiple of `batch_size`), and records the standard
+            error of their values. `escalate` evaluates them on the
+            whole dataset.
+        rotate_subsample : bool, optional
+            If `True`, a different random subset is drawn at each
+            monitoring step. Otherwise the same subset is used every
+            time.
         """
         # The user can ommit using lists if only one dataset is set
         if not isinstance(dataset, list):
@@ -164,14 +183,21 @@ class Monitor(object):
             seed = [None] * len(dataset)
         if not isinstance(seed, list):
             seed = [seed]
+        if not isinstance(subsample, list):
+            subsample = [subsample] * len(dataset)
+        if not isinstance(rotate_subsample, list):
+            rotate_subsample = [rotate_subsample] * len(dataset)
         if len(mode) != len(dataset):
             raise ValueError("Received " + str(len(dataset)) +
                              " dataset but " + str(len(mode)) + " modes.")
-        if any([len(l) != len(dataset) for l in [batch_size, seed]]):
+        if any([len(l) != len(dataset) for l in [batch_size, seed,
+                                                 subsample,
+                                                 rotate_subsample]]):
             raise ValueError("make sure each dataset has its iteration " +
                              "batch size and number of batches.")
-        for (d, m, b, n, sd) in safe_izip(dataset, mode, batch_size,
-                                          num_batches, seed):
+        for (d, m, b, n, sd, k, r) in safe_izip(dataset, mode, batch_size,
+                                                num_batches, seed, subsample,
+                                                rotate_subsample):
             try:
                 it = d.iterator(mode=m,
                                 batch_size=b,
@@ -199,51 +225,155 @@ class Monitor(object):
                 # The iterator should catch this, but let's double-check
                 assert sd is None
 
+            if k is not None:
+                if b is None:
+                    raise ValueError("Monitor.add_dataset requires a "
+                                     "batch_size to subsample a dataset.")
+                k = int(np.ceil(k / float(b))) * b
+                if k >= d.get_num_examples():
+                    # The same subsample may be requested for every
+                    # monitoring dataset, some of which can be small.
+                    log.info("Monitor.add_dataset got a subsample of %d "
+                             "examples, but the dataset only has %d, so it "
+                             "is evaluated fully." %
+                             (k, d.get_num_examples()))
+                    k = None
+                else:
+                    k = (k, bool(r))
+
             if d not in self._datasets:
                 self._datasets.append(d)
                 self._iteration_mode.append(m)
                 self._batch_size.append(b)
                 self._num_batches.append(n)
                 self._rng_seed.append(sd)
+                self._get_subsample().append(k)
+
+    def _get_subsample(self):
+        """
+        Returns the list of (number of examples, rotate) pairs, or None,
+        describing how each dataset is subsampled.
+        """
+        # Patch old pickled monitors
+        if not hasattr(self, '_subsample'):
+            self._subsample = [None] * len(self._datasets)
+            self._subsample_calls = 0
+        return self._subsample
+
+    def _subsample_iterator(self, index):
+        """
+        Returns an iterator over the subset of examples of dataset number
+        `index` to evaluate at this monitoring step.
+        """
+        num_examples, rotate = self._get_subsample()[index]
+        batch_size = self._batch_size[index]
+        seed = self._rng_seed[index]
+        if seed is None:
+            seed = [2015, 6, 29]
+        if not isinstance(seed, (list, tuple)):
+            seed = [seed]
+        seed = list(seed) + [index]
+        if rotate:
+            seed.append(self._subsample_calls)
+        return self._datasets[index].iterator(
+            mode='shuffled_sequential',
+            batch_size=batch_size,
+            num_batches=num_examples // batch_size,
+            data_specs=self._flat_data_specs,
+            return_tuple=True,
+            rng=seed)
 
     def __call__(self):
         """
         Runs the model on the monitoring dataset in order to add one
         data point to each of the channels.
+
+        In asynchronous mode (see `set_asynchronous`), the values of the
+        shared variables the channels depend on are copied and the
+        channels are computed on this copy in a background thread. The
+        new data points are added to the channels by the next call to
+        `__call__` or `wait`.
         """
+        # Only one monitoring step can be in progress at a time
+        self.wait()
 
         # If the channels have changed at all, we need to recompile the theano
         # functions used to compute them
         if self._dirty:
             self.redo_theano()
 
+        counters = (time.time() - self.t0, self._num_batches_seen,
+                    self._examples_seen, self._epochs_seen)
+        if not getattr(self, '_asynchronous', False):
+            stderrs = self._accumulate()
+            self._record(counters, self._channel_values(), stderrs)
+            return
+
+        for var, snapshot in self._snapshots:
+            snapshot.set_value(var.get_value(borrow=False), borrow=True)
+        pending = {'counters': counters, 'values': None, 'stderrs': None,
+                   'error': None}
+        pending['thread'] = threading.Thread(target=self._accumulate_async,
+                                             args=(pending,))
+        pending['thread'].daemon = True
+        self._pending = pending
+        pending['thread'].start()
+
+    def _accumulate(self, full=False, indices=None):
+        """
+        Resets the channels and accumulates their values over all the
+        monitoring datasets.
+
+        Parameters
+        ----------
+        full : bool, optional
+            If `True`, subsampled datasets are evaluated on all their
+            examples.
+        indices : list of int, optional
+            If given, only the datasets with these indices are evaluated.
+
+        Returns
+        -------
+        stderrs : dict
+            Maps the names of the channels of the evaluated datasets to
+            the standard error of their values.
+        """
         datasets = self._datasets
+        subsample = self._get_subsample()
+        if indices is None:
+            indices = range(len(datasets))
+        if not full and any(subsample[index] is not None
+                            for index in indices):
+            self._subsample_calls += 1
 
         # Set all channels' val_shared to 0
         self.begin_record_entry()
-        for d, i, b, n, a, sd, ne in safe_izip(datasets,
-                                               self._iteration_mode,
-                                               self._batch_size,
-                                               self._num_batches,
-                                               self.accum,
-                                               self._rng_seed,
-                                               self.num_examples):
+        stderrs = {}
+        for index in indices:
+            d = datasets[index]
+            a = self.accum[index]
             if isinstance(d, six.string_types):
                 d = yaml_parse.load(d)
                 raise NotImplementedError()
 
-            # need to put d back into self._datasets
-            myiterator = d.iterator(mode=i,
-                                    batch_size=b,
-                                    num_batches=n,
-                                    data_specs=self._flat_data_specs,
-                                    return_tuple=True,
-                                    rng=sd)
+            if subsample[index] is not None and not full:
+                myiterator = self._subsample_iterator(index)
+            else:
+                # need to put d back into self._datasets
+                myiterator = d.iterator(mode=self._iteration_mode[index],
+                                        batch_size=self._batch_size[index],
+                                        num_batches=self._num_batches[index],
+                                        data_specs=self._flat_data_specs,
+                                        return_tuple=True,
+                                        rng=self._rng_seed[index])
+            ne = myiterator.num_examples
+            self._num_examples_shared[index].set_value(np.float64(ne))
 
             # If self._flat_data_specs is empty, no channel needs data,
             # so we do not need to call the iterator in order to average
             # the monitored values across different batches, we only
             # have to call them once.
+            sizes = []
             if len(self._flat_data_specs[1]) == 0:
                 X = ()
                 self.run_prereqs(X, d)
@@ -251,41 +381,298 @@ class Monitor(object):
 
             else:
                 actual_ne = 0
-                for X in myiterator:
+                timer = get_phase_timer()
+                for X in timer.iterate('data', myiterator):
                     # X is a flat (not nested) tuple
-                    self.run_prereqs(X, d)
-                    a(*X)
-                    actual_ne += self._flat_data_specs[0].np_batch_size(X)
+                    with timer.phase('accumulate'):
+                        self.run_prereqs(X, d)
+                        a(*X)
+                    sizes.append(self._flat_data_specs[0].np_batch_size(X))
+                    actual_ne += sizes[-1]
                 # end for X
                 if actual_ne != ne:
                     raise RuntimeError("At compile time, your iterator said "
                                        "it had %d examples total, but at "
                                        "runtime it gave us %d." %
                                        (ne, actual_ne))
+            stderrs.update(self._stderrs(index, sizes))
         # end for d
+        return stderrs
+
+    def _stderrs(self, index, sizes):
+        """
+        Estimates the standard error of the channels of dataset number
+        `index` from the variance of their values across batches.
+
+        Parameters
+        ----------
+        index : int
+            Index of the dataset.
+        sizes : list of int
+            Sizes of the batches the channels were accumulated over.
+
+        Returns
+        -------
+        stderrs : dict
+            Maps channel names to standard errors.
+        """
+        d = self._datasets[index]
+        rval = {}
+        total = float(sum(sizes))
+        if len(sizes) < 2:
+            weight = 0.
+        else:
+            # Variance of a weighted mean of batch means, with a finite
+            # population correction
+            weight = (np.sum(np.square(np.asarray(sizes) / total)) *
+                      len(sizes) / (len(sizes) - 1.) *
+                      max(0., 1. - total / d.get_num_examples()))
+        for name, channel in six.iteritems(self.channels):
+            if channel.dataset is not d:
+                continue
+            mean = float(channel.val_shared.get_value())
+            mean_sq = float(self._sq_trackers[name].get_value())
+            variance = max(0., mean_sq - mean ** 2)
+            rval[name] = np.sqrt(variance * weight)
+        return rval
+
+    def escalate(self):
+        """
+        Evaluates the channels of the subsampled datasets on all of their
+        examples, and replaces the last data point of these channels by
+        the result. Used to settle decisions depending on subsampled
+        channels. In asynchronous mode, the channels are evaluated on the
+        same copy of the parameters as the last monitoring step.
+        """
+        self.wait()
+        subsample = self._get_subsample()
+        indices = [i for i, k in enumerate(subsample) if k is not None]
+        if not indices:
+            return
+        if self._dirty:
+            self.redo_theano()
+        stderrs = self._accumulate(full=True, indices=indices)
+        log.info("Escalated monitoring step:")
+        for name in sorted(stderrs.keys(), key=number_aware_alphabetical_key):
+            channel = self.channels[name]
+            val = channel.val_shared.get_value()
+            channel.val_record[-1] = val
+            channel.stderr_record[-1] = stderrs[name]
+            log.info("\t%s: %s" % (name, val))
+        record_log = getattr(self, '_log', None)
+        if record_log is not None:
+            # Replaces the last row of the log
+            channel = self.channels[name]
+            counters = (channel.time_record[-1], channel.batch_record[-1],
+                        channel.example_record[-1], channel.epoch_record[-1])
+            names = sorted(self.channels.keys(),
+                           key=number_aware_alphabetical_key)
+            values = OrderedDict((name, self.channels[name].val_record[-1])
+                                 for name in names)
+            stderrs = dict((name, self.channels[name].stderr_record[-1])
+                           for name in names)
+            record_log.append(counters, values, stderrs)
+
+    def escalate_if_close(self, channel_name, threshold, num_stderrs):
+        """
+        Calls `escalate` if the last value of a channel is within
+        `num_stderrs` standard errors of `threshold`.
+
+        Parameters
+        ----------
+        channel_name : str
+            Name of the channel.
+        threshold : float
+            Value at which a decision based on the channel changes.
+        num_stderrs : float
+            Number of standard errors defining "close". If None, never
+            escalates.
+
+        Returns
+        -------
+        escalated : bool
+            Whether the channel was re-evaluated.
+        """
+        self.wait()
+        if num_stderrs is None:
+            return False
+        channel = self.channels[channel_name]
+        stderr = channel.stderr_record[-1]
+        if not stderr or not np.isfinite(threshold):
+            return False
+        if abs(channel.val_record[-1] - threshold) >= num_stderrs * stderr:
+            return False
+        self.escalate()
+        return True
+
+    def _channel_values(self):
+        """
+        Returns a dictionary mapping channel names to their current
+        values.
+        """
+        return dict((name, channel.val_shared.get_value())
+                    for name, channel in six.iteritems(self.channels))
 
+    def _accumulate_async(self, pending):
+        """
+        Body of the background thread of an asynchronous monitoring
+        step. Stores the channel values, or the exception raised, in the
+        `pending` dictionary.
+        """
+        try:
+            pending['stderrs'] = self._accumulate()
+            pending['values'] = self._channel_values()
+        except Exception:
+            pending['error'] = sys.exc_info()
+
+    def _record(self, counters, values, stderrs):
+        """
+        Adds one data point to each of the channels.
+
+        Parameters
+        ----------
+        counters : tuple
+            Time, number of batches, examples and epochs seen when the
+            values were measured.
+        values : dict
+            Maps channel names to their values.
+        stderrs : dict
+            Maps channel names to the standard errors of their values.
+        """
+        t, batches_seen, examples_seen, epochs_seen = counters
+        record_log = getattr(self, '_log', None)
+        if record_log is not None:
+            logged_values = OrderedDict()
         log.info("Monitoring step:")
-        log.info("\tEpochs seen: %d" % self._epochs_seen)
-        log.info("\tBatches seen: %d" % self._num_batches_seen)
-        log.info("\tExamples seen: %d" % self._examples_seen)
-        t = time.time() - self.t0
+        log.info("\tEpochs seen: %d" % epochs_seen)
+        log.info("\tBatches seen: %d" % batches_seen)
+        log.info("\tExamples seen: %d" % examples_seen)
         for channel_name in sorted(self.channels.keys(),
                                    key=number_aware_alphabetical_key):
             channel = self.channels[channel_name]
             channel.time_record.append(t)
-            channel.batch_record.append(self._num_batches_seen)
-            channel.example_record.append(self._examples_seen)
-            channel.epoch_record.append(self._epochs_seen)
-            val = channel.val_shared.get_value()
+            channel.batch_record.append(batches_seen)
+            channel.example_record.append(examples_seen)
+            channel.epoch_record.append(epochs_seen)
+            val = values[channel_name]
             channel.val_record.append(val)
+            stderr = stderrs.get(channel_name, 0.)
+            channel.stderr_record.append(stderr)
+            if record_log is not None:
+                logged_values[channel_name] = val
+                if len(channel.val_record) == 1:
+                    # The whole history of the channel is in the log
+                    channel.log_path = record_log.path
             # TODO: use logging infrastructure so that user can configure
             # formatting
             if abs(val) < 1e4:
                 val_str = str(val)
             else:
                 val_str = '%.3e' % val
+            if stderr > 0:
+                val_str += ' +/- %.3e' % stderr
 
             log.info("\t%s: %s" % (channel_name, val_str))
+        if record_log is not None:
+            record_log.append(counters, logged_values, stderrs)
+
+    def set_log(self, path):
+        """
+        Appends the data points of the channels to a `MonitorLog` file,
+        one row per monitoring step, which can be read without loading
+        the model (see `pylearn2.utils.monitor_log.read_monitor_log`).
+
+        The channels whose whole history is in the log are then pickled
+        without their records, which are read back from the log when
+        first accessed; pickles of the model thus don't grow with the
+        length of the run, but need the log.
+
+        If the log doesn't exist yet, the existing history of the
+        channels is written to it first.
+
+        Parameters
+        ----------
+        path : str or None
+            Path of the log. None stops logging.
+        """
+        self.wait()
+        if path is None:
+            for channel in self.channels.values():
+                # Make the channels hold their whole history again:
+                # reading a record loads them from the log
+                getattr(channel, 'val_record')
+                channel.log_path = None
+            self._log = None
+            return
+        record_log = monitor_log.MonitorLog(path)
+        old_log = getattr(self, '_log', None)
+        if old_log is not None and old_log.path == record_log.path:
+            return
+        self._log = record_log
+        if record_log.exists():
+            return
+        lengths = [len(channel.val_record)
+                   for channel in self.channels.values()]
+        if not lengths or max(lengths) == 0:
+            return
+        length = max(lengths)
+        names = [name for name in sorted(self.channels.keys(),
+                                         key=number_aware_alphabetical_key)
+                 if len(self.channels[name].val_record) == length]
+        first = self.channels[names[0]]
+        for i in range(length):
+            counters = (first.time_record[i], first.batch_record[i],
+                        first.example_record[i], first.epoch_record[i])
+            values = OrderedDict((name, self.channels[name].val_record[i])
+                                 for name in names)
+            stderrs = dict((name, self.channels[name].stderr_record[i])
+                           for name in names)
+            record_log.append(counters, values, stderrs)
+        for name in names:
+            self.channels[name].log_path = record_log.path
+
+    def set_asynchronous(self, asynchronous):
+        """
+        Enables or disables asynchronous monitoring.
+
+        In asynchronous mode, calling the monitor copies the shared
+        variables used by the channels (such as the model parameters)
+        and evaluates the channels on that copy in a background thread,
+        so training can go on in the meantime. The data points are added
+        to the channels when the next monitoring step starts, or when
+        `wait` is called; code reading the newest channel values must
+        call `wait` first. Train extensions and termination criteria
+        do so through their `wait_for_monitor` attribute.
+
+        Prerequisite functions of the channels are run by the background
+        thread.
+
+        Parameters
+        ----------
+        asynchronous : bool
+            Whether to monitor asynchronously.
+        """
+        asynchronous = bool(asynchronous)
+        self.register_names_to_del(['_pending'])
+        if getattr(self, '_asynchronous', False) != asynchronous:
+            self.wait()
+            self._asynchronous = asynchronous
+            self._dirty = True
+
+    def wait(self):
+        """
+        Waits for the asynchronous monitoring step in progress, if any,
+        to finish, and adds its data points to the channels.
+        """
+        pending = getattr(self, '_pending', None)
+        if pending is None:
+            return
+        pending['thread'].join()
+        self._pending = None
+        if pending['error'] is not None:
+            six.reraise(*pending['error'])
+        self._record(pending['counters'], pending['values'],
+                     pending['stderrs'])
 
     def run_prereqs(self, data, dataset):
         """
@@ -395,9 +782,17 @@ class Monitor(object):
                     if prereq not in prereqs:
                         prereqs.append(prereq)
 
+        # Accumulators of the squared batch values, used to estimate the
+        # standard error of the channels
+        self._sq_trackers = OrderedDict()
+        for name in self.channels:
+            self._sq_trackers[name] = sharedX(0.0, name + "_sq_tracker")
+
         updates = OrderedDict()
         for channel in self.channels.values():
             updates[channel.val_shared] = np.cast[config.floatX](0.0)
+        for tracker in self._sq_trackers.values():
+            updates[tracker] = np.cast[config.floatX](0.0)
         with log_timing(log, "compiling begin_record_entry"):
             self.begin_record_entry = function(
                 inputs=[],
@@ -439,13 +834,17 @@ class Monitor(object):
                                  data_specs=self._flat_data_specs,
                                  return_tuple=True))
         self.num_examples = [i.num_examples for i in it]
+        # The number of examples evaluated is only known at runtime when
+        # subsampling
+        self._num_examples_shared = [theano.shared(np.float64(ne))
+                                     for ne in self.num_examples]
         givens = [OrderedDict() for d in self._datasets]
         updates = [OrderedDict() for d in self._datasets]
         for i, channel in enumerate(self.channels.values()):
             index = self._datasets.index(channel.dataset)
             d = self._datasets[index]
             g = givens[index]
-            cur_num_examples = self.num_examples[index]
+            cur_num_examples = self._num_examples_shared[index]
             u = updates[index]
 
             # Flatten channel.graph_input and the appropriate part of
@@ -476,6 +875,30 @@ class Monitor(object):
                 val = T.cast(channel.val * T.cast(batch_size, 'float64')
                              / cur_num_examples, config.floatX)
             u[channel.val_shared] = channel.val_shared + val
+            sq_tracker = self._sq_trackers[channel.name]
+            u[sq_tracker] = sq_tracker + T.cast(
+                T.sqr(channel.val) * T.cast(batch_size, 'float64') /
+                cur_num_examples, config.floatX)
+
+        # In asynchronous mode, the channels are computed on copies of the
+        # shared variables they depend on, so training can modify them.
+        self._snapshots = []
+        if getattr(self, '_asynchronous', False):
+            channel_vals = [channel.val for channel in self.channels.values()]
+            for var in theano.gof.graph.inputs(channel_vals):
+                if not isinstance(var, theano.compile.SharedVariable):
+                    continue
+                kwargs = {}
+                if hasattr(var.type, 'broadcastable'):
+                    kwargs['broadcastable'] = var.type.broadcastable
+                snapshot = theano.shared(var.get_value(),
+                                         name='snapshot(%s)' % var.name,
+                                         **kwargs)
+                if snapshot.type != var.type:
+                    continue
+                self._snapshots.append((var, snapshot))
+                for g in givens:
+                    g[var] = snapshot
 
         with log_timing(log, "Compiling accum"):
             # Check type of update expressions
@@ -552,6 +975,10 @@ class Monitor(object):
         `self.names_to_del`
         """
 
+        # Add the data points of an asynchronous monitoring step, waiting
+        # for it if it is still running, so that they are saved too
+        self.wait()
+
         # Patch old pickled monitors
         if not hasattr(self, '_datasets'):
             self._datasets = [self._dataset]
@@ -793,7 +1220,8 @@ class Monitor(object):
 
     def setup(self, dataset, cost, batch_size, num_batches=None,
               extra_costs=None, mode='sequential', obj_prereqs=None,
-              cost_monitoring_args=None):
+              cost_monitoring_args=None, subsample=None,
+              rotate_subsample=False):
         """
         Sets up the monitor for a cost minimization problem.
         Adds channels defined by both the model and the cost for
@@ -828,6 +1256,11 @@ class Monitor(object):
             Dictionary of kwargs that will be passed to
             `cost.get_monitoring_channels()`
             (but not for the extra_costs).
+        subsample : int, optional
+            Number of examples of each dataset to evaluate at each
+            monitoring step. See `add_dataset`.
+        rotate_subsample : bool, optional
+            See `add_dataset`.
         """
 
         if dataset is None:
@@ -924,7 +1357,9 @@ class Monitor(object):
                              mode=mode,
                              batch_size=batch_size,
                              num_batches=num_batches,
-                             seed=seed)
+                             seed=seed,
+                             subsample=subsample,
+                             rotate_subsample=rotate_subsample)
             if dataset_name == '':
                 dprefix = ''
             else:
@@ -962,6 +1397,9 @@ class Monitor(object):
                                  dataset=cur_dataset)
 
 
+_RECORD_NAMES = [record for record, _ in monitor_log.RECORDS]
+
+
 class MonitorChannel(object):
     """
     A class representing a specific quantity to be monitored.
@@ -1014,26 +1452,20 @@ class MonitorChannel(object):
                              str(val.ndim))
         # Dataset monitored by this channel
         self.dataset = dataset
+        # The records are ArrayRecords. They hold the value of the desired
+        # quantity at measurement time, its standard error (0 if computed
+        # on all the examples), and the time, number of batches, examples
+        # (batch sizes may fluctuate) and epochs seen at measurement time.
+        # If the history is written to a MonitorLog, log_path is its path.
         if old_channel is not None:
-            # Value of the desired quantity at measurement time.
-            self.val_record = old_channel.val_record[:-1]
-            # Number of batches seen at measurement time.
-            self.batch_record = old_channel.batch_record[:-1]
-            # Number of examples seen at measurement time (batch sizes may
-            # fluctuate).
-            self.example_record = old_channel.example_record[:-1]
-            self.epoch_record = old_channel.epoch_record[:-1]
-            self.time_record = old_channel.time_record[:-1]
+            for record, dtype in monitor_log.RECORDS:
+                setattr(self, record, monitor_log.as_record(
+                    getattr(old_channel, record)[:-1], dtype))
+            self.log_path = getattr(old_channel, 'log_path', None)
         else:
-            # Value of the desired quantity at measurement time.
-            self.val_record = []
-            # Number of batches seen at measurement time.
-            self.batch_record = []
-            # Number of examples seen at measurement time (batch sizes may
-            # fluctuate).
-            self.example_record = []
-            self.epoch_record = []
-            self.time_record = []
+            for record, dtype in monitor_log.RECORDS:
+                setattr(self, record, monitor_log.ArrayRecord(dtype=dtype))
+            self.log_path = None
 
     def __str__(self):
         """
@@ -1104,13 +1536,19 @@ class MonitorChannel(object):
                 # Support pickle files that are older than the doc system
                 doc = None
 
+        log_path = getattr(self, 'log_path', None)
+        if log_path is not None:
+            # The history is read back from the log
+            return {'doc': doc, 'name': self.name, 'log_path': log_path}
+
         return {
             'doc': doc,
             'example_record': self.example_record,
             'batch_record': self.batch_record,
             'time_record': self.time_record,
             'epoch_record': self.epoch_record,
-            'val_record': self.val_record
+            'val_record': self.val_record,
+            'stderr_record': self.stderr_record
         }
 
     def __setstate__(self, d):
@@ -1124,6 +1562,9 @@ class MonitorChannel(object):
             these fields.
         """
         self.__dict__.update(d)
+        if 'log_path' in d:
+            # The records are loaded from the log when first accessed
+            return
         if 'batch_record' not in d:
             self.batch_record = [None] * len(self.val_record)
         # Patch old pickle files that don't have the "epoch_record" field
@@ -1133,6 +1574,39 @@ class MonitorChannel(object):
             self.epoch_record = range(len(self.val_record))
         if 'time_record' not in d:
             self.time_record = [None] * len(self.val_record)
+        if 'stderr_record' not in d:
+            self.stderr_record = [None] * len(self.val_record)
+        for record, dtype in monitor_log.RECORDS:
+            setattr(self, record,
+                    monitor_log.as_record(getattr(self, record), dtype))
+
+    def __getattr__(self, name):
+        """
+        Loads the records from the log of the channel, if it was pickled
+        without them.
+
+        Parameters
+        ----------
+        name : str
+            Name of the missing attribute.
+        """
+        log_path = self.__dict__.get('log_path')
+        if log_path is None or name not in _RECORD_NAMES:
+            raise AttributeError(name)
+        try:
+            logged = monitor_log.read_monitor_log(log_path).get(
+                self.__dict__.get('name'))
+        except (IOError, OSError, ValueError) as e:
+            log.warning("Could not read the history of channel %s from %s: "
+                        "%s" % (self.__dict__.get('name'), log_path, e))
+            logged = None
+        for record, dtype in monitor_log.RECORDS:
+            if logged is None:
+                value = monitor_log.ArrayRecord(dtype=dtype)
+            else:
+                value = getattr(logged, record)[:]
+            self.__dict__[record] = value
+        return self.__dict__[name]
 
 
 def push_monitor(model, name, transfer_experience=False,
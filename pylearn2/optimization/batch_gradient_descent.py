@@ -11,11 +11,14 @@ __maintainer__ = "LISA Lab"
 __email__ = "pylearn-dev@googlegroups"
 
 import logging
+import multiprocessing
 import time
+import traceback
 
 import numpy as np
 from theano.compat.six.moves import xrange
 
+import theano
 from theano import config
 from theano.printing import var_descriptor
 import theano.tensor as T
@@ -30,6 +33,16 @@ from pylearn2.utils import sharedX
 logger = logging.getLogger(__name__)
 
 
+def _get_context():
+    """
+    Returns a multiprocessing context that forks, so that the workers
+    inherit the compiled Theano functions of the parent.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
 class BatchGradientDescent(object):
     """
     A class for minimizing a function via the method of steepest descent.
@@ -71,6 +84,16 @@ class BatchGradientDescent(object):
     gradient_updates : dict
         A dictionary of shared variable updates to run each time the
         gradient is computed
+    num_workers : int, optional
+        If larger than 1, the objective and the gradient are evaluated by
+        this many forked worker processes. Each call to `minimize` splits
+        its inputs along their first axis into one shard per worker.
+        Every evaluation during the line search then sends the current
+        parameters to the workers. Each worker evaluates its shard, and
+        the results are summed, weighted by the size of the shards. All
+        the inputs must be batches of examples, and the objective must
+        be an average over the examples plus terms that don't depend on
+        them. `gradient_updates` and `accumulate` are not supported.
 
     Notes
     -----
@@ -84,10 +107,17 @@ class BatchGradientDescent(object):
                  reset_alpha=True, conjugate=False,
                  reset_conjugate=True, gradients=None,
                  gradient_updates=None, line_search_mode=None,
-                 accumulate=False, theano_function_mode=None):
+                 accumulate=False, theano_function_mode=None,
+                 num_workers=1):
 
         self.__dict__.update(locals())
         del self.self
+        self._workers = None
+
+        if num_workers > 1 and (accumulate or gradient_updates):
+            raise ValueError("BatchGradientDescent with num_workers > 1 "
+                             "supports neither accumulate nor "
+                             "gradient_updates")
 
         if line_search_mode is None:
             if init_alpha is None:
@@ -292,6 +322,198 @@ class BatchGradientDescent(object):
         self.ave_step_size = sharedX(0.)
         self.ave_grad_mult = sharedX(0.)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_workers'] = None
+        for key in ['_shared_params', '_grad_buffer', '_sync_vars']:
+            state.pop(key, None)
+        return state
+
+    def _start_workers(self):
+        """
+        Allocates the shared memory and forks the worker processes.
+        """
+        ctx = _get_context()
+
+        def allocate(shape, dtype):
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape))
+            buf = ctx.RawArray('b', max(1, size * dtype.itemsize))
+            return np.frombuffer(buf, dtype=dtype,
+                                 count=size).reshape(shape)
+
+        self._shared_params = [allocate(value.shape, value.dtype)
+                               for value in (param.get_value(borrow=True)
+                                             for param in self.params)]
+        grad_size = sum(value.size for value in self._shared_params)
+        self._grad_buffer = allocate((self.num_workers, grad_size),
+                                     'float64')
+
+        # Shared variables that the objective or the gradient read, other
+        # than the parameters (e.g. set by on_load_batch callbacks), are
+        # sent to the workers with their shards.
+        skip = set(self.params) | set(self.param_to_grad_shared.values())
+        self._sync_vars = []
+        for fn in [self.obj, self._compute_grad]:
+            for maker_input in fn.maker.inputs:
+                var = maker_input.variable
+                if (isinstance(var, theano.compile.SharedVariable) and
+                        var not in skip and var not in self._sync_vars):
+                    self._sync_vars.append(var)
+
+        workers = []
+        for i in xrange(self.num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=self._worker_loop,
+                                  args=(i, child_conn))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn))
+        self._workers = workers
+
+    def shutdown(self):
+        """
+        Stops the worker processes, if any.
+        """
+        if getattr(self, '_workers', None) is None:
+            return
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for process, conn in self._workers:
+            process.join()
+            conn.close()
+        self._workers = None
+
+    def __del__(self):
+        try:
+            self.shutdown()
+        except Exception:
+            pass
+
+    def _worker_loop(self, index, conn):
+        """
+        Main loop of worker number `index`: stores the shard of the
+        inputs it receives through `conn`, and evaluates the objective or
+        the gradient on it when requested.
+        """
+        try:
+            shard, weight = None, 0.
+            while True:
+                request = conn.recv()
+                if request is None:
+                    break
+                kind, payload = request
+                if kind == 'data':
+                    shard, weight, sync_values = payload
+                    for var, value in safe_zip(self._sync_vars,
+                                               sync_values):
+                        var.set_value(value)
+                    continue
+                for param, value in safe_zip(self.params,
+                                             self._shared_params):
+                    param.set_value(value)
+                if kind == 'obj':
+                    value = 0.
+                    if weight > 0:
+                        value = weight * float(self.obj(*shard))
+                    conn.send(('done', value))
+                else:
+                    assert kind == 'grad'
+                    row = self._grad_buffer[index]
+                    if weight > 0:
+                        self._compute_grad(*shard)
+                        start = 0
+                        for grad_shared in self.param_to_grad_shared.values():
+                            value = grad_shared.get_value(borrow=True)
+                            row[start:start + value.size] = value.ravel()
+                            start += value.size
+                        row *= weight
+                    else:
+                        row[...] = 0.
+                    conn.send(('done', None))
+        except (KeyboardInterrupt, EOFError):
+            pass
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        finally:
+            conn.close()
+
+    def _scatter(self, inputs):
+        """
+        Sends each worker its shard of `inputs`.
+        """
+        if self._workers is None:
+            self._start_workers()
+        num_examples = None
+        for value in inputs:
+            if np.ndim(value) == 0:
+                raise ValueError("BatchGradientDescent with num_workers > 1 "
+                                 "needs batches of examples as inputs")
+            if num_examples is None:
+                num_examples = len(value)
+            elif len(value) != num_examples:
+                raise ValueError("The inputs have different numbers of "
+                                 "examples: %d and %d"
+                                 % (num_examples, len(value)))
+        bounds = np.linspace(0, num_examples,
+                             self.num_workers + 1).astype('int64')
+        sync_values = [var.get_value() for var in self._sync_vars]
+        for i, (process, conn) in enumerate(self._workers):
+            start, stop = bounds[i], bounds[i + 1]
+            shard = [value[start:stop] for value in inputs]
+            weight = float(stop - start) / num_examples
+            conn.send(('data', (shard, weight, sync_values)))
+
+    def _gather(self, kind):
+        """
+        Sends the parameters to the workers, has them evaluate `kind`
+        ('obj' or 'grad') on their shards, and returns the results.
+        """
+        for param, value in safe_zip(self.params, self._shared_params):
+            value[...] = param.get_value(borrow=True)
+        for process, conn in self._workers:
+            conn.send((kind, None))
+        results = []
+        for process, conn in self._workers:
+            try:
+                status, payload = conn.recv()
+            except EOFError:
+                self.shutdown()
+                raise RuntimeError("A BatchGradientDescent worker died "
+                                   "unexpectedly")
+            if status == 'error':
+                self.shutdown()
+                raise RuntimeError("Error in BatchGradientDescent "
+                                   "worker:\n" + payload)
+            results.append(payload)
+        return results
+
+    def _parallel_obj(self, *inputs):
+        """
+        Returns the objective on the inputs last scattered to the
+        workers.
+        """
+        return np.cast[self.objective.dtype](sum(self._gather('obj')))
+
+    def _parallel_grad(self, *inputs):
+        """
+        Sets the gradient shared variables to the gradient on the inputs
+        last scattered to the workers, reducing the weighted gradients of
+        the workers as one vector.
+        """
+        self._gather('grad')
+        total = self._grad_buffer.sum(axis=0)
+        start = 0
+        for grad_shared in self.param_to_grad_shared.values():
+            value = grad_shared.get_value(borrow=True)
+            new = total[start:start + value.size].reshape(value.shape)
+            grad_shared.set_value(new.astype(value.dtype))
+            start += value.size
+
     def minimize(self, * inputs):
         """
         .. todo::
@@ -303,7 +525,15 @@ class BatchGradientDescent(object):
             logger.info('minimizing')
         alpha_list = list(self.init_alpha)
 
-        orig_obj = self.obj(*inputs)
+        if getattr(self, 'num_workers', 1) > 1:
+            self._scatter(inputs)
+            compute_obj = self._parallel_obj
+            compute_grad = self._parallel_grad
+        else:
+            compute_obj = self.obj
+            compute_grad = self._compute_grad
+
+        orig_obj = compute_obj(*inputs)
 
         if self.verbose:
             logger.info(orig_obj)
@@ -334,19 +564,19 @@ class BatchGradientDescent(object):
             self._cache_values()
             if self.conjugate:
                 self._store_old_grad(norm)
-            self._compute_grad(*inputs)
+            compute_grad(*inputs)
             if self.conjugate:
                 self._make_conjugate()
             norm = self._normalize_grad()
 
             if self.line_search_mode is None:
                 best_obj, best_alpha, best_alpha_ind = \
-                    self.obj(* inputs), 0., -1
+                    compute_obj(*inputs), 0., -1
                 prev_best_obj = best_obj
 
                 for ind, alpha in enumerate(alpha_list):
                     self._goto_alpha(alpha)
-                    obj = self.obj(*inputs)
+                    obj = compute_obj(*inputs)
                     if self.verbose:
                         logger.info('\t{0} {1}'.format(alpha, obj))
 
@@ -429,7 +659,7 @@ class BatchGradientDescent(object):
                 if self.verbose > 1:
                     logger.info('Exhaustive line search')
 
-                obj = self.obj(*inputs)
+                obj = compute_obj(*inputs)
                 if np.isnan(obj):
                     logger.warning("Objective is NaN for these parameters.")
                 results = [(0., obj)]
@@ -440,7 +670,7 @@ class BatchGradientDescent(object):
                                      '{0}'.format(results[-1][0]))
                         assert False
                     self._goto_alpha(alpha)
-                    obj = self.obj(*inputs)
+                    obj = compute_obj(*inputs)
                     if np.isnan(obj):
                         obj = np.inf
                     results.append((alpha, obj))
@@ -459,7 +689,7 @@ class BatchGradientDescent(object):
 
                     def do_point(x):
                         self._goto_alpha(x)
-                        res = self.obj(*inputs)
+                        res = compute_obj(*inputs)
                         if self.verbose > 1:
                             logger.info('\t{0} {1}'.format(x, res))
                         # Regard NaN results as infinitely bad so they
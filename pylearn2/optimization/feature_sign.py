@@ -14,13 +14,19 @@ __all__ = ["feature_sign_search"]
 from itertools import count
 
 import logging
+import multiprocessing
 import numpy as np
+from scipy import sparse
 from theano.compat import six
-from theano.compat.six.moves import zip as izip
+from theano.compat.six.moves import xrange
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# Arguments of the batched solver, set in each process of the pool used by
+# `feature_sign_search` when `num_workers` is larger than 1.
+_worker_args = None
+
 
 def _feature_sign_checkargs(dictionary, signals, sparsity, max_iter,
                             solution):
@@ -223,8 +229,212 @@ def _feature_sign_search_single(dictionary, signal, sparsity, max_iter,
     return solution, min(six.next(counter), max_iter)
 
 
+def _feature_sign_search_batch(gram_matrix, target_correlation, sparsity,
+                               max_iter, solution):
+    """
+    Solve several L1-penalized minimization problems with feature-sign
+    search, advancing the active sets of all of them together.
+
+    Parameters
+    ----------
+    gram_matrix : ndarray, 2-dimensional
+        The Gram matrix of the dictionary, `np.dot(dictionary.T,
+        dictionary)`.
+    target_correlation : ndarray, 2-dimensional
+        The correlations of the signals with the dictionary,
+        `np.dot(signals, dictionary)`, one row per signal.
+    sparsity : float or ndarray
+        The coefficient on the L1 penalty term of the cost function, or
+        a matrix of coefficients with one per element of `solution`.
+        Coefficients may be infinite, to keep elements at zero.
+    max_iter : int
+        The maximum number of iterations to run per signal.
+    solution : ndarray, 2-dimensional
+        Matrix in which to store the solutions, one row per signal.
+
+    Returns
+    -------
+    iters : ndarray, 1-dimensional
+        The number of iterations that were run for each signal.
+
+    Notes
+    -----
+    Each iteration performs the steps of `_feature_sign_search_single`
+    for all the signals that have not converged yet. The feature
+    activations and the gradients are computed for all of them at once,
+    and the unconstrained problems restricted to the active sets are
+    solved together for the signals whose active sets have the same
+    size. The line searches use the fact that the cost is quadratic
+    along the segment between the old and new solutions, plus the L1
+    term.
+    """
+    # This prevents the sparsity penalty scalar from upcasting the entire
+    # rhs vector sent to linalg.solve().
+    num_cases, num_features = target_correlation.shape
+    sparsity = np.broadcast_to(np.asarray(sparsity, dtype=gram_matrix.dtype),
+                               (num_cases, num_features))
+    effective_zero = 1e-18
+    solution[...] = 0.
+    signs = np.zeros((num_cases, num_features), dtype=np.int8)
+    # second term is zero on initialization.
+    grad = - 2 * target_correlation
+    # Set to True here to trigger a new feature activation on first
+    # iteration.
+    nz_optimal = np.ones(num_cases, dtype=bool)
+    iters = np.zeros(num_cases, dtype='int64')
+    running = np.arange(num_cases)
+    while len(running) > 0:
+        running = running[iters[running] < max_iter]
+        iters[running] += 1
+        activate = running[nz_optimal[running]]
+        if len(activate) > 0:
+            candidates = np.argmax(np.where(signs[activate] == 0,
+                                            np.abs(grad[activate]) -
+                                            sparsity[activate], -np.inf),
+                                   axis=1)
+            candidate_grad = grad[activate, candidates]
+            candidate_sparsity = sparsity[activate, candidates]
+            for sign, added in [(-1, candidate_grad > candidate_sparsity),
+                                (1, candidate_grad < -candidate_sparsity)]:
+                signs[activate[added], candidates[added]] = sign
+                solution[activate[added], candidates[added]] = 0.
+            # Signals with an empty active set are solved by zero.
+            empty = activate[~signs[activate].any(axis=1)]
+            running = np.setdiff1d(running, empty, assume_unique=True)
+        if len(running) == 0:
+            break
+        active = signs[running] != 0
+        sizes = active.sum(axis=1)
+        for size in np.unique(sizes):
+            in_group = sizes == size
+            rows = running[in_group]
+            indices = np.nonzero(active[in_group])[1].reshape(len(rows),
+                                                               size)
+            solution[rows[:, np.newaxis], indices] = _restricted_step(
+                gram_matrix[indices[:, :, np.newaxis],
+                            indices[:, np.newaxis, :]],
+                target_correlation[rows[:, np.newaxis], indices],
+                signs[rows[:, np.newaxis], indices],
+                solution[rows[:, np.newaxis], indices],
+                sparsity[rows[:, np.newaxis], indices])
+        current = solution[running]
+        current[np.abs(current) < effective_zero] = 0.
+        solution[running] = current
+        current_signs = np.sign(current).astype(np.int8)
+        signs[running] = current_signs
+        # The solutions are sparse, so this costs much less than a dense
+        # product with the Gram matrix.
+        current_grad = (- 2 * target_correlation[running] +
+                        2 * sparse.csr_matrix(current).dot(gram_matrix))
+        grad[running] = current_grad
+        current_sparsity = sparsity[running]
+        zero = current_signs == 0
+        z_opt = np.where(zero, np.abs(current_grad) - current_sparsity,
+                         -np.inf).max(axis=1)
+        with np.errstate(invalid='ignore'):
+            nz_opt = np.where(zero, 0.,
+                              np.abs(current_grad + current_sparsity *
+                                     current_signs)).max(axis=1)
+        nz_optimal[running] = np.isclose(nz_opt, 0)
+        running = running[(z_opt > 0) | ~nz_optimal[running]]
+    return iters
+
+
+def _restricted_step(restr_gram, restr_corr, restr_sign, restr_oldsol,
+                     sparsity):
+    """
+    Solve the unconstrained problems restricted to active sets of the
+    same size, then do the line searches over the zero crossings of the
+    coefficients whose signs flip.
+
+    Parameters
+    ----------
+    restr_gram : ndarray, 3-dimensional
+        The Gram matrices restricted to each active set.
+    restr_corr : ndarray, 2-dimensional
+        The target correlations restricted to each active set.
+    restr_sign : ndarray, 2-dimensional
+        The signs of the active coefficients.
+    restr_oldsol : ndarray, 2-dimensional
+        The current values of the active coefficients.
+    sparsity : ndarray, 2-dimensional
+        The coefficients on the L1 penalty of the active coefficients.
+
+    Returns
+    -------
+    new_solution : ndarray, 2-dimensional
+        The new values of the active coefficients.
+    """
+    rhs = restr_corr - sparsity * restr_sign / 2
+    try:
+        new_solution = np.linalg.solve(restr_gram,
+                                       rhs[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        # Use the pseudoinverse for the singular restricted Gram
+        # matrices (footnote 3 of the paper).
+        new_solution = np.array([np.linalg.lstsq(gram, r, rcond=-1)[0]
+                                 for gram, r in zip(restr_gram, rhs)])
+    flips = np.abs(np.sign(new_solution) - restr_sign) > 1
+    search = flips.any(axis=1)
+    if not search.any():
+        return new_solution
+    old = restr_oldsol[search]
+    diff = new_solution[search] - old
+    gram = restr_gram[search]
+    corr = restr_corr[search]
+    # Up to the constant term, the cost at old + step * diff is
+    # a0 + a1 * step + a2 * step ** 2 + sparsity . |old + step * diff|.
+    gram_old = np.einsum('ijk,ik->ij', gram, old)
+    gram_diff = np.einsum('ijk,ik->ij', gram, diff)
+    a0 = (old * (gram_old - 2 * corr)).sum(axis=1)
+    a1 = 2 * (diff * (gram_old - corr)).sum(axis=1)
+    a2 = (diff * gram_diff).sum(axis=1)
+    # The first step is the new solution, the others are the zero
+    # crossings of the coefficients whose signs flip.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steps = np.where(flips[search], -old / diff, 1.)
+    steps = np.hstack([np.ones((len(old), 1), dtype=steps.dtype), steps])
+    curr = old[:, np.newaxis, :] + steps[:, :, np.newaxis] * \
+        diff[:, np.newaxis, :]
+    costs = (a0[:, np.newaxis] + a1[:, np.newaxis] * steps +
+             a2[:, np.newaxis] * steps ** 2 +
+             (sparsity[search][:, np.newaxis, :] *
+              np.abs(curr)).sum(axis=2))
+    costs[:, 1:][~flips[search]] = np.inf
+    # Ties are broken in favor of the new solution, then of the first
+    # zero crossing, as in `_feature_sign_search_single`.
+    best = np.argmin(costs, axis=1)
+    crossing = best > 0
+    rows = np.flatnonzero(search)[crossing]
+    new_solution[rows] = curr[np.flatnonzero(crossing), best[crossing]]
+    return new_solution
+
+
+def _init_worker(*args):
+    """
+    Stores the arguments of the batched solver in a worker process.
+    """
+    global _worker_args
+    _worker_args = args
+
+
+def _solve_in_worker(bounds):
+    """
+    Solves the problems for the signals from `bounds[0]` to `bounds[1]`
+    in a worker process.
+    """
+    start, stop = bounds
+    dictionary, gram_matrix, signals, sparsity, max_iter = _worker_args
+    solution = np.zeros((stop - start, dictionary.shape[1]),
+                        dtype=signals.dtype)
+    iters = _feature_sign_search_batch(
+        gram_matrix, np.dot(signals[start:stop], dictionary),
+        sparsity[start:stop], max_iter, solution)
+    return start, solution, iters
+
+
 def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
-                        solution=None):
+                        solution=None, batch_size=1000, num_workers=1):
     """
     Solve L1-penalized quadratic minimization problems with
     feature-sign search.
@@ -246,8 +456,11 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
         The signal(s) to be decomposed as a sparse linear combination
         of the columns of the dictionary. If 2-dimensional, each
         different signal (training case) should be a row of this matrix.
-    sparsity : float
+    sparsity : float or array_like
         The coefficient on the L1 penalty term of the cost function.
+        If an array, it must be broadcastable to the shape of the
+        solution, and gives a different coefficient to each element of
+        the solution. Infinite coefficients keep elements at zero.
     max_iter : int, optional
         The maximum number of iterations to run, per code vector, if
         the optimization has still not converged. Default is 1000.
@@ -255,6 +468,13 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
         Pre-allocated vector or matrix used to store the solution(s).
         If provided, it should have the same rank as `signals`. If
         2-dimensional, it should have as many rows as `signals`.
+    batch_size : int, optional
+        The number of signals whose problems are solved together. The
+        active sets of the signals of a batch are advanced together,
+        sharing the Gram matrix of the dictionary. Default is 1000.
+    num_workers : int, optional
+        If larger than 1, the batches are solved by a pool of this many
+        forked processes. Default is 1.
 
     Returns
     -------
@@ -301,14 +521,40 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
     else:
         orig_sol = solution
         solution = np.atleast_2d(solution)
-    # Solve each minimization in sequence.
-    for row, (signal, sol) in enumerate(izip(signals, solution)):
-        _, iters = _feature_sign_search_single(dictionary, signal, sparsity,
-                                               max_iter, sol)
-        if iters >= max_iter:
-            log.warning("maximum number of iterations reached when "
-                        "optimizing code for training case %d; solution "
-                        "may not be optimal" % iters)
+    if batch_size < 1:
+        raise ValueError("batch_size must be positive, got %d" % batch_size)
+    sparsity = np.broadcast_to(sparsity, solution.shape)
+    # The Gram matrix is shared by all the problems.
+    gram_matrix = np.dot(dictionary.T, dictionary)
+    starts = xrange(0, signals.shape[0], batch_size)
+    bounds = [(start, min(start + batch_size, signals.shape[0]))
+              for start in starts]
+    iters = np.zeros(signals.shape[0], dtype='int64')
+    if num_workers > 1 and len(bounds) > 1:
+        if hasattr(multiprocessing, 'get_context'):
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing
+        pool = ctx.Pool(num_workers, _init_worker,
+                        (dictionary, gram_matrix, signals, sparsity,
+                         max_iter))
+        try:
+            for start, sol, batch_iters in pool.imap_unordered(
+                    _solve_in_worker, bounds):
+                solution[start:start + len(sol)] = sol
+                iters[start:start + len(sol)] = batch_iters
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for start, stop in bounds:
+            iters[start:stop] = _feature_sign_search_batch(
+                gram_matrix, np.dot(signals[start:stop], dictionary),
+                sparsity[start:stop], max_iter, solution[start:stop])
+    for row in np.flatnonzero(iters >= max_iter):
+        log.warning("maximum number of iterations reached when "
+                    "optimizing code for training case %d; solution "
+                    "may not be optimal" % row)
     # Attempt to return the exact same object reference.
     if orig_sol is not None and orig_sol.ndim == 1:
         solution = orig_sol
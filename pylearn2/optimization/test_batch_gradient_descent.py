@@ -171,5 +171,35 @@ def test_batch_gradient_descent():
                 assert False
 
 
+def test_num_workers():
+    """ Verify that evaluating the objective and the gradient in worker
+    processes, each holding a shard of the examples, gives the same
+    result as evaluating them in the main process."""
+
+    rng = np.random.RandomState([1, 2, 3])
+    X_value = np.cast[config.floatX](rng.randn(11, 4))
+    y_value = np.cast[config.floatX](rng.randn(11, 2))
+    W_init = np.cast[config.floatX](rng.randn(4, 2))
+
+    X = T.matrix(name='X')
+    y = T.matrix(name='y')
+
+    results = []
+    for num_workers in [1, 3]:
+        W = sharedX(W_init, name='W')
+        obj = T.sqr(T.dot(X, W) - y).sum(axis=1).mean() + \
+            np.cast[config.floatX](0.1) * T.sqr(W).sum()
+        minimizer = BatchGradientDescent(objective=obj, params=[W],
+                                         inputs=[X, y], max_iter=5,
+                                         conjugate=True,
+                                         num_workers=num_workers)
+        actual_obj = minimizer.minimize(X_value, y_value)
+        assert np.allclose(actual_obj, minimizer.obj(X_value, y_value))
+        minimizer.shutdown()
+        results.append(W.get_value())
+
+    assert np.allclose(results[0], results[1], rtol=1e-4, atol=1e-5)
+
+
 if __name__ == '__main__':
     test_batch_gradient_descent()
@@ -11,6 +11,7 @@ __email__ = "wardefar@iro"
 
 import numpy as np
 from pylearn2.optimization.feature_sign import feature_sign_search
+from pylearn2.optimization.feature_sign import _feature_sign_search_single
 
 
 class TestFeatureSign(object):
@@ -414,3 +415,21 @@ class TestFeatureSign(object):
         newsol = feature_sign_search(self.dictionary, signal, sparsity,
                                      solution=solution)
         assert solution is newsol
+
+
+def test_batches_match_single():
+    rng = np.random.RandomState(1)
+    dictionary = rng.normal(size=(20, 60))
+    dictionary /= np.sqrt((dictionary ** 2).sum(axis=0))
+    signals = rng.normal(size=(25, 20))
+    for sparsity in [0.5, 2.]:
+        reference = np.array([_feature_sign_search_single(dictionary, signal,
+                                                          sparsity, 1000)[0]
+                              for signal in signals])
+        solution = feature_sign_search(dictionary, signals, sparsity,
+                                       batch_size=10)
+        assert np.allclose(solution, reference)
+        assert np.all((solution == 0) == (reference == 0))
+        parallel = feature_sign_search(dictionary, signals, sparsity,
+                                       batch_size=7, num_workers=2)
+        assert np.allclose(parallel, solution)
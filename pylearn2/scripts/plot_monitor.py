@@ -4,9 +4,9 @@ usage:
 
 plot_monitor.py model_1.pkl model_2.pkl ... model_n.pkl
 
-Loads any number of .pkl files produced by train.py. Extracts
-all of their monitoring channels and prompts the user to select
-a subset of them to be plotted.
+Loads any number of .pkl files produced by train.py, or monitor logs
+(see `Monitor.set_log`). Extracts all of their monitoring channels and
+prompts the user to select a subset of them to be plotted.
 
 """
 from __future__ import print_function
@@ -24,6 +24,7 @@ import sys
 
 from theano.compat.six.moves import input, xrange
 from pylearn2.utils import serial
+from pylearn2.utils.monitor_log import is_monitor_log, read_monitor_log
 from theano.printing import _TagGenerator
 from pylearn2.utils.string_utils import number_aware_alphabetical_key
 from pylearn2.utils import contains_nan, contains_inf
@@ -89,15 +90,21 @@ def main():
     print('...done')
 
     for i, arg in enumerate(model_paths):
-        try:
-            model = serial.load(arg)
-        except Exception:
-            if arg.endswith('.yaml'):
-                print(sys.stderr, arg + " is a yaml config file," + 
-                      "you need to load a trained model.", file=sys.stderr)
-                quit(-1)
-            raise
-        this_model_channels = model.monitor.channels
+        if is_monitor_log(arg):
+            # Read the log written by the monitor, without the model
+            this_model_channels = read_monitor_log(arg)
+            model = None
+        else:
+            try:
+                model = serial.load(arg)
+            except Exception:
+                if arg.endswith('.yaml'):
+                    print(sys.stderr, arg + " is a yaml config file," +
+                          "you need to load a trained model.",
+                          file=sys.stderr)
+                    quit(-1)
+                raise
+            this_model_channels = model.monitor.channels
 
         if len(sys.argv) > 2:
             postfix = ":" + model_names[i]
@@ -15,19 +15,26 @@ __email__ = "pylearn-dev@googlegroups"
 
 def print_monitor(args):
     from pylearn2.utils import serial
+    from pylearn2.utils.monitor_log import is_monitor_log, read_monitor_log
     import gc
     for model_path in args:
         if len(args) > 1:
             print(model_path)
-        model = serial.load(model_path)
-        monitor = model.monitor
-        del model
-        gc.collect()
-        channels = monitor.channels
-        if not hasattr(monitor, '_epochs_seen'):
-            print('old file, not all fields parsed correctly')
+        if is_monitor_log(model_path):
+            # Read the log written by the monitor, without the model
+            channels = read_monitor_log(model_path)
+            print('epochs seen: ', max(channels[key].epoch_record[-1]
+                                       for key in channels))
         else:
-            print('epochs seen: ', monitor._epochs_seen)
+            model = serial.load(model_path)
+            monitor = model.monitor
+            del model
+            gc.collect()
+            channels = monitor.channels
+            if not hasattr(monitor, '_epochs_seen'):
+                print('old file, not all fields parsed correctly')
+            else:
+                print('epochs seen: ', monitor._epochs_seen)
         print('time trained: ', max(channels[key].time_record[-1] for key in
               channels))
         for key in sorted(channels.keys()):
@@ -19,6 +19,10 @@ class TerminationCriterion(object):
     running.
     """
 
+    # Whether continue_learning reads the monitoring channels. If True,
+    # Train waits for asynchronous monitoring to finish before calling it.
+    wait_for_monitor = False
+
     def continue_learning(self, model):
         """
         Returns True if training should continue for this model,
@@ -55,10 +59,19 @@ class MonitorBased(TerminationCriterion):
         Name of the channel to examine. If None and the monitor
         has only one channel, this channel will be used; otherwise, an
         error will be raised.
+    escalate_stderrs : float, optional
+        If the channel is computed on a subsample of its monitoring
+        dataset and its value is within this many standard errors of
+        the improvement threshold, it is recomputed on the whole dataset
+        (see `Monitor.escalate_if_close`) before deciding.
     """
 
-    def __init__(self, prop_decrease=.01, N=5, channel_name=None):
+    wait_for_monitor = True
+
+    def __init__(self, prop_decrease=.01, N=5, channel_name=None,
+                 escalate_stderrs=None):
         self._channel_name = channel_name
+        self.escalate_stderrs = escalate_stderrs
         self.prop_decrease = prop_decrease
         self.N = N
         self.countdown = N
@@ -86,9 +99,13 @@ class MonitorBased(TerminationCriterion):
         # available. However, if the monitor has multiple channels, leaving
         # the channel_name unspecified will raise an error.
         if self._channel_name is None:
-            v = monitor.channels['objective'].val_record
+            channel_name = 'objective'
         else:
-            v = monitor.channels[self._channel_name].val_record
+            channel_name = self._channel_name
+        monitor.escalate_if_close(channel_name,
+                                  (1. - self.prop_decrease) * self.best_value,
+                                  getattr(self, 'escalate_stderrs', None))
+        v = monitor.channels[channel_name].val_record
 
         # The countdown decreases every time the termination criterion is
         # called unless the channel value is lower than the best value times
@@ -128,6 +145,8 @@ class MatchChannel(TerminationCriterion):
         from the previous training run
     """
 
+    wait_for_monitor = True
+
     def __init__(self, channel_name, prev_channel_name, prev_monitor_name):
         self.__dict__.update(locals())
         self.target = None
@@ -161,6 +180,8 @@ class ChannelTarget(TerminationCriterion):
         Quit training after the channel is below this value
     """
 
+    wait_for_monitor = True
+
     def __init__(self, channel_name, target):
         target = float(target)
         self.__dict__.update(locals())
@@ -185,6 +206,8 @@ class ChannelInf(TerminationCriterion):
         The channel to track.
     """
 
+    wait_for_monitor = True
+
     def __init__(self, channel_name):
         self.__dict__.update(locals())
 
@@ -253,6 +276,14 @@ class And(TerminationCriterion):
         assert all(isinstance(x, TerminationCriterion) for x in list(criteria))
         self._criteria = list(criteria)
 
+    @property
+    def wait_for_monitor(self):
+        """
+        Whether any of the criteria reads the monitoring channels.
+        """
+        return any(getattr(criterion, 'wait_for_monitor', False)
+                   for criterion in self._criteria)
+
     @functools.wraps(TerminationCriterion.continue_learning)
     def continue_learning(self, model):
         return all(criterion.continue_learning(model)
@@ -279,6 +310,14 @@ class Or(TerminationCriterion):
         assert all(isinstance(x, TerminationCriterion) for x in list(criteria))
         self._criteria = list(criteria)
 
+    @property
+    def wait_for_monitor(self):
+        """
+        Whether any of the criteria reads the monitoring channels.
+        """
+        return any(getattr(criterion, 'wait_for_monitor', False)
+                   for criterion in self._criteria)
+
     @functools.wraps(TerminationCriterion.continue_learning)
     def continue_learning(self, model):
         return any(criterion.continue_learning(model)
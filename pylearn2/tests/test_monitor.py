@@ -633,5 +633,77 @@ def test_extra_costs():
                   extra_costs=extra_costs)
 
 
+def test_asynchronous():
+
+    # Makes sure asynchronous monitoring computes the channels on the
+    # parameters at the time of the call
+
+    num_features = 3
+    model = DummyModel(num_features=num_features)
+    W = sharedX(np.ones(num_features), 'W')
+    dataset = DummyDataset(num_examples=4, num_features=num_features)
+    monitor = Monitor.get_monitor(model)
+    monitor.add_dataset(dataset, 'sequential', batch_size=2)
+    X = T.matrix()
+    monitor.add_channel('sum_WX', ipt=X, val=T.dot(X, W).mean(),
+                        data_specs=(model.get_input_space(), 'features'))
+    monitor.set_asynchronous(True)
+    expected = []
+    for i in range(3):
+        expected.append(dataset.X.dot(W.get_value()).mean())
+        monitor()
+        monitor.report_epoch()
+        W.set_value(W.get_value() * 2)
+    channel = monitor.channels['sum_WX']
+    assert len(channel.val_record) == 2
+    monitor.wait()
+    assert np.allclose(channel.val_record, expected)
+    assert channel.epoch_record == [0, 1, 2]
+
+    # Pickling waits for the step in progress and adds it, and does not
+    # save the thread
+    monitor()
+    monitor = from_string(to_string(monitor))
+    assert len(monitor.channels['sum_WX'].val_record) == 4
+
+
+def test_subsample():
+
+    # Makes sure subsampled monitoring evaluates random subsets, records a
+    # standard error, and escalates to the full dataset
+
+    num_features = 2
+    for rotate in [False, True]:
+        monitor = Monitor(DummyModel(num_features))
+        dataset = DummyDataset(100, num_features)
+        monitor.add_dataset(dataset, 'sequential', batch_size=5,
+                            subsample=18, rotate_subsample=rotate)
+        X = T.matrix()
+        monitor.add_channel(name='mean', ipt=X, val=X.mean(),
+                            dataset=dataset,
+                            data_specs=(monitor.model.get_input_space(),
+                                        'features'))
+        monitor()
+        monitor()
+        channel = monitor.channels['mean']
+        full_mean = dataset.X.mean()
+        assert all(0 < stderr < 0.2 for stderr in channel.stderr_record)
+        assert all(abs(val - full_mean) < 4 * stderr for val, stderr
+                   in zip(channel.val_record, channel.stderr_record))
+        assert (channel.val_record[0] != channel.val_record[1]) == rotate
+
+        far = channel.val_record[-1] + 100 * channel.stderr_record[-1]
+        assert not monitor.escalate_if_close('mean', far, 2.)
+        assert monitor.escalate_if_close('mean', channel.val_record[-1], 2.)
+        assert np.allclose(channel.val_record[-1], full_mean)
+        assert channel.stderr_record[-1] == 0
+        assert len(channel.val_record) == 2
+
+    # A dataset no larger than the subsample is evaluated fully
+    small = DummyDataset(10, 2)
+    monitor.add_dataset(small, 'sequential', batch_size=5, subsample=10)
+    assert monitor._get_subsample()[monitor._datasets.index(small)] is None
+
+
 if __name__ == '__main__':
     test_revisit()
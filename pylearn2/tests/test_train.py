@@ -86,6 +86,82 @@ def test_execution_order():
 
     train.main_loop()
 
+class RecordCounter(TrainExtension):
+    """
+    Mock train extension checking that the monitor is up to date when
+    it waits for it
+    """
+
+    wait_for_monitor = True
+
+    def on_monitor(self, model, dataset, algorithm):
+        """
+        Check that every channel has a record for each epoch
+        """
+        epochs = model.monitor.get_epochs_seen()
+        for channel in model.monitor.channels.values():
+            assert channel.epoch_record[-1] == epochs
+
+
+def test_asynchronous_monitoring():
+
+    # ensure asynchronous monitoring gives the same records as
+    # synchronous monitoring.
+
+    records = []
+    for asynchronous in [False, True]:
+        model = MLP(layers=[Softmax(layer_name='y',
+                                    n_classes=2,
+                                    irange=0.)],
+                    nvis=3)
+        rng = np.random.RandomState(0)
+        dataset = DenseDesignMatrix(X=rng.normal(size=(6, 3)),
+                                    y=rng.normal(size=(6, 2)))
+        algorithm = SGD(batch_size=2, learning_rate=0.1,
+                        monitoring_dataset=dataset,
+                        termination_criterion=EpochCounter(max_epochs=3))
+        train = Train(dataset=dataset,
+                      model=model,
+                      algorithm=algorithm,
+                      extensions=[RecordCounter()],
+                      asynchronous_monitoring=asynchronous)
+        train.main_loop()
+        records.append(model.monitor.channels['objective'].val_record)
+    assert len(records[0]) == 4
+    assert np.allclose(records[0], records[1])
+
+
+def test_time_phases():
+
+    # ensure the phase channels report where the training time goes
+
+    model = MLP(layers=[Softmax(layer_name='y',
+                                n_classes=2,
+                                irange=0.)],
+                nvis=3)
+    rng = np.random.RandomState(0)
+    dataset = DenseDesignMatrix(X=rng.normal(size=(6, 3)),
+                                y=rng.normal(size=(6, 2)))
+    algorithm = SGD(batch_size=2, learning_rate=0.1,
+                    monitoring_dataset=dataset,
+                    termination_criterion=EpochCounter(max_epochs=2))
+    train = Train(dataset=dataset,
+                  model=model,
+                  algorithm=algorithm,
+                  extensions=[RecordCounter()],
+                  time_phases=True)
+    train.main_loop()
+    channels = model.monitor.channels
+    assert len(channels['seconds_train'].val_record) == 3
+    assert channels['seconds_train_update'].val_record[-1] > 0
+    assert channels['seconds_train_data_get'].val_record[-1] > 0
+    assert (channels['seconds_train_update'].val_record[-1] <=
+            channels['seconds_train'].val_record[-1])
+    assert channels['examples_per_second'].val_record[-1] > 0
+    assert 'seconds_extensions_RecordCounter' in channels
+    assert train.phase_timer.totals['monitor/data'] > 0
+
+
 def test_serialization_guard():
 
     # tests that Train refuses to serialize the dataset
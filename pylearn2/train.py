@@ -12,10 +12,13 @@ import logging
 import warnings
 from pylearn2.utils import serial
 from pylearn2.utils.string_utils import preprocess
+from pylearn2.compat import OrderedDict
 from pylearn2.monitor import Monitor
 from pylearn2.space import NullSpace
-from pylearn2.utils.timing import log_timing, total_seconds
+from pylearn2.utils.timing import (get_phase_timer, log_timing, PhaseTimer,
+                                   total_seconds)
 from pylearn2.utils import sharedX
+from pylearn2.utils.checkpoint import Checkpointer
 
 
 log = logging.getLogger(__name__)
@@ -52,11 +55,59 @@ class Train(object):
         If `True`, will save the model to save_path even if there is
         already something there. Otherwise, will raise an error if the
         `save_path` is already occupied.
+    asynchronous_monitoring : bool, optional
+        If `True`, the monitoring channels are computed in the
+        background on a copy of the parameters while training goes on.
+        Extensions and termination criteria with a true
+        `wait_for_monitor` attribute wait for the channels to be
+        up to date before being called. See `Monitor.set_asynchronous`.
+    checkpoint_path : str, optional
+        Path of a `.npz` file where the parameters of the model and the
+        state of the algorithm (e.g. momentum velocities) are saved every
+        `checkpoint_freq` epochs and after learning. This is much cheaper
+        than pickling the whole model to `save_path`, and can be restored
+        with `pylearn2.utils.checkpoint.load_checkpoint`.
+    checkpoint_freq : int, optional
+        Frequency of the checkpoints, in epochs. Default is 1.
+    asynchronous_checkpoint : bool, optional
+        If `True` (default), the checkpoints are written in the
+        background while training goes on. Only copying the values of
+        the parameters blocks training.
+    monitor_log_path : str, optional
+        Path of a log file where the monitoring channels are appended,
+        one row per monitoring step. `print_monitor.py` and
+        `plot_monitor.py` can read it without loading the model, and
+        saved models no longer hold the channel histories. See
+        `Monitor.set_log`.
+    time_phases : bool, optional
+        If `True`, the time spent in each phase of the main loop (getting
+        the batches from the dataset iterator, the compiled update, the
+        callbacks, monitoring, each extension, saving...) is measured.
+        The times since the previous monitoring step, and the number of
+        examples trained on per second, are reported as monitoring
+        channels named `seconds_<phase>` and `examples_per_second`, and
+        a summary of the whole run is logged at the end of the main loop.
+        See `pylearn2.utils.timing.PhaseTimer`.
     """
 
     def __init__(self, dataset, model, algorithm=None, save_path=None,
-                 save_freq=0, extensions=None, allow_overwrite=True):
+                 save_freq=0, extensions=None, allow_overwrite=True,
+                 asynchronous_monitoring=False, checkpoint_path=None,
+                 checkpoint_freq=1, asynchronous_checkpoint=True,
+                 monitor_log_path=None, time_phases=False):
         self.allow_overwrite = allow_overwrite
+        self.phase_timer = PhaseTimer() if time_phases else None
+        self.monitor_log_path = monitor_log_path
+        self.asynchronous_monitoring = asynchronous_monitoring
+        if checkpoint_freq < 1:
+            raise ValueError("checkpoint_freq must be at least 1, got %s"
+                             % str(checkpoint_freq))
+        self.checkpoint_freq = checkpoint_freq
+        if checkpoint_path is not None:
+            self.checkpointer = Checkpointer(checkpoint_path,
+                                             asynchronous_checkpoint)
+        else:
+            self.checkpointer = None
         self.first_save = True
         self.dataset = dataset
         self.model = model
@@ -117,6 +168,10 @@ class Train(object):
         """
         self.model.monitor = Monitor.get_monitor(self.model)
         self.model.monitor.time_budget_exceeded = False
+        if getattr(self, 'asynchronous_monitoring', False):
+            self.model.monitor.set_asynchronous(True)
+        if getattr(self, 'monitor_log_path', None) is not None:
+            self.model.monitor.set_log(self.monitor_log_path)
         if self.algorithm is not None:
             self.algorithm.setup(model=self.model, dataset=self.dataset)
         self.setup_extensions()
@@ -137,8 +192,26 @@ class Train(object):
             The maximum number of seconds before interrupting
             training. Default is `None`, no time limit.
         """
+        timer = getattr(self, 'phase_timer', None)
+        if timer is None:
+            self._main_loop(time_budget)
+            return
+        with timer.activate():
+            self._main_loop(time_budget)
+        log.info(timer.summary())
+
+    def _main_loop(self, time_budget):
+        """
+        Body of `main_loop`.
+
+        Parameters
+        ----------
+        time_budget : int or None
+            The maximum number of seconds before interrupting training.
+        """
         t0 = datetime.now()
         self.setup()
+        timer = get_phase_timer()
         if self.algorithm is None:
             extension_continue = self.run_callbacks_and_monitoring()
             # First check if the model is already beyond the stop criteria of
@@ -150,7 +223,8 @@ class Train(object):
                 if self.exceeded_time_budget(t0, time_budget):
                     break
 
-                rval = self.model.train_all(dataset=self.dataset)
+                with timer.phase('train'):
+                    rval = self.model.train_all(dataset=self.dataset)
                 if rval is not None:
                     raise ValueError(
                         "Model.train_all should not return anything. Use "
@@ -162,6 +236,7 @@ class Train(object):
                 if freq > 0 and \
                     self.model.monitor.get_epochs_seen() % freq == 0:
                     self.save()
+                self._checkpoint_if_needed()
                 continue_learning = (self.model.continue_learning() and
                                      extension_continue)
                 assert continue_learning in [True, False, 0, 1]
@@ -198,10 +273,13 @@ already been reported."""
                     val=self.total_seconds,
                     data_specs=(NullSpace(), ''),
                     dataset=self.model.monitor._datasets[0])
+                if getattr(self, 'phase_timer', None) is not None:
+                    self._add_phase_channels()
             extension_continue = self.run_callbacks_and_monitoring()
 
             # First check if the model is already beyond the stop criteria of
             # training, if so, just return directly.
+            self._wait_for_termination_criterion()
             continue_learning = (
                 self.algorithm.continue_learning(self.model) and
                 extension_continue
@@ -217,7 +295,8 @@ already been reported."""
                         log, None, final_msg='Time this epoch:',
                         callbacks=[self.training_seconds.set_value]
                     ):
-                        rval = self.algorithm.train(dataset=self.dataset)
+                        with timer.phase('train'):
+                            rval = self.algorithm.train(dataset=self.dataset)
                     if rval is not None:
                         raise ValueError(
                             "TrainingAlgorithm.train should not return "
@@ -231,16 +310,26 @@ already been reported."""
                         self.model.monitor.get_epochs_seen() % \
                         self.save_freq == 0:
                         self.save()
+                    self._checkpoint_if_needed()
+                self._wait_for_termination_criterion()
                 continue_learning = (
                     self.algorithm.continue_learning(self.model) and
                     extension_continue
                 )
                 assert continue_learning in [True, False, 0, 1]
 
+        self.model.monitor.wait()
         self.model.monitor.training_succeeded = True
 
         if self.save_freq > 0:
             self.save()
+        if getattr(self, 'checkpointer', None) is not None:
+            # Skip the final checkpoint if the last epoch was already
+            # checkpointed by _checkpoint_if_needed
+            last_epoch = getattr(self, '_checkpointed_epoch', None)
+            if last_epoch != self.model.monitor.get_epochs_seen():
+                self.checkpoint()
+            self.checkpointer.wait()
 
     def run_callbacks_and_monitoring(self):
         """
@@ -252,11 +341,20 @@ already been reported."""
             If `False`, signals that at least one train
             extension wants to stop learning.
         """
-        self.model.monitor()
+        self._report_phases()
+        timer = get_phase_timer()
+        with timer.phase('monitor'):
+            self.model.monitor()
         continue_learning = True
         for extension in self.extensions:
+            if getattr(extension, 'wait_for_monitor', False):
+                with timer.phase('monitor'):
+                    self.model.monitor.wait()
             try:
-                extension.on_monitor(self.model, self.dataset, self.algorithm)
+                with timer.phase('extensions'):
+                    with timer.phase(type(extension).__name__):
+                        extension.on_monitor(self.model, self.dataset,
+                                             self.algorithm)
             except TypeError:
                 logging.warning('Failure during callback ' + str(extension))
                 raise
@@ -268,14 +366,103 @@ already been reported."""
                 continue_learning = False
         return continue_learning
 
+    def _add_phase_channels(self):
+        """
+        Adds the monitoring channels reporting the time spent in the
+        main phases of the main loop, and the training throughput.
+        """
+        phases = ['train', 'train/data', 'train/data/index',
+                  'train/data/get', 'train/data/format', 'train/update',
+                  'train/callbacks', 'monitor', 'extensions', 'save']
+        for extension in self.extensions:
+            phase = 'extensions/' + type(extension).__name__
+            if phase not in phases:
+                phases.append(phase)
+        monitor = self.model.monitor
+        self._phase_channels = OrderedDict()
+        for phase in phases:
+            shared = sharedX(0., name='seconds_' + phase.replace('/', '_'))
+            shared.__doc__ = ("The number of seconds spent in phase %s of "
+                              "the main loop since the previous monitoring "
+                              "step. See pylearn2.utils.timing.PhaseTimer."
+                              % phase)
+            self._phase_channels[phase] = shared
+        self.examples_per_second = sharedX(0., name='examples_per_second')
+        self.examples_per_second.__doc__ = """\
+The number of examples trained on per second spent in the training algorithm
+since the previous monitoring step."""
+        for shared in list(self._phase_channels.values()) + \
+                [self.examples_per_second]:
+            monitor.add_channel(name=shared.name,
+                                ipt=None,
+                                val=shared,
+                                data_specs=(NullSpace(), ''),
+                                dataset=monitor._datasets[0])
+        self._examples_at_reset = monitor.get_examples_seen()
+
+    def _report_phases(self):
+        """
+        Sets the values of the phase channels to the time spent in each
+        phase since the previous call, and resets the phase timer.
+        """
+        timer = getattr(self, 'phase_timer', None)
+        if timer is None or not hasattr(self, '_phase_channels'):
+            return
+        for phase, shared in self._phase_channels.items():
+            shared.set_value(timer.seconds.get(phase, 0.))
+        examples_seen = self.model.monitor.get_examples_seen()
+        seconds = timer.seconds.get('train', 0.)
+        if seconds > 0:
+            self.examples_per_second.set_value(
+                (examples_seen - self._examples_at_reset) / seconds)
+        else:
+            self.examples_per_second.set_value(0.)
+        self._examples_at_reset = examples_seen
+        timer.reset()
+
+    def _wait_for_termination_criterion(self):
+        """
+        Waits for the monitoring step in progress if the termination
+        criterion of the algorithm reads the monitoring channels.
+        """
+        criterion = getattr(self.algorithm, 'termination_criterion', None)
+        if getattr(criterion, 'wait_for_monitor', False):
+            self.model.monitor.wait()
+
+    def _checkpoint_if_needed(self):
+        """
+        Checkpoints the model if a checkpoint is due this epoch.
+        """
+        if getattr(self, 'checkpointer', None) is None:
+            return
+        if self.model.monitor.get_epochs_seen() % self.checkpoint_freq == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Saves the parameters of the model and the state of the algorithm
+        to `checkpoint_path`.
+        """
+        with log_timing(log, None, level=logging.DEBUG,
+                        final_msg='Checkpointing to %s took'
+                        % self.checkpointer.path):
+            with get_phase_timer().phase('save'):
+                self.checkpointer.save(self.model, self.algorithm)
+        self._checkpointed_epoch = self.model.monitor.get_epochs_seen()
+
     def save(self):
         """Saves the model."""
         #TODO-- save state of training algorithm so training can be
         # resumed after a crash
-        for extension in self.extensions:
-            extension.on_save(self.model, self.dataset, self.algorithm)
+        timer = get_phase_timer()
+        with timer.phase('extensions'):
+            for extension in self.extensions:
+                with timer.phase(type(extension).__name__):
+                    extension.on_save(self.model, self.dataset,
+                                      self.algorithm)
         if self.save_path is not None:
-            with log_timing(log, 'Saving to ' + self.save_path):
+            with log_timing(log, 'Saving to ' + self.save_path), \
+                    timer.phase('save'):
                 if self.first_save and (not self.allow_overwrite) \
                    and os.path.exists(self.save_path):
                     # Every job overwrites its own output on the second save
@@ -25,6 +25,11 @@ class TrainExtension(object):
     base class that overrides any subset of these no-op methods.
     """
 
+    # Whether on_monitor needs the values of the monitoring step that
+    # just started. If True, Train waits for asynchronous monitoring to
+    # finish before calling on_monitor.
+    wait_for_monitor = False
+
     def on_save(self, model, dataset, algorithm):
         """
         Train calls this immediately before it saves the model.
@@ -144,6 +149,8 @@ class ChannelSmoother(TrainExtension):
     k : WRITEME
     """
 
+    wait_for_monitor = True
+
     def __init__(self, channel_to_smooth, channel_to_publish, k=5):
         self.__dict__.update(locals())
         del self.self
@@ -122,10 +122,19 @@ class MonitorBasedSaveBest(TrainExtension):
     tag_key : str, optional
         A unique key to use for storing diagnostic information in
         `model.tag`. If `None`, use the class name (default).
+    escalate_stderrs : float, optional
+        If the channel is computed on a subsample of its monitoring
+        dataset and its value is within this many standard errors of the
+        best value so far, it is recomputed on the whole dataset (see
+        `Monitor.escalate_if_close`) before deciding whether to save.
     """
+    wait_for_monitor = True
+
     def __init__(self, channel_name, save_path=None, store_best_model=False,
-                 start_epoch=0, higher_is_better=False, tag_key=None):
+                 start_epoch=0, higher_is_better=False, tag_key=None,
+                 escalate_stderrs=None):
         self.channel_name = channel_name
+        self.escalate_stderrs = escalate_stderrs
         assert save_path is not None or store_best_model, (
             "Either save_path must be defined or store_best_model must be " +
             "True. (Or both.)")
@@ -191,6 +200,9 @@ class MonitorBasedSaveBest(TrainExtension):
             Not used
         """
         monitor = model.monitor
+        if monitor._epochs_seen >= self.start_epoch:
+            monitor.escalate_if_close(self.channel_name, self.best_cost,
+                                      getattr(self, 'escalate_stderrs', None))
         channels = monitor.channels
         channel = channels[self.channel_name]
         val_record = channel.val_record
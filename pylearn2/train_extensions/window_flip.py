@@ -93,6 +93,13 @@ class WindowAndFlip(TrainExtension):
     flip : bool, optional
         Reflect images on the horizontal axis with probability
         0.5. `True` by default.
+
+    Notes
+    -----
+    This extension keeps a padded copy of every randomized dataset and
+    rewrites it entirely at each epoch. To window and flip each
+    minibatch on the fly instead, wrap the training dataset in a
+    `pylearn2.datasets.augmentation.AugmentedDataset`.
     """
     def __init__(self,
                  window_shape,
@@ -29,6 +29,7 @@ from pylearn2.utils import sharedX
 from pylearn2.space import CompositeSpace, NullSpace
 from pylearn2.utils.data_specs import DataSpecsMapping
 from pylearn2.utils.rng import make_np_rng
+from pylearn2.utils.timing import get_phase_timer
 
 
 logger = logging.getLogger(__name__)
@@ -88,6 +89,11 @@ class BGD(TrainingAlgorithm):
     theano_function_mode : WRITEME
     init_alpha : WRITEME
     seed : WRITEME
+    num_workers : int, optional
+        Passed through to the optimization.BatchGradientDescent's
+        `num_workers` parameter. If larger than 1, the objective and the
+        gradient on each batch are evaluated by this many processes, each
+        holding a shard of the batch.
     """
 
     def __init__(self, cost=None, batch_size=None, batches_per_iter=None,
@@ -97,7 +103,8 @@ class BGD(TrainingAlgorithm):
                  reset_alpha=True, conjugate=False, min_init_alpha=.001,
                  reset_conjugate=True, line_search_mode=None,
                  verbose_optimization=False, scale_step=1.,
-                 theano_function_mode=None, init_alpha=None, seed=None):
+                 theano_function_mode=None, init_alpha=None, seed=None,
+                 num_workers=1):
 
         self.__dict__.update(locals())
         del self.self
@@ -233,7 +240,8 @@ class BGD(TrainingAlgorithm):
             min_init_alpha=self.min_init_alpha,
             line_search_mode=self.line_search_mode,
             theano_function_mode=self.theano_function_mode,
-            init_alpha=self.init_alpha)
+            init_alpha=self.init_alpha,
+            num_workers=getattr(self, 'num_workers', 1))
 
         # These monitoring channels keep track of shared variables,
         # which do not need inputs nor data.
@@ -298,19 +306,22 @@ class BGD(TrainingAlgorithm):
                                     rng=rng)
 
         mode = self.theano_function_mode
-        for data in iterator:
+        timer = get_phase_timer()
+        for data in timer.iterate('data', iterator):
             if ('targets' in source_tuple and mode is not None
                     and hasattr(mode, 'record')):
                 Y = data[source_tuple.index('targets')]
                 stry = str(Y).replace('\n', ' ')
                 mode.record.handle_line('data Y ' + stry + '\n')
 
-            for on_load_batch in self.on_load_batch:
-                on_load_batch(mapping.nest(data))
+            with timer.phase('callbacks'):
+                for on_load_batch in self.on_load_batch:
+                    on_load_batch(mapping.nest(data))
 
-            self.before_step(model)
-            self.optimizer.minimize(*data)
-            self.after_step(model)
+            with timer.phase('update'):
+                self.before_step(model)
+                self.optimizer.minimize(*data)
+                self.after_step(model)
             actual_batch_size = flat_data_specs[0].np_batch_size(data)
             model.monitor.report_batch(actual_batch_size)
 
@@ -358,6 +369,8 @@ class StepShrinker(TrainExtension, TerminationCriterion):
         WRITEME
     """
 
+    wait_for_monitor = True
+
     def __init__(self, channel, scale, giveup_after, scale_up=1.,
                  max_scale=1.):
         self.__dict__.update(locals())
@@ -0,0 +1,488 @@
+"""
+Data-parallel Stochastic Gradient Descent using several worker
+processes on a single machine.
+"""
+from __future__ import division
+
+__license__ = "3-clause BSD"
+
+import logging
+import multiprocessing
+import traceback
+
+import numpy as np
+import theano
+from theano.compat.six.moves import xrange
+
+from pylearn2.space import CompositeSpace
+from pylearn2.training_algorithms.sgd import SGD
+from pylearn2.utils import safe_zip
+from pylearn2.utils.data_specs import DataSpecsMapping
+from pylearn2.utils.iteration import (is_stochastic, resolve_iterator_class,
+                                      SubsetIterator)
+
+
+log = logging.getLogger(__name__)
+
+
+class ShardIterator(SubsetIterator):
+    """
+    A class which wraps another subset iterator and only returns every
+    `num_shards`-th batch of it, starting with batch number `shard`.
+    Iterators built with the same random number generator state for
+    each shard visit disjoint sets of batches which together cover what
+    the wrapped iterator would have returned.
+
+    This class needs to be completed using type(), like
+    `ForcedEvenIterator`. Use `as_shard` to do so.
+
+    Parameters
+    ----------
+    dataset_size : int
+        Total number of examples in the dataset
+    batch_size : int or None
+        The size of the batches.
+    num_batches : int or None
+        The number of batches of the wrapped iterator, for all the
+        shards together.
+    *args : Variable length argument list for _base_iterator_cls
+    **kwargs : Arbitrary keyword arguments for _base_iterator_cls
+    """
+
+    def __init__(self, dataset_size, batch_size, num_batches, *args,
+                 **kwargs):
+        if self._base_iterator_cls is None:
+            raise ValueError("You must pre-define _base_iterator_cls, shard "
+                             "and num_shards by creating a new class with "
+                             "as_shard().")
+        self._base_iterator = self._base_iterator_cls(dataset_size,
+                                                      batch_size,
+                                                      num_batches,
+                                                      *args, **kwargs)
+        self._skip = self.shard
+
+    fancy = None
+    stochastic = None
+    _base_iterator_cls = None
+    shard = 0
+    num_shards = 1
+
+    @property
+    def _dataset_size(self):
+        return self._base_iterator._dataset_size
+
+    @property
+    def _batch_size(self):
+        return self._base_iterator.batch_size
+
+    @property
+    def _num_batches(self):
+        total = int(self._base_iterator.num_batches)
+        return max(0, (total - self.shard + self.num_shards - 1) //
+                   self.num_shards)
+
+    @property
+    def num_examples(self):
+        """
+        Upper bound on the number of examples visited by this shard.
+        """
+        return min(self.batch_size * self.num_batches,
+                   self._base_iterator.num_examples)
+
+    @property
+    def uneven(self):
+        """
+        Whether batches of the wrapped iterator may have differing sizes.
+        """
+        return self._base_iterator.uneven
+
+    @property
+    def uniform_batch_size(self):
+        """
+        Whether the wrapped iterator ensures equal batch sizes.
+        """
+        return self._base_iterator.uniform_batch_size
+
+    def next(self):
+        """
+        Returns the next batch of this shard.
+
+        Raises
+        ------
+        StopIteration
+            When the wrapped iterator has no batches left for this shard.
+        """
+        for i in xrange(self._skip):
+            self._base_iterator.next()
+        self._skip = self.num_shards - 1
+        return self._base_iterator.next()
+
+    def __next__(self):
+        return self.next()
+
+
+def as_shard(iterator_cls, shard, num_shards):
+    """
+    Returns a class wrapping `iterator_cls` that only returns the batches
+    of shard number `shard` out of `num_shards`.
+
+    Parameters
+    ----------
+    iterator_cls : str or class
+        An iteration mode string or a class following the
+        `SubsetIterator` interface.
+    shard : int
+        Index of the shard, from 0 to `num_shards - 1`.
+    num_shards : int
+        Number of shards.
+
+    Returns
+    -------
+    class
+        An iterator class based on `ShardIterator`.
+    """
+    iterator_cls = resolve_iterator_class(iterator_cls)
+    if not 0 <= shard < num_shards:
+        raise ValueError("shard must be in [0, %d), got %d" %
+                         (num_shards, shard))
+    dct = dict(_base_iterator_cls=iterator_cls,
+               fancy=iterator_cls.fancy,
+               stochastic=iterator_cls.stochastic,
+               shard=shard,
+               num_shards=num_shards)
+    return type("Shard%d%s" % (shard, iterator_cls.__name__),
+                (ShardIterator,), dct)
+
+
+def _get_context():
+    """
+    Returns a multiprocessing context that forks, so that the workers
+    inherit the compiled Theano functions of the parent.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+class ParallelSGD(SGD):
+    """
+    Data-parallel SGD. After `setup`, `num_workers` processes are forked
+    from the training process. Each epoch, the batches the training
+    iterator would return are split between the workers, which run the
+    compiled SGD update on their own share. The parameters are kept in
+    shared memory and combined either:
+
+    - Hogwild-style (`sync_freq=None`): every worker adds the change made
+      by each of its updates to the shared parameters, without locking,
+      and reads them back before its next update.
+    - By synchronous averaging (`sync_freq=K`): every worker does `K`
+      updates on a local copy of the parameters, then the copies of all
+      the workers are averaged into the shared parameters, which every
+      worker then continues from.
+
+    At the end of each epoch the shared parameters are copied back into
+    the model, so monitoring, train extensions and `Train.save` work on
+    the model exactly as with `SGD`.
+
+    Parameters
+    ----------
+    learning_rate : float
+        See `SGD`.
+    num_workers : int, optional
+        Number of worker processes. With fewer than 2 workers, training
+        happens in the training process, as with `SGD`.
+    sync_freq : int, optional
+        Number of updates each worker does between two averaging steps.
+        If None, the workers update the shared parameters Hogwild-style.
+    kwargs : dict
+        Passed on to `SGD`. `batches_per_call` and `shared_dataset` are
+        not supported.
+
+    Notes
+    -----
+    The workers are forked, so this only works on platforms supporting
+    `fork`, and not with functions compiled for the GPU.
+
+    State updated by the learning rule (e.g. momentum velocities) is kept
+    by each worker and is not shared. Values of shared variables that the
+    update only reads, such as the learning rate and momentum, are sent
+    to the workers at the start of every epoch, so changes made by train
+    extensions between epochs are honoured. `update_callbacks` are run by
+    the training process once per batch at the end of the epoch, so
+    changes they make only reach the workers at the next epoch.
+    """
+
+    def __init__(self, learning_rate, num_workers=2, sync_freq=None,
+                 **kwargs):
+        if kwargs.get('batches_per_call', 1) != 1:
+            raise ValueError("ParallelSGD does not support batches_per_call")
+        if kwargs.get('shared_dataset', False):
+            raise ValueError("ParallelSGD does not support shared_dataset")
+        if sync_freq is not None and sync_freq < 1:
+            raise ValueError("sync_freq must be None or at least 1, got %d"
+                             % sync_freq)
+        super(ParallelSGD, self).__init__(learning_rate, **kwargs)
+        self.num_workers = num_workers
+        self.sync_freq = sync_freq
+        self._workers = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_workers'] = None
+        for key in ['_shared_params', '_worker_params', '_sync_vars']:
+            state.pop(key, None)
+        return state
+
+    def setup(self, model, dataset):
+        """
+        Compiles the theano functions needed for the train method.
+
+        Parameters
+        ----------
+        model : a Model instance
+        dataset : Dataset
+        """
+        self.shutdown()
+        super(ParallelSGD, self).setup(model, dataset)
+
+        # Shared variables read but not updated by sgd_update, e.g. the
+        # learning rate, have to be sent to the workers every epoch.
+        maker = self.sgd_update.maker
+        updated = set(maker.fgraph.update_mapping.values())
+        self._sync_vars = [
+            maker_input.variable
+            for i, maker_input in enumerate(maker.inputs)
+            if i not in updated and
+            isinstance(maker_input.variable, theano.compile.SharedVariable)]
+
+    def _allocate(self, values):
+        """
+        Returns numpy arrays in shared memory with the shapes and dtypes
+        of `values`.
+        """
+        ctx = _get_context()
+        rval = []
+        for value in values:
+            buf = ctx.RawArray('b', max(1, value.nbytes))
+            array = np.frombuffer(buf, dtype=value.dtype,
+                                  count=value.size).reshape(value.shape)
+            rval.append(array)
+        return rval
+
+    def _start_workers(self, dataset):
+        """
+        Forks the worker processes, which will train on `dataset`.
+        """
+        values = [param.get_value(borrow=True) for param in self.params]
+        self._shared_params = self._allocate(values)
+        self._worker_params = None
+        if self.sync_freq is not None:
+            self._worker_params = [self._allocate(values)
+                                   for i in xrange(self.num_workers)]
+        ctx = _get_context()
+        workers = []
+        for i in xrange(self.num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=self._worker_loop,
+                                  args=(i, dataset, child_conn))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn))
+        self._workers = (dataset, workers)
+
+    def shutdown(self):
+        """
+        Stops the worker processes, if any.
+        """
+        if getattr(self, '_workers', None) is None:
+            return
+        for process, conn in self._workers[1]:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for process, conn in self._workers[1]:
+            process.join()
+            conn.close()
+        self._workers = None
+
+    def __del__(self):
+        try:
+            self.shutdown()
+        except Exception:
+            pass
+
+    def _flat_data_specs(self):
+        """
+        Returns the flat data specs used to iterate over the dataset.
+        """
+        data_specs = self.cost.get_data_specs(self.model)
+        mapping = DataSpecsMapping(data_specs)
+        space_tuple = mapping.flatten(data_specs[0], return_tuple=True)
+        source_tuple = mapping.flatten(data_specs[1], return_tuple=True)
+        if len(space_tuple) == 0:
+            raise NotImplementedError(
+                "Unable to train with SGD, because "
+                "the cost does not actually use data from the data set. "
+                "data_specs: %s" % str(data_specs))
+        return (CompositeSpace(space_tuple), source_tuple)
+
+    def _load_params(self, values):
+        """
+        Sets the (local) parameters to copies of `values`.
+        """
+        for param, value in safe_zip(self.params, values):
+            param.set_value(value.copy(), borrow=True)
+
+    def _worker_loop(self, index, dataset, conn):
+        """
+        Main loop of worker number `index`: runs one epoch on its shard of
+        `dataset` per request received through `conn`.
+        """
+        try:
+            flat_data_specs = self._flat_data_specs()
+            mode = as_shard(self.train_iteration_mode, index,
+                            self.num_workers)
+            while True:
+                request = conn.recv()
+                if request is None:
+                    break
+                seed, sync_values = request
+                for var, value in safe_zip(self._sync_vars, sync_values):
+                    var.set_value(value)
+                rng = None
+                if seed is not None:
+                    rng = np.random.RandomState(seed)
+                iterator = dataset.iterator(mode=mode,
+                                            batch_size=self.batch_size,
+                                            data_specs=flat_data_specs,
+                                            return_tuple=True, rng=rng,
+                                            num_batches=self.batches_per_iter)
+                sizes = self._worker_epoch(index, iterator, flat_data_specs,
+                                           conn)
+                conn.send(('done', sizes))
+        except (KeyboardInterrupt, EOFError):
+            pass
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        finally:
+            conn.close()
+
+    def _worker_epoch(self, index, iterator, flat_data_specs, conn):
+        """
+        Trains worker number `index` on the batches of `iterator`, and
+        returns the list of their sizes.
+        """
+        shared_params = self._shared_params
+        sizes = []
+        if self.sync_freq is None:
+            for batch in iterator:
+                old = [value.copy() for value in shared_params]
+                self._load_params(old)
+                for callback in self.on_load_batch:
+                    callback(*batch)
+                self.sgd_update(*batch)
+                for param, value, old_value in safe_zip(self.params,
+                                                        shared_params, old):
+                    value += param.get_value(borrow=True) - old_value
+                sizes.append(flat_data_specs[0].np_batch_size(batch))
+            return sizes
+
+        local = self._worker_params[index]
+        self._load_params(shared_params)
+        for batch in iterator:
+            for callback in self.on_load_batch:
+                callback(*batch)
+            self.sgd_update(*batch)
+            sizes.append(flat_data_specs[0].np_batch_size(batch))
+            if len(sizes) % self.sync_freq == 0:
+                for param, value in safe_zip(self.params, local):
+                    value[...] = param.get_value(borrow=True)
+                conn.send(('sync', None))
+                if conn.recv() is None:
+                    raise EOFError()
+                self._load_params(shared_params)
+        for param, value in safe_zip(self.params, local):
+            value[...] = param.get_value(borrow=True)
+        return sizes
+
+    def _receive(self, conn):
+        """
+        Receives a message from a worker, raising its errors.
+        """
+        try:
+            kind, payload = conn.recv()
+        except EOFError:
+            raise RuntimeError("A ParallelSGD worker died unexpectedly")
+        if kind == 'error':
+            self.shutdown()
+            raise RuntimeError("Error in ParallelSGD worker:\n" + payload)
+        return kind, payload
+
+    def _average(self, indices):
+        """
+        Sets the shared parameters to the average of the parameters of
+        the workers in `indices`.
+        """
+        for i, value in enumerate(self._shared_params):
+            value[...] = np.mean([self._worker_params[j][i]
+                                  for j in indices], axis=0)
+
+    def train(self, dataset):
+        """
+        Runs one epoch of data-parallel SGD training on the specified
+        dataset.
+
+        Parameters
+        ----------
+        dataset : Dataset
+        """
+        if self.num_workers < 2:
+            return super(ParallelSGD, self).train(dataset)
+        if not hasattr(self, 'sgd_update'):
+            raise Exception("train called without first calling setup")
+
+        self._check_params_finite()
+        self.first = False
+
+        if self._workers is not None and self._workers[0] is not dataset:
+            self.shutdown()
+        if self._workers is None:
+            self._start_workers(dataset)
+        workers = self._workers[1]
+
+        for param, value in safe_zip(self.params, self._shared_params):
+            value[...] = param.get_value(borrow=True)
+        seed = None
+        if is_stochastic(self.train_iteration_mode):
+            seed = self.rng.randint(2 ** 30)
+        sync_values = [var.get_value() for var in self._sync_vars]
+        for process, conn in workers:
+            conn.send((seed, sync_values))
+
+        sizes = [None] * len(workers)
+        running = list(range(len(workers)))
+        while running:
+            syncing = []
+            for i in running:
+                kind, payload = self._receive(workers[i][1])
+                if kind == 'done':
+                    sizes[i] = payload
+                else:
+                    syncing.append(i)
+            if self.sync_freq is not None:
+                self._average(running)
+            for i in syncing:
+                workers[i][1].send(True)
+            running = syncing
+
+        for param, value in safe_zip(self.params, self._shared_params):
+            param.set_value(value.copy(), borrow=True)
+        for worker_sizes in sizes:
+            for size in worker_sizes:
+                self.monitor.report_batch(size)
+                for callback in self.update_callbacks:
+                    callback(self)
+
+        self._check_params_finite()
@@ -15,9 +15,10 @@ import logging
 import warnings
 
 import numpy as np
+import theano
 from theano.compat import six
 from theano import config
-from theano import function
+from theano import tensor
 from theano.gof.op import get_debug_values
 
 from pylearn2.compat import OrderedDict, first_key
@@ -28,17 +29,19 @@ from pylearn2.training_algorithms.training_algorithm import TrainingAlgorithm
 from pylearn2.training_algorithms.learning_rule import Momentum
 from pylearn2.training_algorithms.learning_rule import (
     MomentumAdjustor as LRMomentumAdjustor)
-from pylearn2.utils.iteration import is_stochastic, has_uniform_batch_size
+from pylearn2.utils.iteration import (is_stochastic, has_uniform_batch_size,
+                                      resolve_iterator_class)
 from pylearn2.utils import py_integer_types, py_float_types
 from pylearn2.utils import safe_zip
 from pylearn2.utils import serial
 from pylearn2.utils import sharedX
 from pylearn2.utils import contains_nan
 from pylearn2.utils import contains_inf
+from pylearn2.utils import function
 from pylearn2.utils import isfinite
 from pylearn2.utils.data_specs import DataSpecsMapping
 from pylearn2.utils.exc import reraise_as
-from pylearn2.utils.timing import log_timing
+from pylearn2.utils.timing import get_phase_timer, log_timing
 from pylearn2.utils.rng import make_np_rng
 
 
@@ -149,6 +152,45 @@ class SGD(TrainingAlgorithm):
     seed : valid argument to np.random.RandomState, optional
         The seed used for the random number generate to be passed to the
         training dataset iterator (if any)
+    prefetch : int, optional
+        If positive, the training dataset iterator retrieves this many
+        upcoming batches on background threads while `sgd_update` runs
+        on the current one. The training dataset's `iterator` method must
+        accept a `prefetch` argument. Defaults to 0 (no prefetching).
+    batches_per_call : int, optional
+        If larger than 1, `train` stacks this many consecutive minibatches
+        of the same size and applies their updates sequentially inside a
+        single compiled function (a `scan` over the minibatches), which
+        removes most of the per-minibatch Python and Theano call overhead
+        when training small models. The monitor still counts every
+        minibatch, and `update_callbacks` are still called once per
+        minibatch, but only after the whole group was processed, so
+        changes they make (e.g. to the learning rate) take effect every
+        `batches_per_call` minibatches. Costs that need `on_load_batch`
+        callbacks and sparse inputs are not supported and train one
+        minibatch at a time. Defaults to 1.
+    shared_dataset : bool, optional
+        If True, `setup` copies the sources of the training dataset that
+        the cost needs (e.g. the `X` and `y` of a `DenseDesignMatrix`)
+        into shared variables once, and compiles an update function that
+        only takes the indices of the examples of a minibatch and slices
+        them in the graph (through `givens`). This removes the copy of
+        every minibatch to the compiled function. If the dataset does not
+        expose its data as numpy arrays (through `get_data`), if it is
+        larger than `shared_dataset_max_bytes`, or if it can't be
+        formatted in the graph, training falls back to the usual
+        iterator. Takes precedence over `batches_per_call`. Defaults to
+        False.
+    shared_dataset_max_bytes : int, optional
+        Maximum total size of the arrays copied to shared variables when
+        `shared_dataset` is True. Defaults to no limit.
+    monitoring_subsample : int, optional
+        If given, each monitoring step evaluates the channels on a random
+        subset of this many examples of each monitoring dataset, and
+        records their standard error. See `Monitor.add_dataset`.
+    monitoring_rotate_subsample : bool, optional
+        Whether to draw a different monitoring subset at each monitoring
+        step. Defaults to False (the same subset every time).
     """
     def __init__(self, learning_rate, cost=None, batch_size=None,
                  monitoring_batch_size=None, monitoring_batches=None,
@@ -158,7 +200,10 @@ class SGD(TrainingAlgorithm):
                  learning_rule=None, set_batch_size=False,
                  train_iteration_mode=None, batches_per_iter=None,
                  theano_function_mode=None, monitoring_costs=None,
-                 seed=[2012, 10, 5]):
+                 seed=[2012, 10, 5], prefetch=0, batches_per_call=1,
+                 shared_dataset=False, shared_dataset_max_bytes=None,
+                 monitoring_subsample=None,
+                 monitoring_rotate_subsample=False):
 
         if isinstance(cost, (list, tuple, set)):
             raise TypeError("SGD no longer supports using collections of " +
@@ -192,6 +237,15 @@ class SGD(TrainingAlgorithm):
         self.rng = make_np_rng(seed, which_method=["randn", "randint"])
         self.theano_function_mode = theano_function_mode
         self.monitoring_costs = monitoring_costs
+        self.prefetch = prefetch
+        if batches_per_call < 1:
+            raise ValueError("batches_per_call must be at least 1, got %d"
+                             % batches_per_call)
+        self.batches_per_call = batches_per_call
+        self.shared_dataset = shared_dataset
+        self.shared_dataset_max_bytes = shared_dataset_max_bytes
+        self.monitoring_subsample = monitoring_subsample
+        self.monitoring_rotate_subsample = monitoring_rotate_subsample
 
     def _setup_monitor(self):
         """
@@ -213,7 +267,13 @@ class SGD(TrainingAlgorithm):
                                batch_size=self.monitoring_batch_size,
                                num_batches=self.monitoring_batches,
                                extra_costs=self.monitoring_costs,
-                               mode=self.monitor_iteration_mode)
+                               mode=self.monitor_iteration_mode,
+                               subsample=getattr(self,
+                                                 'monitoring_subsample',
+                                                 None),
+                               rotate_subsample=getattr(
+                                   self, 'monitoring_rotate_subsample',
+                                   False))
             dataset_name = first_key(self.monitoring_dataset)
             monitoring_dataset = self.monitoring_dataset[dataset_name]
             # TODO: have Monitor support non-data-dependent channels
@@ -399,10 +459,258 @@ class SGD(TrainingAlgorithm):
             self.sgd_update = function(theano_args,
                                        updates=updates,
                                        name='sgd_update',
-                                       on_unused_input='ignore',
                                        mode=self.theano_function_mode)
         self.params = params
 
+        self._indexed_update = None
+        self._shared_data = None
+        if getattr(self, 'shared_dataset', False):
+            self._indexed_update = self._compile_indexed_update(
+                dataset, theano_args, space_tuple, source_tuple, updates)
+
+        self._fused_update = None
+        if (getattr(self, 'batches_per_call', 1) > 1 and
+                self._indexed_update is None):
+            self._fused_update = self._compile_fused_update(theano_args,
+                                                            updates)
+
+    def _compile_indexed_update(self, dataset, theano_args, space_tuple,
+                                source_tuple, updates):
+        """
+        Copies the training data into shared variables and compiles a
+        function applying `updates` to the examples at given indices.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The training dataset.
+        theano_args : tuple
+            The inputs of `sgd_update`.
+        space_tuple : tuple
+            The space of each input.
+        source_tuple : tuple
+            The source of each input.
+        updates : OrderedDict
+            The updates of `sgd_update`.
+
+        Returns
+        -------
+        indexed_update : theano function or None
+            A function taking a vector of example indices, or None if the
+            dataset can't be stored in shared variables.
+        """
+        if self.on_load_batch:
+            log.warning("The cost uses on_load_batch callbacks, which need "
+                        "the minibatches. Ignoring shared_dataset.")
+            return None
+        if not (hasattr(dataset, 'get_data') and
+                hasattr(dataset, 'get_data_specs')):
+            log.warning("%s does not provide get_data, ignoring "
+                        "shared_dataset." % type(dataset).__name__)
+            return None
+
+        dataset_space, dataset_source = dataset.get_data_specs()
+        data = dataset.get_data()
+        if not isinstance(dataset_source, tuple):
+            dataset_space = CompositeSpace((dataset_space,))
+            dataset_source = (dataset_source,)
+            data = (data,)
+        arrays = OrderedDict()
+        for source in source_tuple:
+            if source not in dataset_source:
+                log.warning("The dataset does not provide a source named "
+                            "%s, ignoring shared_dataset." % source)
+                return None
+            idx = dataset_source.index(source)
+            if not isinstance(data[idx], np.ndarray):
+                log.warning("The %s of the dataset are not a numpy array, "
+                            "ignoring shared_dataset." % source)
+                return None
+            arrays[source] = (dataset_space.components[idx], data[idx])
+
+        nbytes = sum(array.nbytes for space, array in arrays.values())
+        if (self.shared_dataset_max_bytes is not None and
+                nbytes > self.shared_dataset_max_bytes):
+            log.info("The training data (%d bytes) is larger than "
+                     "shared_dataset_max_bytes, using the dataset iterator."
+                     % nbytes)
+            return None
+
+        index = tensor.lvector('sgd_batch_index')
+        try:
+            shared_data = OrderedDict(
+                (source, theano.shared(array, name='sgd_shared_' + source))
+                for source, (space, array) in arrays.items())
+            givens = OrderedDict()
+            for arg, space, source in safe_zip(theano_args, space_tuple,
+                                               source_tuple):
+                dspace = arrays[source][0]
+                batch = dspace.format_as(shared_data[source][index], space)
+                givens[arg] = tensor.patternbroadcast(batch,
+                                                      arg.broadcastable)
+            with log_timing(log, 'Compiling indexed sgd_update'):
+                indexed_update = function([index],
+                                          updates=updates,
+                                          givens=givens,
+                                          name='indexed_sgd_update',
+                                          mode=self.theano_function_mode)
+        except (MemoryError, NotImplementedError, TypeError,
+                ValueError) as e:
+            log.warning("Couldn't store the training data in shared "
+                        "variables, using the dataset iterator: %s" % e)
+            return None
+        self._shared_data = (dataset, shared_data)
+        return indexed_update
+
+    def _train_indexed(self, dataset, rng):
+        """
+        Runs one epoch of SGD on the data stored in shared variables by
+        `_compile_indexed_update`, only passing the minibatch indices to
+        the compiled function.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The training dataset.
+        rng : RandomState or None
+            The rng of the subset iterator.
+        """
+        mode = resolve_iterator_class(self.train_iteration_mode)
+        subset_iterator = mode(dataset.get_num_examples(), self.batch_size,
+                               self.batches_per_iter, rng)
+        timer = get_phase_timer()
+        # Recorded as train/data/index, like the index phase of the
+        # iterators used by `train`
+        batches = timer.iterate('data', timer.iterate('index',
+                                                      subset_iterator))
+        for indices in batches:
+            if isinstance(indices, slice):
+                indices = np.arange(indices.start, indices.stop,
+                                    indices.step)
+            else:
+                indices = np.asarray(indices, dtype='int64')
+            with timer.phase('update'):
+                self._indexed_update(indices)
+            self.monitor.report_batch(len(indices))
+            with timer.phase('callbacks'):
+                for callback in self.update_callbacks:
+                    callback(self)
+
+    def _compile_fused_update(self, theano_args, updates):
+        """
+        Compiles a function applying `updates` once for each of several
+        stacked minibatches, in sequence.
+
+        Parameters
+        ----------
+        theano_args : tuple
+            The inputs of `sgd_update`.
+        updates : OrderedDict
+            The updates of `sgd_update`.
+
+        Returns
+        -------
+        fused_update : theano function or None
+            A function taking one array per input of `sgd_update`, with
+            an additional leading axis indexing the minibatches, or None
+            if the updates can't be fused.
+        """
+        if self.on_load_batch:
+            log.warning("The cost uses on_load_batch callbacks, which can't "
+                        "be run inside a fused update. Ignoring "
+                        "batches_per_call.")
+            return None
+        if not all(isinstance(arg.type, tensor.TensorType)
+                   for arg in theano_args):
+            log.warning("batches_per_call is only supported with dense "
+                        "inputs. Ignoring it.")
+            return None
+
+        stacked_args = []
+        for arg in theano_args:
+            stacked_type = tensor.TensorType(arg.dtype,
+                                             (False,) + arg.broadcastable)
+            stacked_args.append(stacked_type(name='stacked_' + str(arg.name)))
+        keys = list(updates.keys())
+
+        def step(*args):
+            """
+            The updates for one minibatch, computed from the values the
+            shared variables have after the previous minibatches.
+            """
+            new_values = theano.clone([updates[key] for key in keys],
+                                      replace=dict(safe_zip(theano_args,
+                                                            args)))
+            return OrderedDict(safe_zip(keys, new_values))
+
+        _, fused_updates = theano.scan(step, sequences=stacked_args)
+        with log_timing(log, 'Compiling fused sgd_update'):
+            return function(stacked_args,
+                            updates=fused_updates,
+                            name='fused_sgd_update',
+                            mode=self.theano_function_mode)
+
+    def _train_batch(self, batch, flat_data_specs):
+        """
+        Does one SGD step on `batch`.
+
+        Parameters
+        ----------
+        batch : tuple
+            Flat tuple of data, one element per source.
+        flat_data_specs : tuple
+            The flat data specs of `batch`.
+        """
+        timer = get_phase_timer()
+        with timer.phase('callbacks'):
+            for callback in self.on_load_batch:
+                callback(*batch)
+        with timer.phase('update'):
+            self.sgd_update(*batch)
+        # iterator might return a smaller batch if dataset size
+        # isn't divisible by batch_size
+        # Note: if data_specs[0] is a NullSpace, there is no way to know
+        # how many examples would actually have been in the batch,
+        # since it was empty, so actual_batch_size would be reported as 0.
+        actual_batch_size = flat_data_specs[0].np_batch_size(batch)
+        self.monitor.report_batch(actual_batch_size)
+        with timer.phase('callbacks'):
+            for callback in self.update_callbacks:
+                callback(self)
+
+    def _train_batches(self, batches, flat_data_specs):
+        """
+        Does one SGD step on each of `batches` with a single call to the
+        fused update function, or one at a time if they can't be stacked.
+
+        Parameters
+        ----------
+        batches : list of tuples
+            Flat tuples of data, one element per source.
+        flat_data_specs : tuple
+            The flat data specs of the batches.
+        """
+        sizes = [flat_data_specs[0].np_batch_size(batch)
+                 for batch in batches]
+        if len(set(sizes)) > 1 or not all(isinstance(data, np.ndarray)
+                                          for batch in batches
+                                          for data in batch):
+            for batch in batches:
+                self._train_batch(batch, flat_data_specs)
+            return
+        timer = get_phase_timer()
+        with timer.phase('stack'):
+            stacked = [np.concatenate([data[np.newaxis]
+                                       for data in source_data])
+                       for source_data in safe_zip(*batches)]
+        with timer.phase('update'):
+            self._fused_update(*stacked)
+        for size in sizes:
+            self.monitor.report_batch(size)
+            with timer.phase('callbacks'):
+                for callback in self.update_callbacks:
+                    callback(self)
+
     def train(self, dataset):
         """
         Runs one epoch of SGD training on the specified dataset.
@@ -414,17 +722,19 @@ class SGD(TrainingAlgorithm):
         if not hasattr(self, 'sgd_update'):
             raise Exception("train called without first calling setup")
 
-        # Make sure none of the parameters have bad values
-        for param in self.params:
-            value = param.get_value(borrow=True)
-            if not isfinite(value):
-                raise RuntimeError("NaN in " + param.name)
+        self._check_params_finite()
 
         self.first = False
         rng = self.rng
         if not is_stochastic(self.train_iteration_mode):
             rng = None
 
+        shared_data = getattr(self, '_shared_data', None)
+        if shared_data is not None and shared_data[0] is dataset:
+            self._train_indexed(dataset, rng)
+            self._check_params_finite()
+            return
+
         data_specs = self.cost.get_data_specs(self.model)
 
         # The iterator should be built from flat data specs, so it returns
@@ -442,33 +752,59 @@ class SGD(TrainingAlgorithm):
                 "data_specs: %s" % str(data_specs))
         flat_data_specs = (CompositeSpace(space_tuple), source_tuple)
 
+        iterator_kwargs = {}
+        if getattr(self, 'prefetch', 0):
+            iterator_kwargs['prefetch'] = self.prefetch
         iterator = dataset.iterator(mode=self.train_iteration_mode,
                                     batch_size=self.batch_size,
                                     data_specs=flat_data_specs,
                                     return_tuple=True, rng=rng,
-                                    num_batches=self.batches_per_iter)
-
-        on_load_batch = self.on_load_batch
-        for batch in iterator:
-            for callback in on_load_batch:
-                callback(*batch)
-            self.sgd_update(*batch)
-            # iterator might return a smaller batch if dataset size
-            # isn't divisible by batch_size
-            # Note: if data_specs[0] is a NullSpace, there is no way to know
-            # how many examples would actually have been in the batch,
-            # since it was empty, so actual_batch_size would be reported as 0.
-            actual_batch_size = flat_data_specs[0].np_batch_size(batch)
-            self.monitor.report_batch(actual_batch_size)
-            for callback in self.update_callbacks:
-                callback(self)
+                                    num_batches=self.batches_per_iter,
+                                    **iterator_kwargs)
 
-        # Make sure none of the parameters have bad values
+        batches = get_phase_timer().iterate('data', iterator)
+        if getattr(self, '_fused_update', None) is None:
+            for batch in batches:
+                self._train_batch(batch, flat_data_specs)
+        else:
+            pending = []
+            for batch in batches:
+                pending.append(batch)
+                if len(pending) == self.batches_per_call:
+                    self._train_batches(pending, flat_data_specs)
+                    pending = []
+            for batch in pending:
+                self._train_batch(batch, flat_data_specs)
+
+        self._check_params_finite()
+
+    def _check_params_finite(self):
+        """
+        Makes sure none of the parameters have bad values.
+        """
         for param in self.params:
             value = param.get_value(borrow=True)
             if not isfinite(value):
                 raise RuntimeError("NaN in " + param.name)
 
+    def get_state_variables(self):
+        """
+        Returns the learning rate and the array-valued shared variables
+        other than the parameters updated by each step (e.g. the
+        velocities of the learning rule).
+        """
+        state = [self.learning_rate]
+        params = set(getattr(self, 'params', []))
+        sgd_update = getattr(self, 'sgd_update', None)
+        if sgd_update is not None:
+            for spec in sgd_update.maker.inputs:
+                var = spec.variable
+                if spec.update is None or var in params or var in state:
+                    continue
+                if hasattr(var.type, 'ndim'):
+                    state.append(var)
+        return state
+
     def continue_learning(self, model):
         """
         Returns True if the algorithm should continue running, or False
@@ -527,6 +863,8 @@ class MonitorBasedLRAdjuster(TrainExtension):
         "objective"
     """
 
+    wait_for_monitor = True
+
     def __init__(self, high_trigger=1., shrink_amt=.99,
                  low_trigger=.99, grow_amt=1.01,
                  min_lr=1e-7, max_lr=1.,
@@ -111,6 +111,45 @@ def test_bgd_unsup():
 
     train.main_loop()
 
+def test_bgd_num_workers():
+
+    # tests that evaluating the batches in worker processes
+    # trains the same parameters as evaluating them in the
+    # main process
+
+    dim = 3
+    m = 12
+
+    rng = np.random.RandomState([25,9,2012])
+
+    X = rng.randn(m, dim)
+
+    class DummyCost(Cost):
+
+        def expr(self, model, data):
+            self.get_data_specs(model)[0].validate(data)
+            X = data
+            return T.square(model(X) - X).mean()
+
+        def get_data_specs(self, model):
+            return (model.get_input_space(), model.get_input_source())
+
+    params = []
+    for num_workers in [1, 2]:
+        dataset = DenseDesignMatrix(X=X)
+        model = SoftmaxModel(dim)
+        algorithm = BGD(DummyCost(), batch_size=6,
+                        termination_criterion=EpochCounter(2),
+                        num_workers=num_workers)
+        train = Train(dataset, model, algorithm, save_path=None,
+                      save_freq=0, extensions=None)
+        train.main_loop()
+        algorithm.optimizer.shutdown()
+        params.append(model.P.get_value())
+
+    assert np.allclose(params[0], params[1])
+
+
 def test_determinism():
 
     """
@@ -0,0 +1,105 @@
+"""
+Tests for pylearn2.training_algorithms.parallel_sgd
+"""
+import numpy as np
+import theano.tensor as T
+from nose.tools import assert_raises
+
+from pylearn2.costs.cost import Cost, DefaultDataSpecsMixin
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.models.model import Model
+from pylearn2.monitor import Monitor
+from pylearn2.space import VectorSpace
+from pylearn2.training_algorithms.parallel_sgd import ParallelSGD, as_shard
+from pylearn2.utils import sharedX
+from pylearn2.utils.iteration import resolve_iterator_class
+
+
+class LinearModel(Model):
+    """
+    A linear regression model with a single output.
+    """
+
+    def __init__(self, dim):
+        super(LinearModel, self).__init__()
+        self.W = sharedX(np.zeros(dim), 'W')
+        self.input_space = VectorSpace(dim)
+        self.output_space = VectorSpace(1)
+
+    def get_params(self):
+        return [self.W]
+
+    def __call__(self, X):
+        return T.dot(X, self.W).dimshuffle(0, 'x')
+
+
+class SquaredError(DefaultDataSpecsMixin, Cost):
+    supervised = True
+
+    def expr(self, model, data):
+        X, y = data
+        return T.sqr(model(X) - y).mean()
+
+
+def _make_dataset(rng, num_examples=64, dim=3):
+    X = rng.randn(num_examples, dim)
+    true_W = np.arange(1, dim + 1)
+    y = X.dot(true_W)[:, np.newaxis]
+    return DenseDesignMatrix(X=X, y=y), true_W
+
+
+def test_as_shard():
+    """
+    Checks that the shards of a stochastic iterator partition its
+    batches.
+    """
+    base = resolve_iterator_class('shuffled_sequential')
+    expected = list(base(23, 4, None, np.random.RandomState(3)))
+    shards = [list(as_shard('shuffled_sequential', i, 3)(
+        23, 4, None, np.random.RandomState(3))) for i in range(3)]
+    assert [len(s) for s in shards] == [2, 2, 2]
+    for i, batch in enumerate(expected):
+        np.testing.assert_equal(shards[i % 3][i // 3], batch)
+    assert as_shard('shuffled_sequential', 1, 3).stochastic
+    assert as_shard('sequential', 2, 3)(20, 4, None).num_batches == 1
+    assert_raises(ValueError, as_shard, 'sequential', 3, 3)
+
+
+def test_parallel_sgd():
+    """
+    Checks that both Hogwild and averaging modes fit a linear regression
+    and report every batch to the monitor.
+    """
+    rng = np.random.RandomState(0)
+    dataset, true_W = _make_dataset(rng)
+    for sync_freq in [None, 2]:
+        calls = []
+        model = LinearModel(3)
+        algorithm = ParallelSGD(0.05, num_workers=2, sync_freq=sync_freq,
+                                cost=SquaredError(), batch_size=5,
+                                update_callbacks=[calls.append])
+        algorithm.setup(model=model, dataset=dataset)
+        try:
+            for epoch in range(10):
+                algorithm.train(dataset)
+            # Changes to the learning rate reach the workers
+            algorithm.learning_rate.set_value(0.)
+            W = model.W.get_value()
+            algorithm.train(dataset)
+            np.testing.assert_allclose(model.W.get_value(), W)
+        finally:
+            algorithm.shutdown()
+        monitor = Monitor.get_monitor(model)
+        assert monitor.get_batches_seen() == 11 * 13
+        assert monitor.get_examples_seen() == 11 * 64
+        assert len(calls) == 11 * 13
+        np.testing.assert_allclose(model.W.get_value(), true_W, atol=0.05)
+
+
+def test_parallel_sgd_errors():
+    """
+    Checks that unsupported options are rejected.
+    """
+    assert_raises(ValueError, ParallelSGD, 0.1, batches_per_call=2)
+    assert_raises(ValueError, ParallelSGD, 0.1, shared_dataset=True)
+    assert_raises(ValueError, ParallelSGD, 0.1, sync_freq=0)
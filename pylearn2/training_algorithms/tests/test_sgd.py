@@ -29,6 +29,7 @@ from pylearn2.training_algorithms.learning_rule import (Momentum,
 from pylearn2.utils.iteration import _iteration_schemes
 from pylearn2.utils import safe_izip, safe_union, sharedX
 from pylearn2.utils.exc import reraise_as
+from pylearn2.utils.timing import PhaseTimer
 
 
 class SupervisedDummyCost(DefaultDataSpecsMixin, Cost):
@@ -1993,3 +1994,75 @@ def test_epoch_monitor():
 
 if __name__ == '__main__':
     test_monitor_based_lr()
+
+
+def test_batches_per_call():
+    """
+    Tests that fusing several minibatches into one call gives the same
+    parameters and monitor counts as updating after each minibatch.
+    """
+    dim = 3
+    m = 11
+    rng = np.random.RandomState([25, 9, 2012])
+    X = rng.randn(m, dim)
+    dataset = DenseDesignMatrix(X=X)
+
+    results = []
+    for batches_per_call in [1, 3]:
+        model = SoftmaxModel(dim)
+        callback_calls = []
+        algorithm = SGD(1e-1, DummyCost(), batch_size=2,
+                        train_iteration_mode='sequential',
+                        learning_rule=Momentum(.5),
+                        update_callbacks=[callback_calls.append],
+                        batches_per_call=batches_per_call)
+        algorithm.setup(model=model, dataset=dataset)
+        assert (algorithm._fused_update is None) == (batches_per_call == 1)
+        algorithm.train(dataset)
+        algorithm.train(dataset)
+        monitor = Monitor.get_monitor(model)
+        assert monitor.get_batches_seen() == 12
+        assert monitor.get_examples_seen() == 2 * m
+        assert len(callback_calls) == 12
+        results.append(model.P.get_value())
+
+    assert np.allclose(results[0], results[1])
+
+
+def test_shared_dataset():
+    """
+    Tests that training from shared variables with index givens gives the
+    same parameters as the dataset iterator, and the fallback when the
+    data is too large.
+    """
+    dim = 3
+    m = 11
+    rng = np.random.RandomState([25, 9, 2012])
+    X = rng.randn(m, dim)
+    dataset = DenseDesignMatrix(X=X)
+
+    results = []
+    for shared_dataset, max_bytes in [(False, None), (True, None),
+                                      (True, 10)]:
+        model = SoftmaxModel(dim)
+        algorithm = SGD(1e-1, DummyCost(), batch_size=2,
+                        train_iteration_mode='shuffled_sequential',
+                        shared_dataset=shared_dataset,
+                        shared_dataset_max_bytes=max_bytes)
+        algorithm.setup(model=model, dataset=dataset)
+        uses_shared = shared_dataset and max_bytes is None
+        assert (algorithm._indexed_update is not None) == uses_shared
+        timer = PhaseTimer()
+        with timer.activate():
+            with timer.phase('train'):
+                algorithm.train(dataset)
+        assert 'train/data/index' in timer.totals
+        assert 'train/index' not in timer.totals
+        algorithm.train(dataset)
+        monitor = Monitor.get_monitor(model)
+        assert monitor.get_batches_seen() == 12
+        assert monitor.get_examples_seen() == 2 * m
+        results.append(model.P.get_value())
+
+    assert np.allclose(results[0], results[1])
+    assert np.allclose(results[0], results[2])
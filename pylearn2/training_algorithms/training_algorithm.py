@@ -60,6 +60,19 @@ class TrainingAlgorithm(object):
         """
         raise NotImplementedError()
 
+    def get_state_variables(self):
+        """
+        Returns the shared variables holding the state of the algorithm
+        (e.g. learning rate or momentum velocities), saved alongside the
+        parameters of the model by `pylearn2.utils.checkpoint`.
+
+        Returns
+        -------
+        state : list of SharedVariables
+            In a deterministic order. Empty by default.
+        """
+        return []
+
     def _set_monitoring_dataset(self, monitoring_dataset):
         """
         .. todo::
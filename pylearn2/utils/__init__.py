@@ -377,7 +377,15 @@ def function(*args, **kwargs):
     A wrapper around theano.function that disables the on_unused_input error.
     Almost no part of pylearn2 can assume that an unused input is an error, so
     the default from theano is inappropriate for this project.
+
+    If a compiled-function cache is enabled (see
+    `pylearn2.utils.function_cache`), the function is loaded from it when
+    possible.
     """
+    from pylearn2.utils.function_cache import get_function_cache
+    cache = get_function_cache()
+    if cache is not None:
+        return cache.function(*args, on_unused_input='ignore', **kwargs)
     return theano.function(*args, on_unused_input='ignore', **kwargs)
 
 
@@ -0,0 +1,200 @@
+"""
+Compact, atomic and optionally asynchronous checkpoints of the parameters
+of a model and of the state of its training algorithm.
+
+Pickling the whole model (see `pylearn2.utils.serial.save`) also
+serializes the monitor history and the Theano graphs, and blocks training
+while it is written. A `Checkpointer` instead copies the values of the
+parameters and of the state variables of the algorithm (see
+`TrainingAlgorithm.get_state_variables`) into preallocated buffers, and
+writes them to a `.npz` file in a background thread. The file is written
+under a temporary name and then renamed, so a crash never leaves a
+partially written checkpoint behind.
+
+`load_checkpoint` restores such a checkpoint into a model built from the
+same description, e.g. to resume training.
+"""
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from pylearn2.utils import serial
+from pylearn2.utils.string_utils import preprocess
+from pylearn2.utils.timing import log_timing
+
+
+log = logging.getLogger(__name__)
+
+_COUNTERS = ['_epochs_seen', '_num_batches_seen', '_examples_seen']
+
+
+def _replace(src, dst):
+    """
+    Renames `src` to `dst`, replacing `dst` if it exists.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # On POSIX, os.rename replaces the destination atomically
+        os.rename(src, dst)
+
+
+class Checkpointer(object):
+    """
+    Writes the parameters of a model and the state of its training
+    algorithm to a `.npz` file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the checkpoint. Environment variables are expanded.
+    asynchronous : bool, optional
+        If `True`, `save` returns as soon as the values are copied, and
+        the file is written in a background thread. A call to `save`
+        waits for the previous write to finish.
+    """
+
+    def __init__(self, path, asynchronous=True):
+        self.path = preprocess(path)
+        self.asynchronous = asynchronous
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _snapshot(self, name, var):
+        """
+        Copies the value of the shared variable `var` into the buffer
+        `name`, reallocating it only if its shape or dtype changed.
+        """
+        value = var.get_value(borrow=True)
+        buf = self._buffers.get(name)
+        if (buf is None or buf.shape != value.shape or
+                buf.dtype != value.dtype):
+            buf = np.empty(value.shape, dtype=value.dtype)
+            self._buffers[name] = buf
+        buf[...] = value
+        return buf
+
+    def save(self, model, algorithm=None):
+        """
+        Checkpoints `model` and `algorithm`.
+
+        Parameters
+        ----------
+        model : Model
+            The model whose parameters are saved, along with the
+            counters of its monitor if it has one.
+        algorithm : TrainingAlgorithm, optional
+            The algorithm whose state variables are saved.
+        """
+        self.wait()
+        arrays = {}
+        for i, param in enumerate(model.get_params()):
+            arrays['param_%d' % i] = self._snapshot('param_%d' % i, param)
+        if algorithm is not None:
+            for i, var in enumerate(algorithm.get_state_variables()):
+                arrays['state_%d' % i] = self._snapshot('state_%d' % i, var)
+        monitor = getattr(model, 'monitor', None)
+        if monitor is not None:
+            for name in _COUNTERS:
+                arrays['monitor' + name] = np.asarray(getattr(monitor, name))
+        if self.asynchronous:
+            self._thread = threading.Thread(target=self._write_async,
+                                            args=(arrays,))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._write(arrays)
+
+    def _write(self, arrays):
+        """
+        Writes `arrays` to a temporary file and renames it to
+        `self.path`.
+        """
+        with log_timing(log, 'Writing checkpoint to ' + self.path,
+                        level=logging.DEBUG):
+            save_dir = os.path.dirname(self.path) or '.'
+            serial.mkdir(save_dir)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.' + os.path.basename(self.path), dir=save_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **arrays)
+                _replace(tmp_path, self.path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _write_async(self, arrays):
+        """
+        Body of the background thread: writes `arrays` and records any
+        error, to be raised by `wait`.
+        """
+        try:
+            self._write(arrays)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """
+        Waits for the write in progress, if any, to finish, and raises
+        its error if it failed.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise IOError("Could not write checkpoint to %s: %s"
+                          % (self.path, error))
+
+    def __getstate__(self):
+        self.wait()
+        state = self.__dict__.copy()
+        state['_buffers'] = {}
+        return state
+
+
+def load_checkpoint(path, model, algorithm=None):
+    """
+    Restores a checkpoint written by a `Checkpointer`.
+
+    Parameters
+    ----------
+    path : str
+        Path of the checkpoint.
+    model : Model
+        A model with the same parameters as the checkpointed one. The
+        counters of its monitor are restored if it has one.
+    algorithm : TrainingAlgorithm, optional
+        An algorithm set up with `model`, whose state variables are
+        restored.
+    """
+    with np.load(preprocess(path)) as f:
+        groups = [('param', model.get_params())]
+        if algorithm is not None:
+            groups.append(('state', algorithm.get_state_variables()))
+        for prefix, variables in groups:
+            num_saved = len([k for k in f.files if k.startswith(prefix)])
+            if num_saved != len(variables):
+                raise ValueError("%s contains %d %s variables, but %d were "
+                                 "given" % (path, num_saved, prefix,
+                                            len(variables)))
+            for i, var in enumerate(variables):
+                value = f['%s_%d' % (prefix, i)]
+                old_shape = var.get_value(borrow=True).shape
+                if value.shape != old_shape:
+                    raise ValueError("%s_%d of %s has shape %s, but %s has "
+                                     "shape %s" % (prefix, i, path,
+                                                   value.shape, var,
+                                                   old_shape))
+                var.set_value(value.astype(var.dtype))
+        monitor = getattr(model, 'monitor', None)
+        if monitor is not None:
+            for name in _COUNTERS:
+                key = 'monitor' + name
+                if key in f.files:
+                    setattr(monitor, name, int(f[key]))
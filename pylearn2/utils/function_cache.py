@@ -0,0 +1,451 @@
+"""
+Persistent on-disk cache of compiled Theano functions.
+
+Building and optimizing the graphs of large models (e.g. the update
+function of `SGD` or the accumulation functions of the `Monitor`) can
+take minutes every time an experiment is launched or resumed. When a
+`FunctionCache` is installed, `pylearn2.utils.function` looks up each
+function it is asked to compile in the cache, keyed by a canonical hash
+of the symbolic graph (outputs, updates and givens), of the types of its
+inputs and of the compilation mode and Theano configuration. On a hit,
+the optimized graph is unpickled and linked to the shared variables of
+the current graph, which skips the graph optimization.
+
+The cache is enabled by setting the `PYLEARN2_FUNCTION_CACHE`
+environment variable to a directory, and optionally
+`PYLEARN2_FUNCTION_CACHE_MAX_SIZE` to a size in bytes, or by calling
+`set_function_cache`.
+
+The values of the shared variables are not stored in the cache. Only
+functions compiled with the default mode (or a mode given by name) and
+symbolic inputs that are plain Variables are cached; other calls are
+compiled as usual.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+import theano
+from theano.compat import six
+from theano.compat.six.moves import cPickle
+
+from pylearn2.utils import serial
+from pylearn2.utils import string_utils
+
+
+log = logging.getLogger(__name__)
+
+# Bump to invalidate all the entries when the format changes
+_FORMAT_VERSION = 1
+
+
+def _type_description(var):
+    """
+    Returns a deterministic description of the type of `var`.
+    """
+    try:
+        return cPickle.dumps(var.type, protocol=2)
+    except Exception:
+        return str(var.type).encode('utf-8')
+
+
+def _op_description(op):
+    """
+    Returns a deterministic description of `op`, or None if there is
+    none.
+    """
+    try:
+        rval = cPickle.dumps(op, protocol=2)
+    except Exception:
+        return None
+    return rval
+
+
+def _graph_key(inputs, outputs, updates, givens, extra):
+    """
+    Returns the hexadecimal digest of a canonical description of a
+    graph, and a dictionary mapping the canonical names of its shared
+    variables to the variables. Returns (None, None) if the graph
+    can't be described deterministically.
+
+    Parameters
+    ----------
+    inputs : list of Variables
+        Explicit inputs of the function.
+    outputs : list of Variables
+        Outputs of the function.
+    updates : list of pairs of Variables
+        Updates of the function.
+    givens : list of pairs of Variables
+        Substitutions of the function.
+    extra : object
+        Anything else to hash into the key, described by its repr.
+    """
+    roots = list(outputs)
+    for pair in list(updates) + list(givens):
+        roots.extend(pair)
+    # Default updates of shared variables (e.g. random streams) are added
+    # by theano.function
+    for var in theano.gof.graph.inputs(roots):
+        default_update = getattr(var, 'default_update', None)
+        if default_update is not None:
+            roots.append(default_update)
+
+    digest = hashlib.sha1()
+    digest.update(repr((_FORMAT_VERSION, extra)).encode('utf-8'))
+    names = {}
+    shared = {}
+    for i, var in enumerate(inputs):
+        names[var] = 'i%d' % i
+        digest.update(names[var].encode('utf-8'))
+        digest.update(_type_description(var))
+    for var in theano.gof.graph.inputs(roots):
+        if var in names:
+            continue
+        if isinstance(var, theano.compile.SharedVariable):
+            name = 's%d' % len(shared)
+            shared[name] = var
+            description = repr(var.name).encode('utf-8')
+        elif isinstance(var, theano.gof.Constant):
+            name = 'c%d' % len(names)
+            data = np.asarray(var.data)
+            if data.dtype == object:
+                return None, None
+            description = (str(data.dtype) + str(data.shape)).encode('utf-8')
+            description += hashlib.sha1(
+                np.ascontiguousarray(data).view(np.uint8)).digest()
+        else:
+            name = 'v%d' % len(names)
+            description = b''
+        names[var] = name
+        digest.update(name.encode('utf-8'))
+        digest.update(_type_description(var))
+        digest.update(description)
+    for i, node in enumerate(theano.gof.graph.io_toposort(
+            theano.gof.graph.inputs(roots), roots)):
+        op_description = _op_description(node.op)
+        if op_description is None:
+            return None, None
+        digest.update(op_description)
+        digest.update(repr([names[var] for var in node.inputs])
+                      .encode('utf-8'))
+        for j, var in enumerate(node.outputs):
+            names[var] = 'n%d.%d' % (i, j)
+            digest.update(_type_description(var))
+    description = ([names[var] for var in outputs],
+                   [(names[k], names[v]) for k, v in updates],
+                   [(names[k], names[v]) for k, v in givens])
+    digest.update(repr(description).encode('utf-8'))
+    return digest.hexdigest(), shared
+
+
+def _tensor_containers(maker):
+    """
+    Returns the containers of the shared tensor inputs of a compiled
+    function.
+    """
+    rval = []
+    for spec in maker.inputs:
+        if getattr(spec, 'shared', False) and isinstance(
+                spec.variable.type, theano.tensor.TensorType):
+            rval.append(spec.value)
+    return rval
+
+
+class FunctionCache(object):
+    """
+    A directory of pickled, optimized Theano function graphs, indexed by
+    a canonical hash of the graphs they were compiled from.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache entries. Environment variables are
+        expanded. Created if it doesn't exist.
+    max_size : int, optional
+        If specified, the least recently used entries are deleted
+        whenever the cache grows beyond this many bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = string_utils.preprocess(cache_dir)
+        if max_size is not None and max_size <= 0:
+            raise ValueError("max_size must be positive, got %s"
+                             % str(max_size))
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, key):
+        """
+        Returns the file of the entry `key`.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry.
+        """
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def function(self, inputs, outputs=None, mode=None, updates=None,
+                 givens=None, **kwargs):
+        """
+        Drop-in replacement for `theano.function` that loads the function
+        from the cache if possible, and stores it otherwise.
+
+        Parameters
+        ----------
+        inputs : list of Variables
+            See `theano.function`.
+        outputs : Variable or list of Variables, optional
+            See `theano.function`.
+        mode : str, optional
+            See `theano.function`.
+        updates : OrderedDict or list of pairs, optional
+            See `theano.function`.
+        givens : OrderedDict or list of pairs, optional
+            See `theano.function`.
+        kwargs : dict
+            Other arguments of `theano.function`.
+        """
+        rval = None
+        key = self._key(inputs, outputs, mode, updates, givens, kwargs)
+        if key[0] is not None:
+            rval = self.load(*key)
+        if rval is not None:
+            self.hits += 1
+            return rval
+        rval = theano.function(inputs, outputs, mode=mode, updates=updates,
+                               givens=givens, **kwargs)
+        if key[0] is not None:
+            self.misses += 1
+            self.store(key[0], key[1], rval)
+        return rval
+
+    def _key(self, inputs, outputs, mode, updates, givens, kwargs):
+        """
+        Returns the key of a call to `function` and the shared variables
+        of its graph, or (None, None) if the call can't be cached.
+        """
+        if not (mode is None or isinstance(mode, six.string_types)):
+            return None, None
+        simple_kwargs = {}
+        for name, value in six.iteritems(kwargs):
+            if name == 'name':
+                continue
+            if not (value is None or
+                    isinstance(value, (bool,) + six.string_types)):
+                return None, None
+            simple_kwargs[name] = value
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        if outputs is None:
+            output_list = []
+        elif isinstance(outputs, (list, tuple)):
+            output_list = list(outputs)
+        else:
+            output_list = [outputs]
+        variables = list(inputs) + output_list
+        updates = self._pairs(updates)
+        givens = self._pairs(givens)
+        if updates is None or givens is None:
+            return None, None
+        for pair in updates + givens:
+            variables.extend(pair)
+        if not all(isinstance(var, theano.gof.Variable) for var in variables):
+            return None, None
+        config = theano.config
+        extra = (theano.__version__, type(outputs).__name__, mode,
+                 sorted(simple_kwargs.items()), config.floatX, config.mode,
+                 config.linker, config.optimizer, config.device,
+                 config.cxx, config.optimizer_excluding,
+                 config.optimizer_including)
+        return _graph_key(list(inputs), output_list, updates, givens, extra)
+
+    @staticmethod
+    def _pairs(pairs):
+        """
+        Returns `pairs` (a dict or a list of pairs) as a list of pairs,
+        or None if its order is not deterministic.
+        """
+        if pairs is None:
+            return []
+        if hasattr(pairs, 'items'):
+            if type(pairs) is dict and six.PY2:
+                return None
+            return list(pairs.items())
+        return [tuple(pair) for pair in pairs]
+
+    def load(self, key, shared):
+        """
+        Returns the function stored under `key`, linked to the shared
+        variables of the current graph, or None if there is no such
+        entry.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry.
+        shared : dict
+            Maps the canonical names of the shared variables to the
+            variables of the current graph.
+        """
+        path = self._entry_path(key)
+        if not os.path.isfile(path):
+            return None
+        t1 = time.time()
+        try:
+            with open(path, 'rb') as f:
+                maker, shared_names = cPickle.load(f)
+            input_storage = []
+            for spec, name in zip(maker.inputs, shared_names):
+                if name is None:
+                    input_storage.append(spec.value)
+                    continue
+                var = shared[name]
+                spec.variable = var
+                spec.value = var.container
+                input_storage.append(var.container)
+            rval = maker.create(input_storage)
+        except Exception as e:
+            log.warning("Ignoring unreadable function cache entry %s: %s"
+                        % (path, e))
+            return None
+        # Mark the entry as recently used
+        os.utime(path, None)
+        log.debug("Loaded function from %s in %f seconds"
+                  % (path, time.time() - t1))
+        return rval
+
+    def store(self, key, shared, fn):
+        """
+        Stores the optimized graph of the compiled function `fn` under
+        `key`, without the values of its shared variables.
+
+        The entry is written to a temporary file that is then renamed,
+        so that concurrent processes never see partial entries.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry.
+        shared : dict
+            Maps the canonical names of the shared variables of the graph
+            of `fn` to the variables.
+        fn : theano.compile.function_module.Function
+            The compiled function.
+        """
+        maker = fn.maker
+        names = dict((var, name) for name, var in six.iteritems(shared))
+        shared_names = []
+        for spec in maker.inputs:
+            if getattr(spec, 'shared', False):
+                if spec.variable not in names:
+                    log.debug("Not caching %s: unknown shared variable %s"
+                              % (fn.name, spec.variable))
+                    return
+                shared_names.append(names[spec.variable])
+            else:
+                shared_names.append(None)
+        # Temporarily replace the values of the shared variables by small
+        # arrays, so they are not written to disk.
+        containers = _tensor_containers(maker)
+        values = [container.storage[0] for container in containers]
+        serial.mkdir(self.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_' + key,
+                                        dir=self.cache_dir)
+        try:
+            for container in containers:
+                container.storage[0] = np.zeros(
+                    (1,) * container.type.ndim, dtype=container.type.dtype)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    cPickle.dump((maker, shared_names), f, protocol=2)
+            finally:
+                for container, value in zip(containers, values):
+                    container.storage[0] = value
+            os.rename(tmp_path, self._entry_path(key))
+        except Exception as e:
+            log.warning("Could not store %s in the function cache: %s"
+                        % (fn.name, e))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if self.max_size is not None:
+            self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the total size of
+        the cache is at most `self.max_size` bytes.
+
+        Parameters
+        ----------
+        keep : str, optional
+            Key of an entry that must not be deleted.
+        """
+        if self.max_size is None or not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not name.endswith('.pkl'):
+                continue
+            try:
+                entries.append((os.path.getmtime(path),
+                                os.path.getsize(path), name))
+            except OSError:
+                # Deleted by another process in the meantime
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            if keep is not None and name == keep + '.pkl':
+                continue
+            log.info("Evicting function cache entry %s" % name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+
+_function_cache = None
+
+
+def set_function_cache(cache):
+    """
+    Installs the cache used by `pylearn2.utils.function`.
+
+    Parameters
+    ----------
+    cache : FunctionCache or str or None
+        The cache, or the directory of a new cache without size limit.
+        None disables caching.
+    """
+    global _function_cache
+    if isinstance(cache, six.string_types):
+        cache = FunctionCache(cache)
+    _function_cache = cache
+
+
+def get_function_cache():
+    """
+    Returns the cache used by `pylearn2.utils.function`, or None.
+
+    Unless `set_function_cache` was called, the cache is created from the
+    `PYLEARN2_FUNCTION_CACHE` and `PYLEARN2_FUNCTION_CACHE_MAX_SIZE`
+    environment variables.
+    """
+    global _function_cache
+    if _function_cache is None and os.environ.get('PYLEARN2_FUNCTION_CACHE'):
+        max_size = os.environ.get('PYLEARN2_FUNCTION_CACHE_MAX_SIZE')
+        if max_size is not None:
+            max_size = int(max_size)
+        _function_cache = FunctionCache(os.environ['PYLEARN2_FUNCTION_CACHE'],
+                                        max_size)
+    return _function_cache
@@ -14,18 +14,26 @@ Presets:
 - random_uniform: on each call to next, returns a random subset of the
   dataset. Samples with replacement, but still reports that
   container is empty after num_examples / batch_size calls
+- block_shuffled_sequential: shuffles contiguous blocks of the dataset,
+  then the examples within each block, and iterates through the
+  result in sequence. Keeps reads from chunked on-disk storage close
+  to sequential.
 """
 from __future__ import division
 
+import collections
 import warnings
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import scipy.sparse
 from theano.compat import six
 
-from pylearn2.space import CompositeSpace
+from pylearn2.space import CompositeSpace, Conv2DSpace, VectorSpace
 from pylearn2.utils import safe_izip, wraps
 from pylearn2.utils.data_specs import is_flat_specs
 from pylearn2.utils.exc import reraise_as
 from pylearn2.utils.rng import make_np_rng
+from pylearn2.utils.timing import get_phase_timer
 import copy
 
 # Make sure that the docstring uses restructured text list format.
@@ -490,6 +498,70 @@ class ShuffledSequentialSubsetIterator(SequentialSubsetIterator):
         return self.next()
 
 
+class BlockShuffledSequentialSubsetIterator(ShuffledSequentialSubsetIterator):
+    """
+    Randomly shuffles the order of contiguous blocks of example indices,
+    then the indices within each block, and proceeds sequentially
+    through the resulting permutation.
+
+    Every example is visited once per epoch, in a nearly random order,
+    but each batch only draws from one or two blocks. When the blocks
+    line up with the chunks of an on-disk dataset, this keeps reads
+    close to sequential.
+
+    Parameters
+    ----------
+    block_size : int, optional
+        The number of contiguous examples in a block. Defaults to 8
+        times the batch size.
+
+    Notes
+    -----
+    Returns lists of indices (`fancy = True`).
+
+    See :py:class:`SubsetIterator` for detailed constructor parameter
+    and attribute documentation.
+    """
+
+    def __init__(self, dataset_size, batch_size, num_batches, rng=None,
+                 block_size=None):
+        # Skip ShuffledSequentialSubsetIterator.__init__, which would
+        # compute a full permutation that we don't need.
+        super(ShuffledSequentialSubsetIterator, self).__init__(
+            dataset_size,
+            batch_size,
+            num_batches,
+            None
+        )
+        self._rng = make_np_rng(rng, which_method=["permutation", "uniform"])
+        if block_size is None:
+            block_size = 8 * self._batch_size
+        if block_size <= 0:
+            raise ValueError("block_size must be positive, got %d"
+                             % block_size)
+        self._block_size = block_size
+
+        block = np.arange(self._dataset_size) // block_size
+        num_blocks = block[-1] + 1 if self._dataset_size > 0 else 0
+        block_rank = np.empty(num_blocks, dtype='int64')
+        block_rank[self._rng.permutation(num_blocks)] = np.arange(num_blocks)
+        # Sort by block rank, then by a random key within each block
+        keys = self._rng.uniform(size=self._dataset_size)
+        self._shuffled = np.lexsort((keys, block_rank[block]))
+
+    @property
+    def block_size(self):
+        """
+        The number of contiguous examples in a block.
+
+        Returns
+        -------
+        block_size : int
+            The number of contiguous examples in a block.
+        """
+        return self._block_size
+
+
 class RandomUniformSubsetIterator(SubsetIterator):
     """
     Selects minibatches of examples by drawing indices uniformly
@@ -770,10 +842,13 @@ _iteration_schemes = {
     'random_slice': RandomSliceSubsetIterator,
     'random_uniform': RandomUniformSubsetIterator,
     'batchwise_shuffled_sequential': BatchwiseShuffledSequentialIterator,
+    'block_shuffled_sequential': BlockShuffledSequentialSubsetIterator,
     'even_sequential': as_even(SequentialSubsetIterator),
     'even_shuffled_sequential': as_even(ShuffledSequentialSubsetIterator),
     'even_batchwise_shuffled_sequential':
     as_even(BatchwiseShuffledSequentialIterator),
+    'even_block_shuffled_sequential':
+    as_even(BlockShuffledSequentialSubsetIterator),
     'even_sequences': EvenSequencesSubsetIterator,
 }
 
@@ -832,6 +907,33 @@ def resolve_iterator_class(mode):
     return subset_iter_class
 
 
+def _can_format_inplace(dspace, space):
+    """
+    Returns True if batches can be formatted from `dspace` to `space` by
+    a plain dtype cast and axis transposition, or by densifying sparse
+    batches, which `FiniteDatasetIterator` can then write into a reused
+    buffer.
+    """
+    if type(dspace) is VectorSpace and type(space) is VectorSpace:
+        return not space.sparse and dspace.dim == space.dim
+    if type(dspace) is Conv2DSpace and type(space) is Conv2DSpace:
+        return (tuple(dspace.shape) == tuple(space.shape) and
+                dspace.num_channels == space.num_channels)
+    return False
+
+
+def _reuse_buffer(ring, slot, shape, dtype):
+    """
+    Returns the buffer at position `slot` of `ring`, first replacing it
+    with a new one if it doesn't have the requested shape and dtype.
+    """
+    buf = ring[slot]
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        ring[slot] = buf
+    return buf
+
+
 class FiniteDatasetIterator(object):
     """
     A wrapper around subset iterators that actually retrieves
@@ -855,6 +957,22 @@ class FiniteDatasetIterator(object):
         A list of callables, in the same order as the sources
         in `data_specs`, that will be called on the individual
         source batches prior to any further processing.
+    prefetch : int, optional
+        If positive, up to `prefetch` upcoming batches are retrieved
+        and converted by a pool of background threads while the
+        current batch is being consumed. The subset iterator is still
+        advanced on the calling thread, in order, so batches come out
+        in the same order and with the same random number generator
+        state as without prefetching. Defaults to 0 (no prefetching).
+    num_buffers : int, optional
+        If positive, batches are written into a ring of `num_buffers`
+        preallocated arrays per source instead of freshly allocated
+        ones: fancy-indexed examples are gathered with `np.take` and
+        dtype or axis conversions between spaces of the same kind are
+        done in place. A returned batch is therefore overwritten
+        `num_buffers` batches later, and must be copied if it needs to
+        live longer. Must be larger than `prefetch`. Defaults to 0
+        (allocate every batch).
 
     Notes
     -----
@@ -868,12 +986,33 @@ class FiniteDatasetIterator(object):
     """
 
     def __init__(self, dataset, subset_iterator, data_specs=None,
-                 return_tuple=False, convert=None):
+                 return_tuple=False, convert=None, prefetch=0,
+                 num_buffers=0):
         self._data_specs = data_specs
         self._dataset = dataset
         self._subset_iterator = subset_iterator
         self._return_tuple = return_tuple
 
+        if prefetch is None:
+            prefetch = 0
+        if prefetch < 0:
+            raise ValueError("prefetch must be non-negative, got %d"
+                             % prefetch)
+        self._prefetch = prefetch
+        self._pool = None
+        self._pending = collections.deque()
+        self._exhausted = False
+
+        if num_buffers is None:
+            num_buffers = 0
+        if num_buffers and num_buffers <= prefetch:
+            raise ValueError("num_buffers (%d) must be larger than prefetch "
+                             "(%d), otherwise prefetched batches would "
+                             "overwrite the one being used"
+                             % (num_buffers, prefetch))
+        self._num_buffers = num_buffers
+        self._next_slot = 0
+
         # Keep only the needed sources in self._raw_data.
         # Remember what source they correspond to in self._source
         assert is_flat_specs(data_specs)
@@ -927,6 +1066,12 @@ class FiniteDatasetIterator(object):
         else:
             assert len(convert) == len(source)
             self._convert = convert
+        # For each source, the (dataset space, requested space) pair if the
+        # conversion between them can be written into a preallocated buffer
+        self._inplace_spaces = [None for s in source]
+        # For each source, a ring of raw and converted batch buffers
+        self._raw_buffers = [[None] * num_buffers for s in source]
+        self._out_buffers = [[None] * num_buffers for s in source]
 
         for i, (so, sp) in enumerate(safe_izip(source, sub_spaces)):
             try:
@@ -950,6 +1095,8 @@ class FiniteDatasetIterator(object):
                 # of the loop.
                 fn = (lambda batch, dspace=dspace, sp=sp:
                       dspace.np_format_as(batch, sp))
+                if _can_format_inplace(dspace, sp):
+                    self._inplace_spaces[i] = (dspace, sp)
 
             self._convert[i] = fn
 
@@ -975,32 +1122,192 @@ class FiniteDatasetIterator(object):
         StopIteration
             When there are no more batches to return.
         """
-        next_index = self._subset_iterator.next()
-        # If the dataset is incompatible with the new interface, fall back to
-        # the old one
-        if hasattr(self._dataset, 'get'):
-            rval = self._next(next_index)
+        if self._prefetch > 0:
+            rval = self._prefetched_next()
         else:
-            rval = self._fallback_next(next_index)
+            with get_phase_timer().phase('index'):
+                next_index = self._subset_iterator.next()
+            rval = self._get_batch(next_index, self._take_slot())
 
         if not self._return_tuple and len(rval) == 1:
             rval, = rval
         return rval
 
+    def _take_slot(self):
+        """
+        Returns the position in the buffer rings to use for the next batch,
+        or None if buffers are not reused.
+        """
+        if not self._num_buffers:
+            return None
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self._num_buffers
+        return slot
+
+    def _get_batch(self, next_index, slot=None):
+        # If the dataset is incompatible with the new interface, fall back to
+        # the old one
+        if slot is not None:
+            return self._buffered_next(next_index, slot)
+        elif hasattr(self._dataset, 'get'):
+            return self._next(next_index)
+        else:
+            return self._fallback_next(next_index)
+
+    def _fill_prefetch_queue(self):
+        """
+        Draws indices from the subset iterator and submits the
+        corresponding batches to the thread pool until `prefetch`
+        batches are pending or the subset iterator is exhausted.
+        """
+        while not self._exhausted and len(self._pending) < self._prefetch:
+            try:
+                next_index = self._subset_iterator.next()
+            except StopIteration:
+                self._exhausted = True
+                break
+            self._pending.append(
+                self._pool.apply_async(self._get_batch,
+                                       (next_index, self._take_slot())))
+
+    def _close_pool(self):
+        """
+        Shuts down the prefetching threads, discarding pending batches.
+        """
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            self._pool = None
+            pool.terminate()
+            pool.join()
+        self._pending.clear()
+
+    def close(self):
+        """
+        Stops the iteration, shutting down the prefetching threads if any.
+        Call it when stopping before the iterator is exhausted, e.g.
+        after a fixed number of batches.
+        """
+        self._close_pool()
+        self._exhausted = True
+
+    def __del__(self):
+        try:
+            self._close_pool()
+        except Exception:
+            pass
+
+    def _prefetched_next(self):
+        """
+        Returns the oldest pending batch, keeping the prefetch queue full.
+        """
+        if self._pool is None:
+            if self._exhausted:
+                raise StopIteration()
+            self._pool = ThreadPool(self._prefetch)
+        self._fill_prefetch_queue()
+        if not self._pending:
+            self._close_pool()
+            raise StopIteration()
+        result = self._pending.popleft()
+        self._fill_prefetch_queue()
+        try:
+            return result.get()
+        except Exception:
+            self._close_pool()
+            self._exhausted = True
+            raise
+
     def _next(self, next_index):
-        return tuple(
-            fn(batch) if fn else batch for batch, fn in
-            safe_izip(self._dataset.get(self._source, next_index),
-                      self._convert)
-        )
+        timer = get_phase_timer()
+        with timer.phase('get'):
+            raw = self._dataset.get(self._source, next_index)
+        with timer.phase('format'):
+            return tuple(fn(batch) if fn else batch
+                         for batch, fn in safe_izip(raw, self._convert))
 
     def _fallback_next(self, next_index):
-        # TODO: handle fancy-index copies by allocating a buffer and
-        # using np.take()
-        return tuple(
-            fn(data[next_index]) if fn else data[next_index]
-            for data, fn in safe_izip(self._raw_data, self._convert)
-        )
+        timer = get_phase_timer()
+        with timer.phase('get'):
+            raw = [data[next_index] for data in self._raw_data]
+        with timer.phase('format'):
+            return tuple(fn(batch) if fn else batch
+                         for batch, fn in safe_izip(raw, self._convert))
+
+    def _buffered_next(self, next_index, slot):
+        """
+        Like `_next` or `_fallback_next`, but writes fancy-indexed and
+        converted batches into the buffers at position `slot` of the
+        rings.
+        """
+        timer = get_phase_timer()
+        with timer.phase('get'):
+            raw = self._buffered_get(next_index, slot)
+
+        with timer.phase('format'):
+            return self._buffered_format(raw, slot)
+
+    def _buffered_get(self, next_index, slot):
+        """
+        Retrieves the examples of `next_index`, gathering fancy-indexed
+        examples into the buffers at position `slot` of the rings.
+        """
+        if hasattr(self._dataset, 'get'):
+            raw = self._dataset.get(self._source, next_index)
+        else:
+            raw = []
+            for i, data in enumerate(self._raw_data):
+                if (isinstance(next_index, slice) or
+                        not isinstance(data, np.ndarray)):
+                    raw.append(data[next_index])
+                else:
+                    next_index = np.asarray(next_index)
+                    buf = _reuse_buffer(self._raw_buffers[i], slot,
+                                        (len(next_index),) + data.shape[1:],
+                                        data.dtype)
+                    np.take(data, next_index, axis=0, out=buf)
+                    raw.append(buf)
+        return raw
+
+    def _buffered_format(self, raw, slot):
+        """
+        Formats the batches of `raw`, converting them in place into the
+        buffers at position `slot` of the rings when possible.
+        """
+        rval = []
+        for i, (batch, fn) in enumerate(safe_izip(raw, self._convert)):
+            spaces = self._inplace_spaces[i]
+            if spaces is not None and (isinstance(batch, np.ndarray) or
+                                       scipy.sparse.issparse(batch)):
+                rval.append(self._format_into_buffer(batch, spaces, i, slot))
+            elif fn:
+                rval.append(fn(batch))
+            else:
+                rval.append(batch)
+        return tuple(rval)
+
+    def _format_into_buffer(self, batch, spaces, i, slot):
+        """
+        Formats `batch` from one space to another one of the same kind,
+        writing the result into a buffer of the ring of source `i`
+        unless no conversion is needed. Sparse batches are first
+        densified into a buffer of the raw ring.
+        """
+        dspace, sp = spaces
+        if scipy.sparse.issparse(batch):
+            dense = _reuse_buffer(self._raw_buffers[i], slot, batch.shape,
+                                  batch.dtype)
+            dense.fill(0)
+            batch.tocsr().toarray(out=dense)
+            batch = dense
+        if isinstance(sp, Conv2DSpace):
+            batch = batch.transpose([dspace.axes.index(axis)
+                                     for axis in sp.axes])
+        dtype = batch.dtype if sp.dtype is None else np.dtype(sp.dtype)
+        if batch.dtype == dtype:
+            return batch
+        buf = _reuse_buffer(self._out_buffers[i], slot, batch.shape, dtype)
+        np.copyto(buf, batch, casting='unsafe')
+        return buf
 
     def __next__(self):
         return self.next()
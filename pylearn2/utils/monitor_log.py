@@ -0,0 +1,341 @@
+"""
+Compact storage for the history of monitoring channels.
+
+`ArrayRecord` is a list-like sequence backed by a growable numpy array,
+used for the records of `MonitorChannel`. It supports appending in
+amortized constant time, and `numpy.asarray(record)` does not copy.
+
+`MonitorLog` is an append-only text file with one row per call to the
+`Monitor`. Once a monitor writes to a log (see `Monitor.set_log`), its
+channels are pickled without their history, which is read back from the
+log when needed. `read_monitor_log` reads the history of all the channels
+without loading the model, e.g. for `print_monitor.py` and
+`plot_monitor.py`.
+
+The log starts with the line `# pylearn2 monitor log`. Each line
+starting with `#channels` lists the channels recorded by the rows that
+follow it, separated by tabs. Each row holds the time, the number of
+batches, examples and epochs seen, then the value and standard error of
+each channel. A row reporting no more epochs, batches and examples than
+the previous ones (e.g. after resuming from an older save) replaces them.
+"""
+import logging
+import os
+
+import numpy as np
+
+from pylearn2.compat import OrderedDict
+from pylearn2.utils.string_utils import preprocess
+
+
+log = logging.getLogger(__name__)
+
+_MAGIC = '# pylearn2 monitor log'
+_CHANNELS = '#channels'
+
+# Names and dtypes of the records of a MonitorChannel
+RECORDS = [('time_record', 'float64'),
+           ('batch_record', 'int64'),
+           ('example_record', 'int64'),
+           ('epoch_record', 'int64'),
+           ('val_record', 'float64'),
+           ('stderr_record', 'float64')]
+
+
+class ArrayRecord(object):
+    """
+    A list-like sequence of numbers stored in a numpy array that grows
+    geometrically.
+
+    Parameters
+    ----------
+    values : iterable, optional
+        Initial content.
+    dtype : str, optional
+        Dtype of the elements.
+    """
+
+    def __init__(self, values=(), dtype='float64'):
+        values = np.asarray(list(values) if not isinstance(values, np.ndarray)
+                            else values, dtype=dtype).reshape((-1,))
+        self._data = np.empty(max(16, 2 * len(values)), dtype=dtype)
+        self._data[:len(values)] = values
+        self._size = len(values)
+
+    @property
+    def array(self):
+        """
+        The content of the record, as a view of the underlying array.
+        """
+        return self._data[:self._size]
+
+    @property
+    def dtype(self):
+        """
+        The dtype of the elements.
+        """
+        return self._data.dtype
+
+    def append(self, value):
+        """
+        Adds `value` at the end of the record.
+
+        Parameters
+        ----------
+        value : number
+            The value to add.
+        """
+        if self._size == len(self._data):
+            data = np.empty(2 * len(self._data), dtype=self._data.dtype)
+            data[:self._size] = self._data
+            self._data = data
+        self._data[self._size] = value
+        self._size += 1
+
+    def extend(self, values):
+        """
+        Adds each element of `values` at the end of the record.
+
+        Parameters
+        ----------
+        values : iterable
+            The values to add.
+        """
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __add__(self, values):
+        rval = ArrayRecord(self.array, self.dtype)
+        rval.extend(values)
+        return rval
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ArrayRecord(self.array[index], self.dtype)
+        return self.array[index].item()
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+
+    def __iter__(self):
+        return iter(self.array.tolist())
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ArrayRecord(%r)' % list(self)
+
+    def __getstate__(self):
+        return {'dtype': str(self.dtype), 'values': self.array.copy()}
+
+    def __setstate__(self, d):
+        self.__init__(d['values'], d['dtype'])
+
+
+def as_record(values, dtype):
+    """
+    Returns `values` as an `ArrayRecord`, or unchanged if it contains
+    None (as in old pickles without some of the records).
+
+    Parameters
+    ----------
+    values : iterable
+        Values of the record.
+    dtype : str
+        Dtype of the elements.
+    """
+    if isinstance(values, ArrayRecord):
+        return values
+    values = list(values)
+    if any(value is None for value in values):
+        return values
+    return ArrayRecord(values, dtype)
+
+
+class LoggedChannel(object):
+    """
+    The history of a channel read from a `MonitorLog`, with the same
+    records as a `MonitorChannel`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the channel.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        for record, dtype in RECORDS:
+            setattr(self, record, ArrayRecord(dtype=dtype))
+
+    def _append(self, counters, val, stderr):
+        """
+        Adds one entry, first removing the entries that were measured
+        after it.
+        """
+        def progress(i):
+            return (self.epoch_record[i], self.batch_record[i],
+                    self.example_record[i])
+        new_progress = (counters[3], counters[1], counters[2])
+        keep = len(self.batch_record)
+        while keep > 0 and progress(keep - 1) >= new_progress:
+            keep -= 1
+        if keep < len(self.batch_record):
+            for record, dtype in RECORDS:
+                setattr(self, record, getattr(self, record)[:keep])
+        for (record, _), value in zip(RECORDS, counters + (val, stderr)):
+            getattr(self, record).append(value)
+
+
+class MonitorLog(object):
+    """
+    An append-only file of monitoring records.
+
+    Parameters
+    ----------
+    path : str
+        Path of the log. Environment variables are expanded.
+    """
+
+    def __init__(self, path):
+        self.path = preprocess(path)
+        self._channel_names = None
+
+    def exists(self):
+        """
+        Returns True if the log already contains records.
+        """
+        return os.path.isfile(self.path) and os.path.getsize(self.path) > 0
+
+    def append(self, counters, values, stderrs):
+        """
+        Writes one row.
+
+        Parameters
+        ----------
+        counters : tuple
+            Time, number of batches, examples and epochs seen when the
+            values were measured.
+        values : OrderedDict
+            Maps the names of the channels to their values.
+        stderrs : dict
+            Maps the names of the channels to the standard errors of
+            their values.
+        """
+        names = list(values.keys())
+        for name in names:
+            if '\t' in name or '\n' in name:
+                raise ValueError("Can't log channel %r: its name contains "
+                                 "a tab or newline" % name)
+        lines = []
+        if not self.exists():
+            lines.append(_MAGIC)
+            self._channel_names = None
+        elif self._channel_names is None:
+            # Resuming an existing log: always restate the channels
+            self._channel_names = []
+        if names != self._channel_names:
+            lines.append('\t'.join([_CHANNELS] + names))
+            self._channel_names = names
+        row = ['%r' % float(counters[0])]
+        row.extend('%d' % counter for counter in counters[1:])
+        for name in names:
+            stderr = stderrs.get(name)
+            row.append('%r' % float(values[name]))
+            row.append('%r' % float(stderr if stderr is not None else 0.))
+        lines.append('\t'.join(row))
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, d):
+        self.__init__(d['path'])
+
+
+def is_monitor_log(path):
+    """
+    Returns True if `path` is a `MonitorLog` file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+    """
+    try:
+        with open(path, 'r') as f:
+            return f.readline().rstrip('\n') == _MAGIC
+    except (IOError, UnicodeDecodeError):
+        return False
+
+
+_cache = {}
+
+
+def read_monitor_log(path):
+    """
+    Reads the history of the channels from a `MonitorLog` file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the log.
+
+    Returns
+    -------
+    channels : OrderedDict
+        Maps the names of the channels to `LoggedChannel` objects, which
+        have the same records as a `MonitorChannel`. Don't modify them:
+        they are cached until the file changes.
+    """
+    path = preprocess(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+    if path in _cache and _cache[path][0] == key:
+        return _cache[path][1]
+    channels = OrderedDict()
+    names = []
+    with open(path, 'r') as f:
+        if f.readline().rstrip('\n') != _MAGIC:
+            raise ValueError("%s is not a monitor log" % path)
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == _CHANNELS:
+                names = fields[1:]
+                for name in names:
+                    if name not in channels:
+                        channels[name] = LoggedChannel(name)
+                continue
+            if len(fields) != 4 + 2 * len(names):
+                # Last row of a log that is being written
+                log.warning("Ignoring truncated row of %s" % path)
+                continue
+            counters = ((float(fields[0]),) +
+                        tuple(int(field) for field in fields[1:4]))
+            for i, name in enumerate(names):
+                channels[name]._append(counters, float(fields[4 + 2 * i]),
+                                       float(fields[5 + 2 * i]))
+    _cache[path] = (key, channels)
+    return channels
@@ -0,0 +1,95 @@
+"""
+Tests for pylearn2.utils.checkpoint
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import assert_raises
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.models.mlp import MLP, Softmax
+from pylearn2.termination_criteria import EpochCounter
+from pylearn2.train import Train
+from pylearn2.training_algorithms.learning_rule import Momentum
+from pylearn2.training_algorithms.sgd import SGD
+from pylearn2.utils.checkpoint import load_checkpoint
+
+
+def _make_train(dataset, max_epochs, **kwargs):
+    """
+    Returns a Train object fitting a softmax regression with momentum.
+    """
+    model = MLP(layers=[Softmax(layer_name='y', n_classes=2, irange=0.1)],
+                nvis=3, seed=1)
+    algorithm = SGD(batch_size=2, learning_rate=0.1,
+                    learning_rule=Momentum(0.5),
+                    termination_criterion=EpochCounter(max_epochs=max_epochs))
+    return Train(dataset=dataset, model=model, algorithm=algorithm, **kwargs)
+
+
+def test_checkpoint():
+    """
+    Checks that the checkpoint of Train restores the parameters, the state
+    of the learning rule and the counters of the monitor.
+    """
+    rng = np.random.RandomState(0)
+    dataset = DenseDesignMatrix(X=rng.normal(size=(6, 3)),
+                                y=np.eye(2)[rng.randint(2, size=6)])
+    save_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(save_dir, 'checkpoint.npz')
+        for asynchronous in [False, True]:
+            train = _make_train(dataset, 3, checkpoint_path=path,
+                                asynchronous_checkpoint=asynchronous)
+            train.main_loop()
+            assert os.listdir(save_dir) == ['checkpoint.npz']
+
+            restored = _make_train(dataset, 3)
+            restored.setup()
+            load_checkpoint(path, restored.model, restored.algorithm)
+            state = train.algorithm.get_state_variables()
+            restored_state = restored.algorithm.get_state_variables()
+            assert len(state) > 1
+            for old, new in zip(train.model.get_params() + state,
+                                restored.model.get_params() + restored_state):
+                np.testing.assert_allclose(old.get_value(), new.get_value())
+            assert restored.model.monitor.get_epochs_seen() == 3
+            assert restored.model.monitor.get_batches_seen() == 9
+
+        # The checkpoint must match the model
+        model = MLP(layers=[Softmax(layer_name='y', n_classes=3,
+                                    irange=0.1)], nvis=3)
+        assert_raises(ValueError, load_checkpoint, path, model)
+    finally:
+        shutil.rmtree(save_dir)
+
+
+def test_checkpoint_once_per_epoch():
+    """
+    Checks that Train does not write the final checkpoint again when the
+    last epoch was already checkpointed.
+    """
+    rng = np.random.RandomState(0)
+    dataset = DenseDesignMatrix(X=rng.normal(size=(6, 3)),
+                                y=np.eye(2)[rng.randint(2, size=6)])
+    save_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(save_dir, 'checkpoint.npz')
+        for checkpoint_freq, expected in [(1, [1, 2, 3]), (2, [2, 3])]:
+            train = _make_train(dataset, 3, checkpoint_path=path,
+                                checkpoint_freq=checkpoint_freq,
+                                asynchronous_checkpoint=False)
+            epochs = []
+            save = train.checkpointer.save
+
+            def counting_save(model, algorithm=None):
+                epochs.append(model.monitor.get_epochs_seen())
+                save(model, algorithm)
+
+            train.checkpointer.save = counting_save
+            train.main_loop()
+            assert epochs == expected
+    finally:
+        shutil.rmtree(save_dir)
@@ -0,0 +1,83 @@
+"""
+Tests for pylearn2.utils.function_cache
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+from pylearn2.compat import OrderedDict
+from pylearn2.utils import function, sharedX
+from pylearn2.utils.function_cache import (FunctionCache, get_function_cache,
+                                           set_function_cache)
+
+
+def _make_graph(W_value):
+    """
+    Returns the inputs, output and updates of a gradient step on a small
+    linear model.
+    """
+    X = T.matrix('X')
+    W = sharedX(W_value, 'W')
+    cost = T.sqr(T.dot(X, W)).sum()
+    updates = OrderedDict([(W, W - 0.01 * T.grad(cost, W))])
+    return X, W, cost, updates
+
+
+def test_function_cache():
+    """
+    Checks that a function compiled twice comes from the cache the second
+    time, computes the same values and updates the current shared
+    variables.
+    """
+    rng = np.random.RandomState(0)
+    X_value = rng.randn(5, 3).astype(theano.config.floatX)
+    W_value = rng.randn(3, 2)
+    cache_dir = tempfile.mkdtemp()
+    old_cache = get_function_cache()
+    try:
+        set_function_cache(FunctionCache(cache_dir))
+        results = []
+        for i in range(2):
+            X, W, cost, updates = _make_graph(W_value)
+            f = function([X], cost, updates=updates)
+            results.append((f(X_value), W.get_value()))
+        cache = get_function_cache()
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert len(os.listdir(cache_dir)) == 1
+        np.testing.assert_allclose(results[0][0], results[1][0])
+        np.testing.assert_allclose(results[0][1], results[1][1])
+        assert not np.allclose(results[1][1], W_value)
+
+        # A different graph gives a different entry
+        X, W, cost, updates = _make_graph(W_value)
+        function([X], 2 * cost, updates=updates)
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert len(os.listdir(cache_dir)) == 2
+    finally:
+        set_function_cache(old_cache)
+        shutil.rmtree(cache_dir)
+
+
+def test_eviction():
+    """
+    Checks that the least recently used entries are evicted.
+    """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = FunctionCache(cache_dir)
+        X = T.matrix('X')
+        for i in range(3):
+            cache.function([X], X + i)
+        names = sorted(os.listdir(cache_dir))
+        for i, name in enumerate(names):
+            os.utime(os.path.join(cache_dir, name), (i, i))
+        entry_size = os.path.getsize(os.path.join(cache_dir, names[0]))
+        cache.max_size = int(2.5 * entry_size)
+        cache.evict()
+        assert sorted(os.listdir(cache_dir)) == names[1:]
+    finally:
+        shutil.rmtree(cache_dir)
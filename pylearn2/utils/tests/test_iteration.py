@@ -5,7 +5,7 @@ from nose.tools import assert_raises
 import numpy as np
 import theano
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
-from pylearn2.space import VectorSpace
+from pylearn2.space import CompositeSpace, Conv2DSpace, VectorSpace
 from pylearn2.utils.iteration import (
     SubsetIterator,
     SequentialSubsetIterator,
@@ -13,8 +13,10 @@ from pylearn2.utils.iteration import (
     RandomSliceSubsetIterator,
     RandomUniformSubsetIterator,
     BatchwiseShuffledSequentialIterator,
+    BlockShuffledSequentialSubsetIterator,
     as_even,
     EvenSequencesSubsetIterator,
+    FiniteDatasetIterator,
 )
 
 
@@ -252,3 +254,157 @@ def test_determinism_even_sequences():
         for i in ind_list:
             visited2[i] = b_ind
     assert np.all(np.asarray(visited1) == np.asarray(visited2))
+
+
+def test_prefetch_matches_synchronous_iteration():
+    """
+    Check that a prefetching FiniteDatasetIterator returns the same
+    batches, in the same order, as a synchronous one.
+    """
+    rng = np.random.RandomState(0)
+    X = rng.rand(53, 7).astype(theano.config.floatX)
+    y = rng.rand(53, 2).astype(theano.config.floatX)
+    dataset = DenseDesignMatrix(X=X, y=y)
+    data_specs = (CompositeSpace((VectorSpace(7), VectorSpace(2))),
+                  ('features', 'targets'))
+    for mode in ['sequential', 'shuffled_sequential', 'random_uniform']:
+        for prefetch in [1, 3, 20]:
+            kwargs = dict(mode=mode, batch_size=10, num_batches=6,
+                          data_specs=data_specs)
+            if mode != 'sequential':
+                kwargs['rng'] = 42
+            expected = list(dataset.iterator(**kwargs))
+            iterator = dataset.iterator(prefetch=prefetch, **kwargs)
+            actual = list(iterator)
+            assert len(actual) == len(expected)
+            for (e_X, e_y), (a_X, a_y) in zip(expected, actual):
+                np.testing.assert_equal(a_X, e_X)
+                np.testing.assert_equal(a_y, e_y)
+            assert_raises(StopIteration, iterator.next)
+
+
+def test_prefetch_propagates_errors():
+    """
+    Check that an exception raised while fetching a batch in the
+    background is re-raised by `next`.
+    """
+    dataset = DenseDesignMatrix(X=np.zeros((20, 3),
+                                           dtype=theano.config.floatX))
+
+    def convert(batch):
+        raise ValueError("bad batch")
+
+    iterator = FiniteDatasetIterator(dataset,
+                                     SequentialSubsetIterator(20, 5, None),
+                                     data_specs=(VectorSpace(3), 'features'),
+                                     convert=[convert], prefetch=2)
+    assert_raises(ValueError, iterator.next)
+    assert_raises(StopIteration, iterator.next)
+    assert_raises(ValueError, FiniteDatasetIterator, dataset,
+                  SequentialSubsetIterator(20, 5, None),
+                  data_specs=(VectorSpace(3), 'features'), prefetch=-1)
+
+
+def test_prefetch_close():
+    """
+    Check that closing a prefetching iterator before it is exhausted
+    shuts down its threads and ends the iteration.
+    """
+    dataset = DenseDesignMatrix(X=np.zeros((20, 3),
+                                           dtype=theano.config.floatX))
+    iterator = FiniteDatasetIterator(dataset,
+                                     SequentialSubsetIterator(20, 5, None),
+                                     data_specs=(VectorSpace(3), 'features'),
+                                     prefetch=2)
+    iterator.next()
+    assert iterator._pool is not None
+    iterator.close()
+    assert iterator._pool is None
+    assert_raises(StopIteration, iterator.next)
+
+
+def test_block_shuffled_sequential():
+    """
+    Check that BlockShuffledSequentialSubsetIterator visits every example
+    once, keeps blocks together and is deterministic given a seed.
+    """
+    dataset_size = 103
+    block_size = 20
+    iterator = BlockShuffledSequentialSubsetIterator(dataset_size, 10, None,
+                                                     rng=3,
+                                                     block_size=block_size)
+    visited = np.concatenate(list(iterator))
+    assert sorted(visited) == list(range(dataset_size))
+    assert not np.all(visited == np.arange(dataset_size))
+    # Every block of the permutation maps to a single block of the data
+    blocks = visited // block_size
+    changes = np.flatnonzero(np.diff(blocks)) + 1
+    assert len(changes) == int(np.ceil(dataset_size / float(block_size))) - 1
+    assert len(np.unique(blocks)) == len(changes) + 1
+
+    again = BlockShuffledSequentialSubsetIterator(dataset_size, 10, None,
+                                                  rng=3,
+                                                  block_size=block_size)
+    assert np.all(np.concatenate(list(again)) == visited)
+    assert_raises(ValueError, BlockShuffledSequentialSubsetIterator,
+                  dataset_size, 10, None, block_size=0)
+
+    class PermutationUniformRNG(object):
+        """
+        RNG that only provides the methods the iterator uses.
+        """
+        def __init__(self, seed):
+            self._rng = np.random.RandomState(seed)
+            self.permutation = self._rng.permutation
+            self.uniform = self._rng.uniform
+
+    rng = PermutationUniformRNG(3)
+    custom = BlockShuffledSequentialSubsetIterator(dataset_size, 10, None,
+                                                   rng=rng,
+                                                   block_size=block_size)
+    assert custom._rng is rng
+    assert np.all(np.concatenate(list(custom)) == visited)
+
+
+def test_num_buffers_matches_allocating_iteration():
+    """
+    Check that reusing batch buffers doesn't change the returned batches,
+    and that the buffers are actually reused.
+    """
+    rng = np.random.RandomState(0)
+    topo = rng.rand(23, 3, 4, 2)
+    y = rng.rand(23, 2)
+    dataset = DenseDesignMatrix(topo_view=topo, y=y, axes=('b', 0, 1, 'c'))
+    specs = [
+        (CompositeSpace((VectorSpace(24, dtype='float32'),
+                         VectorSpace(2, dtype='float32'))),
+         ('features', 'targets')),
+        (CompositeSpace((Conv2DSpace((3, 4), num_channels=2,
+                                     axes=('c', 0, 1, 'b')),
+                         VectorSpace(2, dtype='float64'))),
+         ('features', 'targets')),
+    ]
+    for data_specs in specs:
+        for mode in ['sequential', 'shuffled_sequential']:
+            for prefetch, num_buffers in [(0, 1), (0, 3), (2, 3)]:
+                kwargs = dict(mode=mode, batch_size=5, data_specs=data_specs)
+                if mode != 'sequential':
+                    kwargs['rng'] = 7
+                expected = list(dataset.iterator(**kwargs))
+                iterator = dataset.iterator(prefetch=prefetch,
+                                            num_buffers=num_buffers,
+                                            **kwargs)
+                targets = []
+                for b, (X, t) in enumerate(iterator):
+                    np.testing.assert_equal(X, expected[b][0])
+                    np.testing.assert_equal(t, expected[b][1])
+                    assert X.dtype == expected[b][0].dtype
+                    assert t.dtype == expected[b][1].dtype
+                    targets.append(t)
+                assert len(targets) == len(expected)
+                if mode != 'sequential':
+                    assert np.may_share_memory(targets[0],
+                                               targets[num_buffers])
+    assert_raises(ValueError, dataset.iterator, mode='sequential',
+                  batch_size=5, data_specs=specs[0], prefetch=2,
+                  num_buffers=2)
@@ -0,0 +1,106 @@
+"""
+Tests for pylearn2.utils.monitor_log
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.models.mlp import MLP, Softmax
+from pylearn2.termination_criteria import EpochCounter
+from pylearn2.train import Train
+from pylearn2.training_algorithms.sgd import SGD
+from pylearn2.utils import serial
+from pylearn2.utils.monitor_log import (ArrayRecord, MonitorLog,
+                                        is_monitor_log, read_monitor_log)
+
+
+def test_array_record():
+    """
+    Checks that ArrayRecord behaves like a list.
+    """
+    record = ArrayRecord(dtype='int64')
+    values = list(range(40))
+    for value in values:
+        record.append(value)
+    assert record == values
+    assert len(record) == 40
+    assert record[-1] == 39 and isinstance(record[-1], int)
+    assert record[5:10] == values[5:10]
+    assert isinstance(record[5:10], ArrayRecord)
+    record[-1] = 0
+    assert record[-1] == 0
+    record += [1, 2]
+    assert len(record) == 42
+    assert np.asarray(record).dtype == 'int64'
+    assert serial.from_string(serial.to_string(record)) == record
+
+
+def test_read_monitor_log():
+    """
+    Checks that rows that don't report more progress than the previous
+    ones replace them, and that channels may be added.
+    """
+    log_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(log_dir, 'monitor.log')
+        monitor_log = MonitorLog(path)
+        for epoch in [0, 1, 2, 1, 2]:
+            monitor_log.append((float(epoch), 10 * epoch, 20 * epoch, epoch),
+                               {'a': epoch / 2.}, {})
+        MonitorLog(path).append((3., 30, 60, 3),
+                                {'a': 1.5, 'b': 3.}, {'b': .5})
+        assert is_monitor_log(path)
+        channels = read_monitor_log(path)
+        assert list(channels.keys()) == ['a', 'b']
+        assert channels['a'].epoch_record == [0, 1, 2, 3]
+        assert channels['a'].val_record == [0., .5, 1., 1.5]
+        assert channels['b'].batch_record == [30]
+        assert channels['b'].stderr_record == [.5]
+    finally:
+        shutil.rmtree(log_dir)
+
+
+def test_monitor_log():
+    """
+    Checks that a model trained with a monitor log is pickled without its
+    channel history, and reads it back from the log.
+    """
+    rng = np.random.RandomState(0)
+    dataset = DenseDesignMatrix(X=rng.normal(size=(6, 3)),
+                                y=np.eye(2)[rng.randint(2, size=6)])
+    log_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(log_dir, 'monitor.log')
+        sizes = []
+        for max_epochs in [2, 6]:
+            if os.path.exists(path):
+                os.remove(path)
+            model = MLP(layers=[Softmax(layer_name='y', n_classes=2,
+                                        irange=0.1)], nvis=3, seed=1)
+            algorithm = SGD(batch_size=2, learning_rate=0.1,
+                            monitoring_dataset=dataset,
+                            termination_criterion=EpochCounter(max_epochs))
+            train = Train(dataset=dataset, model=model, algorithm=algorithm,
+                          monitor_log_path=path)
+            train.main_loop()
+            channels = model.monitor.channels
+            sizes.append(len(serial.to_string(model.monitor)))
+
+        logged = read_monitor_log(path)
+        assert sorted(logged.keys()) == sorted(channels.keys())
+        restored = serial.from_string(serial.to_string(model.monitor))
+        for name, channel in channels.items():
+            assert len(channel.val_record) == 7
+            np.testing.assert_allclose(logged[name].val_record,
+                                       channel.val_record)
+            assert restored.channels[name].batch_record == \
+                channel.batch_record
+            np.testing.assert_allclose(restored.channels[name].val_record,
+                                       channel.val_record)
+        # Only the formatting of the counters may change the size
+        assert abs(sizes[1] - sizes[0]) < 100
+    finally:
+        shutil.rmtree(log_dir)
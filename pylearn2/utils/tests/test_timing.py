@@ -0,0 +1,30 @@
+"""
+Tests for pylearn2.utils.timing
+"""
+import time
+
+from pylearn2.utils.timing import PhaseTimer, get_phase_timer
+
+
+def test_phase_timer():
+    """
+    Checks that nested phases are recorded under their parent, only
+    while the timer is active on the current thread.
+    """
+    timer = PhaseTimer()
+    with get_phase_timer().phase('ignored'):
+        pass
+    with timer.activate():
+        active = get_phase_timer()
+        with active.phase('train'):
+            for i in active.iterate('data', range(3)):
+                with active.phase('update'):
+                    time.sleep(0.01)
+    assert get_phase_timer() is not timer
+    assert sorted(timer.totals) == ['train', 'train/data', 'train/update']
+    assert timer.totals['train/update'] >= 0.03
+    assert timer.totals['train'] >= timer.totals['train/update']
+    assert 'update' in timer.summary()
+    timer.reset()
+    assert timer.seconds['train'] == 0.
+    assert timer.totals['train'] > 0.
@@ -10,6 +10,10 @@ __email__ = "wardefar@iro"
 from contextlib import contextmanager
 import logging
 import datetime
+import threading
+import time
+
+from pylearn2.compat import OrderedDict
 
 
 def total_seconds(delta):
@@ -82,3 +86,174 @@ def log_timing(logger, task, level=logging.INFO, final_msg=None,
     if callbacks is not None:
         for callback in callbacks:
             callback(total)
+
+
+class _Phase(object):
+    """
+    Context manager adding the time spent in its block to a phase of a
+    `PhaseTimer`.
+    """
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        stack = self.timer._stack
+        stack.append(stack[-1] + '/' + self.name if stack else self.name)
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.timer._stack.pop(), time.time() - self.start)
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the time spent in named phases of the training loop.
+
+    Phases are nested: a phase entered while another one is active is
+    recorded under the path `outer/inner`, e.g. `train/data/get` for
+    the `get` phase of the dataset iterator during training, and
+    `monitor/data/get` during monitoring.
+
+    The training algorithms and iterators record their phases in the
+    timer that is active on the current thread (see `activate` and
+    `get_phase_timer`).
+    """
+
+    def __init__(self):
+        # Seconds per phase since the creation of the timer
+        self.totals = OrderedDict()
+        # Seconds per phase since the last call to reset
+        self.seconds = OrderedDict()
+        self._stack = []
+
+    def phase(self, name):
+        """
+        Returns a context manager recording the time spent in its block
+        as phase `name`, nested in the active phase if any.
+
+        Parameters
+        ----------
+        name : str
+            Name of the phase.
+        """
+        return _Phase(self, name)
+
+    def iterate(self, name, iterable):
+        """
+        Iterates over `iterable`, recording the time spent getting each
+        element as phase `name`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the phase.
+        iterable : iterable
+            The iterable to time.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, path, seconds):
+        """
+        Adds `seconds` to the phase `path`.
+
+        Parameters
+        ----------
+        path : str
+            Full path of the phase.
+        seconds : float
+            Time spent in the phase.
+        """
+        self.totals[path] = self.totals.get(path, 0.) + seconds
+        self.seconds[path] = self.seconds.get(path, 0.) + seconds
+
+    def reset(self):
+        """
+        Sets the time spent in each phase since the last reset to 0.
+        """
+        for path in self.seconds:
+            self.seconds[path] = 0.
+
+    @contextmanager
+    def activate(self):
+        """
+        Context manager making this timer the one returned by
+        `get_phase_timer` on the current thread.
+        """
+        previous = getattr(_active, 'timer', None)
+        _active.timer = self
+        try:
+            yield self
+        finally:
+            _active.timer = previous
+
+    def summary(self, totals=True):
+        """
+        Returns a human-readable table of the time spent in each phase,
+        with nested phases indented under their parent.
+
+        Parameters
+        ----------
+        totals : bool, optional
+            If True, reports the time since the creation of the timer,
+            otherwise since the last reset.
+        """
+        seconds = self.totals if totals else self.seconds
+        overall = sum(value for path, value in seconds.items()
+                      if '/' not in path)
+        lines = ['Time per phase:']
+        for path in sorted(seconds):
+            depth = path.count('/')
+            percent = 100. * seconds[path] / overall if overall > 0 else 0.
+            lines.append('\t%s%-*s %12.3f s %6.1f%%'
+                         % ('  ' * depth, 30 - 2 * depth,
+                            path.split('/')[-1], seconds[path], percent))
+        return '\n'.join(lines)
+
+
+class _NullPhaseTimer(object):
+    """
+    A timer that records nothing, returned by `get_phase_timer` when no
+    timer is active.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def phase(self, name):
+        """
+        Returns a context manager that does nothing.
+        """
+        return self
+
+    def iterate(self, name, iterable):
+        """
+        Returns `iterable`.
+        """
+        return iterable
+
+
+_active = threading.local()
+_null_timer = _NullPhaseTimer()
+
+
+def get_phase_timer():
+    """
+    Returns the `PhaseTimer` active on the current thread, or a timer
+    that records nothing if there is none.
+    """
+    timer = getattr(_active, 'timer', None)
+    if timer is None:
+        return _null_timer
+    return timer